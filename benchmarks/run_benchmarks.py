@@ -0,0 +1,244 @@
+'''
+Time the hot paths of the reconstruction on synthetic data with fixed seeds
+
+Each benchmark is run `--repeat` times and reports the minimum and median
+wall time, and a digest of its output (rounded to `--decimals`), so that an
+optimization can be checked to give identical physics output. With
+`--baseline`, results are compared to a previous results file: the exit code
+is 1 if any output digest differs, or if a benchmark is slower than the
+baseline by more than `--tolerance` and `--fail_slower` is given.
+
+Usage: python benchmarks/run_benchmarks.py [-o results.json] [--baseline baseline.json]
+       [-k hough] [-n NEVENTS] [--ndir NDIR] [--repeat N]
+
+'''
+import argparse
+import hashlib
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import h5py
+import numpy as np
+from larpixreco.HitParser import HitParser
+from larpixreco.EventBuilder import EventBuilder
+from larpixreco.RecoFile import RecoFile
+from larpixreco.SyntheticData import write_file, generate_events
+from larpixreco.algorithms import hough
+
+def digest(arrays, decimals=6):
+    ''' Returns a hex digest of a list of arrays, floats are rounded to decimals '''
+    sha = hashlib.sha1()
+    for array in arrays:
+        array = np.asarray(array)
+        if array.dtype.kind == 'f':
+            array = np.round(array, decimals) + 0. # no negative zeros
+        sha.update(str(array.shape).encode())
+        sha.update(np.ascontiguousarray(array).tobytes())
+    return sha.hexdigest()
+
+def event_points(event):
+    ''' Returns the (x, y, z) points used by `TrackReconstruction` '''
+    return np.array([np.array(event['px'])/10, np.array(event['py'])/10,
+                     (np.array(event['ts']) - event.ts_start)/1000]).T
+
+def hough_params(args):
+    params = hough.HoughParameters()
+    params.ndirections = args.ndir
+    params.dr = 3
+    return params
+
+class Benchmarks(object):
+    '''
+    The benchmarks, each ``bench_<name>`` method runs its setup and returns a
+    function that runs the timed code and returns a list of output arrays
+    '''
+    def __init__(self, args, tmpdir):
+        self.args = args
+        self.tmpdir = tmpdir
+        self.datafile = os.path.join(tmpdir, 'synthetic.h5')
+        write_file(self.datafile, n_events=args.nevents, max_delay=args.max_delay,
+                   tracks_per_event=args.tracks, noise_rate=args.noise_rate, seed=args.seed)
+        self._events = None
+        self._cache = None
+
+    @classmethod
+    def names(cls):
+        return [name[len('bench_'):] for name in sorted(dir(cls))
+                if name.startswith('bench_')]
+
+    @property
+    def events(self):
+        if self._events is None:
+            self._events = list(EventBuilder(self.datafile, use_cache=False).iter_events())
+        return self._events
+
+    @property
+    def fit_cache(self):
+        if self._cache is None:
+            self._cache = hough.setup_fit_errors()
+        return self._cache
+
+    def largest_event_points(self):
+        return event_points(max(self.events, key=lambda event: event.nhit))
+
+    def bench_hitparser_sort(self):
+        def run():
+            hp = HitParser(self.datafile, sort_buffer_length=self.args.sort_buffer_length)
+            blocks = list(hp.iter_sorted_blocks())
+            return [np.concatenate([block['hid'] for block in blocks]),
+                    np.concatenate([block['ts'] for block in blocks])]
+        return run
+
+    def bench_event_builder(self):
+        def run():
+            eb = EventBuilder(self.datafile, use_cache=False)
+            events = list(eb.iter_events())
+            return [[event.evid for event in events], [event.nhit for event in events],
+                    [event.hits[0].hid for event in events]]
+        return run
+
+    def bench_compute_hough(self):
+        points = self.largest_event_points()
+        def run():
+            params = hough.compute_hough(points, hough_params(self.args))
+            return [params.accumulator]
+        return run
+
+    def bench_run_iterative_hough(self):
+        points = self.largest_event_points()
+        def run():
+            lines, _, _ = hough.run_iterative_hough(points, hough_params(self.args),
+                                                    5, None)
+            return [np.concatenate((line.coords(), hit_idcs))
+                    for line, hit_idcs in lines.items()]
+        return run
+
+    def bench_fit_errors(self):
+        points = self.largest_event_points()
+        cache = self.fit_cache
+        line = hough.fit_line_least_squares(points, hough.get_fit_line(
+                points, hough.compute_hough(points, hough_params(self.args))), 3)
+        closer, _, _ = hough.split_by_distance(points, line, 3)
+        def run():
+            cov = hough.fit_errors(closer, line, cache)
+            return [np.zeros(0) if cov is None else cov]
+        return run
+
+    def bench_recofile_write(self):
+        events = generate_events(self.args.nevents, seed=self.args.seed)
+        filename = os.path.join(self.tmpdir, 'reco.h5')
+        def run():
+            recofile = RecoFile(filename, opt='o', write_queue_length=100)
+            for event in events:
+                recofile.queue(event)
+            recofile.close()
+            outputs = []
+            with h5py.File(filename, 'r') as datafile:
+                for dataset_name in sorted(datafile):
+                    if not isinstance(datafile[dataset_name], h5py.Dataset):
+                        continue
+                    dataset = datafile[dataset_name][:]
+                    outputs += [dataset[field] for field in dataset.dtype.names
+                                if h5py.check_ref_dtype(dataset.dtype[field]) is None]
+            return outputs
+        return run
+
+def run_benchmark(benchmarks, name, repeat, decimals):
+    run = getattr(benchmarks, 'bench_' + name)()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        outputs = run()
+        times += [time.perf_counter() - start]
+    return {
+        'min_s' : min(times),
+        'median_s' : float(np.median(times)),
+        'times_s' : times,
+        'digest' : digest(outputs, decimals)
+        }
+
+def compare(results, baseline, tolerance):
+    '''
+    Compare results to baseline results, returns (lines of a report, number of
+    changed outputs, number of slower benchmarks)
+    '''
+    report = []
+    n_changed = 0
+    n_slower = 0
+    if results['config'] != baseline.get('config'):
+        report += ['warning: benchmark configuration differs from baseline']
+    for name, result in results['benchmarks'].items():
+        if not name in baseline['benchmarks']:
+            report += ['{:24s} (not in baseline)'.format(name)]
+            continue
+        base = baseline['benchmarks'][name]
+        ratio = result['min_s'] / base['min_s']
+        status = []
+        if result['digest'] != base['digest']:
+            status += ['OUTPUT CHANGED']
+            n_changed += 1
+        if ratio > 1 + tolerance:
+            status += ['slower']
+            n_slower += 1
+        elif ratio < 1 - tolerance:
+            status += ['faster']
+        report += ['{:24s} {:9.4f}s -> {:9.4f}s  x{:.2f}  {}'.format(
+                    name, base['min_s'], result['min_s'], ratio, ' '.join(status))]
+    return report, n_changed, n_slower
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-o', '--outfile', default=None, help='write results to json file')
+    parser.add_argument('--baseline', default=None, help='results file to compare to')
+    parser.add_argument('-k', '--select', default=None,
+                        help='only run benchmarks whose name contains this string')
+    parser.add_argument('-n', '--nevents', default=200, type=int)
+    parser.add_argument('--tracks', default=2., type=float, help='mean tracks per event')
+    parser.add_argument('--noise_rate', default=1e3, type=float, help='noise hit rate (Hz)')
+    parser.add_argument('--max_delay', default=5000, type=int, help='readout delay (ns)')
+    parser.add_argument('--sort_buffer_length', default=2000, type=int)
+    parser.add_argument('--ndir', default=300, type=int, help='Hough directions')
+    parser.add_argument('--seed', default=0, type=int)
+    parser.add_argument('--repeat', default=3, type=int)
+    parser.add_argument('--decimals', default=6, type=int,
+                        help='decimals of float outputs compared (default: %(default)s)')
+    parser.add_argument('--tolerance', default=0.1, type=float,
+                        help='relative change in time reported as slower/faster')
+    parser.add_argument('--fail_slower', action='store_true',
+                        help='exit with code 1 if a benchmark is slower than the baseline')
+    args = parser.parse_args()
+
+    config = dict((key, getattr(args, key)) for key in (
+            'nevents', 'tracks', 'noise_rate', 'max_delay', 'sort_buffer_length',
+            'ndir', 'seed', 'decimals'))
+    results = {
+        'config' : config,
+        'python' : platform.python_version(),
+        'numpy' : np.__version__,
+        'benchmarks' : {}
+        }
+    names = [name for name in Benchmarks.names()
+             if args.select is None or args.select in name]
+    with tempfile.TemporaryDirectory() as tmpdir:
+        benchmarks = Benchmarks(args, tmpdir)
+        for name in names:
+            results['benchmarks'][name] = run_benchmark(benchmarks, name, args.repeat,
+                                                        args.decimals)
+            print('{:24s} {:9.4f}s'.format(name, results['benchmarks'][name]['min_s']))
+    if args.outfile is not None:
+        with open(args.outfile, 'w') as outfile:
+            json.dump(results, outfile, indent=2)
+    if args.baseline is not None:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+        report, n_changed, n_slower = compare(results, baseline, args.tolerance)
+        print('\n'.join(['', 'compared to {}:'.format(args.baseline)] + report))
+        if n_changed or (args.fail_slower and n_slower):
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+'''
+Benchmark the write bandwidth and file size of each `RecoFile` storage profile
+
+Usage: python benchmarks/storage_profiles.py [-n NEVENTS] [--overlap N] [-o results.json]
+
+'''
+import argparse
+import json
+import os
+import tempfile
+import time
+import h5py
+from larpixreco.RecoFile import RecoFile
+from larpixreco.SyntheticData import generate_events
+
+def run_profile(events, storage_profile, format_version, tmpdir):
+    ''' Write events with profile and return a dict of results '''
+    filename = os.path.join(tmpdir, '{}_v{}.h5'.format(storage_profile,
+                                                      format_version))
+    start = time.perf_counter()
+    recofile = RecoFile(filename, write_queue_length=100,
+                        format_version=format_version,
+                        storage_profile=storage_profile,
+                        expected_nevents=len(events))
+    for event in events:
+        recofile.queue(event)
+    recofile.close()
+    elapsed = time.perf_counter() - start
+    file_bytes = os.path.getsize(filename)
+    with h5py.File(filename, 'r') as datafile:
+        # measured after close, so the rows flushed by close are included
+        data_bytes = sum(dataset.dtype.itemsize * dataset.shape[0]
+                         for dataset in datafile.values()
+                         if isinstance(dataset, h5py.Dataset))
+    return {
+        'storage_profile' : storage_profile,
+        'format_version' : format_version,
+        'write_s' : elapsed,
+        'write_MBps' : data_bytes / elapsed / 1e6,
+        'data_MB' : data_bytes / 1e6,
+        'file_MB' : file_bytes / 1e6
+        }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', '--nevents', default=2000, type=int)
+    parser.add_argument('--overlap', default=0, type=int,
+                        help='number of hits shared between tracks')
+    parser.add_argument('-o', '--outfile', default=None, help='write results to json file')
+    args = parser.parse_args()
+
+    events = generate_events(args.nevents, overlap=args.overlap)
+    results = []
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for format_version in sorted(RecoFile.format_versions.keys()):
+            for storage_profile in RecoFile.storage_profiles.keys():
+                results += [run_profile(events, storage_profile, format_version,
+                                        tmpdir)]
+                print('{storage_profile:>14s} v{format_version}: '
+                      '{write_MBps:8.1f} MB/s {file_MB:8.2f} MB file '
+                      '({data_MB:.2f} MB data)'.format(**results[-1]))
+    if args.outfile is not None:
+        with open(args.outfile, 'w') as outfile:
+            json.dump(results, outfile, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,13 @@
+import argparse
+from larpixreco.HitParser import expand_filenames
+from larpixreco.RecoShards import consolidate
+from larpixreco.RecoLogging import initializeLogger
+
+parser = argparse.ArgumentParser(description='Present reconstruction output shards as a single file')
+parser.add_argument('outfile')
+parser.add_argument('shards', nargs='+', help='shard files or glob patterns')
+parser.add_argument('-l', '--logfile', default=None)
+args = parser.parse_args()
+
+logger = initializeLogger(level='info', filename=args.logfile)
+consolidate(expand_filenames(args.shards), args.outfile)
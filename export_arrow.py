@@ -0,0 +1,25 @@
+import argparse
+from larpixreco.ArrowExport import export_parquet, vector_modes
+from larpixreco.RecoLogging import initializeLogger
+
+parser = argparse.ArgumentParser(description='Export reconstruction output files to Parquet')
+parser.add_argument('infiles', nargs='+')
+parser.add_argument('-o', '--outdir', default=None,
+                    help='output directory (default: next to input file)')
+parser.add_argument('-l', '--logfile', default=None)
+parser.add_argument('--datasets', nargs='+', default=None,
+                    help='datasets to export (default: all)')
+parser.add_argument('--batch_rows', default=65536, type=int,
+                    help='rows per record batch and row group (default: %(default)s)')
+parser.add_argument('--vector_mode', default='list', choices=vector_modes,
+                    help='store vector fields as fixed-size lists or flattened columns '
+                    '(default: %(default)s)')
+parser.add_argument('--compression', default='snappy',
+                    help='parquet compression codec (default: %(default)s)')
+args = parser.parse_args()
+
+logger = initializeLogger(level='info', filename=args.logfile)
+for infile in args.infiles:
+    export_parquet(infile, outdir=args.outdir, datasets=args.datasets,
+                   batch_rows=args.batch_rows, vector_mode=args.vector_mode,
+                   compression=args.compression)
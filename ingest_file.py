@@ -0,0 +1,24 @@
+import argparse
+from larpixreco.HitCache import ingest
+from larpixreco.RecoLogging import initializeLogger
+
+parser = argparse.ArgumentParser(description='Create time-sorted hit caches of raw data files')
+parser.add_argument('infiles', nargs='+')
+parser.add_argument('-o', '--outfile', default=None,
+                    help='cache filename (only valid for a single input file)')
+parser.add_argument('-l', '--logfile', default=None)
+parser.add_argument('--sort_mode', default='external', choices=['buffer', 'external'],
+                    help='hit sorting method (default: %(default)s)')
+parser.add_argument('--sort_buffer_length', default=100, type=int,
+                    help='sort buffer length in buffer mode (default: %(default)s)')
+parser.add_argument('--sort_memory', default=256, type=float,
+                    help='memory limit for external sort in MB (default: %(default)s)')
+args = parser.parse_args()
+
+if args.outfile is not None and len(args.infiles) > 1:
+    parser.error('--outfile can only be used with a single input file')
+logger = initializeLogger(level='info', filename=args.logfile)
+for infile in args.infiles:
+    ingest(infile, cache_filename=args.outfile, sort_mode=args.sort_mode,
+           sort_buffer_length=args.sort_buffer_length,
+           sort_memory=int(args.sort_memory*1e6))
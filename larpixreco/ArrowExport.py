@@ -0,0 +1,155 @@
+'''
+Export of reconstruction output files to Arrow record batches and Parquet
+
+Datasets are read with a `RecoReader.RecoReader` in chunks of `batch_rows`
+rows, so memory use is bounded by the chunk size rather than the file size.
+Relations are exported as row indices in every format version: region
+references of format version 1 files are converted to the index columns of
+format version 2 (``event_idx``, ``track_idx``, ``hit_start``, ...).
+
+Vector fields (e.g. the ``(3,)f8`` track ``start`` and ``end``) are stored as
+fixed-size lists (``vector_mode='list'``) or flattened into one column per
+component (``vector_mode='flatten'``, e.g. ``start_x``, ``start_y``,
+``start_z``).
+
+Requires pyarrow (``pip install pyarrow``).
+'''
+import os
+import numpy as np
+import h5py
+from larpixreco.RecoReader import RecoReader
+from larpixreco.RecoLogging import getLogger
+logger = getLogger(__name__)
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+vector_modes = ('list', 'flatten')
+vector_components = 'xyz'
+export_datasets = ('events', 'tracks', 'hits')
+
+def _require_pyarrow():
+    if pa is None:
+        raise ImportError('pyarrow is required for Arrow/Parquet export')
+
+def _ref_index_columns(reader, dataset_name, start, stop):
+    '''
+    Returns a dict of row index columns replacing the region references of rows
+    start to stop of a format version 1 dataset
+    '''
+    index = reader.index
+    columns = {}
+    if dataset_name == 'events':
+        for field in ('track_start', 'track_stop', 'hit_start', 'hit_stop'):
+            columns[field] = index['event_' + field][start:stop]
+    elif dataset_name == 'tracks':
+        columns['event_idx'] = index['track_event_idx'][start:stop]
+        columns['hit_start'] = index['track_hit_start'][start:stop]
+        columns['hit_stop'] = index['track_hit_stop'][start:stop]
+    elif dataset_name == 'hits':
+        rows = np.arange(start, stop)
+        for field, prefix in (('event_idx', 'event'), ('track_idx', 'track')):
+            starts = index[prefix + '_hit_start']
+            stops = index[prefix + '_hit_stop']
+            order = np.argsort(starts, kind='stable')
+            pos = np.searchsorted(starts[order], rows, side='right') - 1
+            parent = order[np.maximum(pos, 0)]
+            inside = (pos >= 0) & (rows < stops[parent])
+            columns[field] = np.where(inside, parent, -9999)
+    return columns
+
+def _to_arrays(data, vector_mode, extra_columns=None):
+    ''' Convert a structured array into a list of (name, pyarrow array) '''
+    arrays = []
+    for name in data.dtype.names:
+        dtype = data.dtype[name]
+        if h5py.check_ref_dtype(dtype) is not None:
+            # region references are not exported
+            continue
+        column = data[name]
+        if dtype.subdtype is not None:
+            size = int(np.prod(dtype.shape))
+            column = column.reshape(len(column), size)
+            if vector_mode == 'flatten':
+                for i in range(size):
+                    suffix = vector_components[i] if size <= len(vector_components) \
+                        else str(i)
+                    arrays += [('{}_{}'.format(name, suffix),
+                                pa.array(np.ascontiguousarray(column[:,i])))]
+            else:
+                arrays += [(name, pa.FixedSizeListArray.from_arrays(
+                            pa.array(column.reshape(-1)), size))]
+        else:
+            arrays += [(name, pa.array(column))]
+    for name, column in (extra_columns or {}).items():
+        arrays += [(name, pa.array(np.asarray(column, dtype='i8')))]
+    return arrays
+
+def _record_batch(reader, dataset_name, start, stop, vector_mode):
+    ''' Returns rows start to stop of a dataset as a pyarrow RecordBatch '''
+    view = getattr(reader, dataset_name)
+    extra_columns = None
+    if reader.format_version == 1:
+        extra_columns = _ref_index_columns(reader, dataset_name, start, stop)
+    names, arrays = zip(*_to_arrays(view[start:stop], vector_mode, extra_columns))
+    return pa.RecordBatch.from_arrays(list(arrays), names=list(names))
+
+def iter_record_batches(reader, dataset_name, batch_rows=65536, vector_mode='list'):
+    '''
+    Generator of pyarrow RecordBatches of batch_rows rows of a dataset of an
+    open `RecoReader`
+    '''
+    _require_pyarrow()
+    if not vector_mode in vector_modes:
+        raise ValueError('unknown vector mode {}'.format(vector_mode))
+    nrows = len(getattr(reader, dataset_name))
+    for start in range(0, nrows, batch_rows):
+        yield _record_batch(reader, dataset_name, start,
+                            min(start + batch_rows, nrows), vector_mode)
+
+def parquet_filename(filename, dataset_name, outdir=None):
+    ''' Filename of the Parquet file of a dataset exported from filename '''
+    base = os.path.splitext(os.path.basename(filename))[0]
+    if outdir is None:
+        outdir = os.path.dirname(filename)
+    return os.path.join(outdir, '{}.{}.parquet'.format(base, dataset_name))
+
+def export_parquet(filename, outdir=None, datasets=None, batch_rows=65536,
+                   vector_mode='list', compression='snappy'):
+    '''
+    Export datasets of a reconstruction output file into one Parquet file each
+    (see `parquet_filename`). Each batch of batch_rows rows is written as one
+    row group with column statistics (min/max/null count), so readers can skip
+    row groups by predicate. Returns a dict of dataset name -> Parquet filename
+    By default, `export_datasets` and, if present, ``track_hits`` are exported
+    '''
+    _require_pyarrow()
+    filenames = {}
+    with RecoReader(filename) as reader:
+        if datasets is None:
+            datasets = export_datasets
+            if reader.track_hits is not None:
+                datasets += ('track_hits',)
+        for dataset_name in datasets:
+            outfile = parquet_filename(filename, dataset_name, outdir)
+            writer = None
+            nrows = 0
+            for batch in iter_record_batches(reader, dataset_name, batch_rows,
+                                             vector_mode):
+                if writer is None:
+                    writer = pq.ParquetWriter(outfile, batch.schema,
+                                              compression=compression,
+                                              write_statistics=True)
+                writer.write_batch(batch, row_group_size=batch_rows)
+                nrows += batch.num_rows
+            if writer is None:
+                # empty dataset, write schema only
+                schema = _record_batch(reader, dataset_name, 0, 0, vector_mode).schema
+                writer = pq.ParquetWriter(outfile, schema, compression=compression)
+            writer.close()
+            logger.info('exported {} {} rows to {}'.format(nrows, dataset_name, outfile))
+            filenames[dataset_name] = outfile
+    return filenames
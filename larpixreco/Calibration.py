@@ -0,0 +1,90 @@
+import numpy as np
+from larpixreco.HitParser import HitParser
+from larpixreco.RecoLogging import getLogger
+logger = getLogger(__name__)
+
+class Calibration(object):
+    '''
+    A hit stream stage that applies per-channel calibrations to hit blocks
+
+    Calibration tables are keyed by (chipid, channelid) and are stored as dense
+    arrays, so a hit block is calibrated with a single fancy-indexing lookup
+    per field:
+     - ``q`` becomes ``(q - pedestal) * gain``, where ``q`` is the pedestal
+       subtracted charge from the data file
+     - ``geom`` and ``iochain`` are filled from the tables
+     - ``px`` and ``py`` are replaced where a pixel position is given
+
+    Channels that are not in the tables are left unchanged. The tables cover
+    at least `n_chips` x `n_channels` channels, or the largest ids given.
+    '''
+    n_chips = 256
+    n_channels = 64
+    table_fields = ('pedestal', 'gain', 'geom', 'iochain', 'px', 'py')
+
+    def __init__(self, n_chips=None, n_channels=None):
+        shape = (self.n_chips if n_chips is None else n_chips,
+                 self.n_channels if n_channels is None else n_channels)
+        self.pedestal = np.zeros(shape)
+        self.gain = np.ones(shape)
+        self.geom = np.full(shape, HitParser.empty_value, dtype='i8')
+        self.iochain = np.full(shape, HitParser.empty_value, dtype='i8')
+        self.px = np.full(shape, np.nan)
+        self.py = np.full(shape, np.nan)
+
+    @classmethod
+    def from_arrays(cls, chipid, channelid, **tables):
+        '''
+        Create a calibration from arrays of chipids and channelids, and arrays of
+        table values passed via kwargs (see `table_fields`)
+        '''
+        chipid = np.asarray(chipid, dtype='i8')
+        channelid = np.asarray(channelid, dtype='i8')
+        if np.any(chipid < 0) or np.any(channelid < 0):
+            raise ValueError('chipid and channelid must be non-negative')
+        calibration = cls(n_chips=max(cls.n_chips, int(np.max(chipid, initial=-1)) + 1),
+                          n_channels=max(cls.n_channels, int(np.max(channelid, initial=-1)) + 1))
+        for field, values in tables.items():
+            if not field in cls.table_fields:
+                raise ValueError('unknown calibration field {}'.format(field))
+            getattr(calibration, field)[chipid, channelid] = values
+        return calibration
+
+    @classmethod
+    def from_file(cls, filename):
+        '''
+        Load a calibration from a whitespace-delimited text file with a header
+        line naming the columns, e.g.::
+
+            chipid channelid pedestal gain geom
+            1 0 5.2 1.01 12
+            ...
+
+        '''
+        table = np.genfromtxt(filename, names=True, ndmin=1)
+        tables = dict((field, table[field]) for field in table.dtype.names
+                      if field in cls.table_fields)
+        logger.info('loaded calibration for {} channels from {}'.format(len(table),
+                                                                       filename))
+        return cls.from_arrays(table['chipid'], table['channelid'], **tables)
+
+    def __call__(self, block):
+        ''' Apply calibration to a hit block (in place) '''
+        chipid = block['chipid']
+        channelid = block['channelid']
+        n_chips, n_channels = self.pedestal.shape
+        in_table = (chipid >= 0) & (chipid < n_chips) & (channelid >= 0) \
+            & (channelid < n_channels)
+        if not np.all(in_table):
+            # channels outside of the tables are not calibrated
+            block[in_table] = self(block[in_table])
+            return block
+        block['q'] = (block['q'] - self.pedestal[chipid, channelid]) \
+            * self.gain[chipid, channelid]
+        block['geom'] = self.geom[chipid, channelid]
+        block['iochain'] = self.iochain[chipid, channelid]
+        for field in ('px', 'py'):
+            values = getattr(self, field)[chipid, channelid]
+            has_value = ~np.isnan(values)
+            block[field][has_value] = values[has_value]
+        return block
@@ -0,0 +1,159 @@
+import h5py
+import numpy as np
+from larpixreco.HitParser import HitParser, expand_filenames
+from larpixreco.RecoLogging import getLogger
+logger = getLogger(__name__)
+
+def extend_table(table, shape):
+    ''' Returns a (chips, channels) table zero-padded to at least shape '''
+    shape = tuple(max(size, table_size) for size, table_size in zip(shape, table.shape))
+    if shape == table.shape:
+        return table
+    extended = np.zeros(shape, dtype=table.dtype)
+    extended[:table.shape[0], :table.shape[1]] = table
+    return extended
+
+class NoisyChannelMask(object):
+    '''
+    A hit stream stage that removes hits from channels with a rate above
+    `threshold` (in Hz)
+
+    The mask can be determined with a first pass over the data (`fit` or
+    `fit_file`), or updated continuously from the hit stream using a rolling
+    window of `window` ns. In rolling mode, the rates measured in one window
+    are used to mask hits in the following window.
+
+    Add the mask to `HitParser.stages` (or pass it to the `EventBuilder` via
+    `hit_stages`) to apply it before event building.
+
+    The mask is a (chips, channels) table, which is extended when hits with
+    larger chip or channel ids are seen.
+    '''
+    n_chips = 256 # initial table size
+    n_channels = 64
+
+    def __init__(self, threshold=100., window=None):
+        self.threshold = threshold
+        self.window = window
+        self.mask = np.zeros((self.n_chips, self.n_channels), dtype=bool)
+        self.n_hits = 0
+        self.n_masked_hits = 0
+
+        self._window_counts = np.zeros(self.mask.shape, dtype='i8')
+        self._window_start = None
+
+    def extend(self, chipid, channelid):
+        ''' Extend the mask tables to include arrays of chipids and channelids '''
+        if len(chipid) == 0:
+            return
+        shape = (int(np.max(chipid)) + 1, int(np.max(channelid)) + 1)
+        if shape[0] > self.mask.shape[0] or shape[1] > self.mask.shape[1]:
+            self.mask = extend_table(self.mask, shape)
+            self._window_counts = extend_table(self._window_counts, shape)
+            logger.debug('extended channel mask to {}'.format(self.mask.shape))
+
+    def channel_counts(self, chipid, channelid):
+        ''' Returns a (chips, channels) table of the number of hits per channel '''
+        chipid = np.asarray(chipid, dtype='i8')
+        channelid = np.asarray(channelid, dtype='i8')
+        self.extend(chipid, channelid)
+        n_chips, n_channels = self.mask.shape
+        return np.bincount(chipid * n_channels + channelid,
+                           minlength=n_chips * n_channels).reshape(n_chips, n_channels)
+
+    @property
+    def masked_channels(self):
+        ''' Returns an array of masked (chipid, channelid) pairs '''
+        return np.argwhere(self.mask)
+
+    def update_mask(self, counts, duration):
+        ''' Mask channels with a rate (counts per `duration` ns) above threshold '''
+        if duration <= 0:
+            return
+        rates = counts / (duration * 1e-9)
+        self.mask = rates > self.threshold
+        logger.debug('{} channels above {} Hz'.format(np.count_nonzero(self.mask),
+                                                       self.threshold))
+
+    def fit(self, chipid, channelid, ts):
+        ''' Determine the mask from arrays of hit chipids, channelids, and timestamps '''
+        if len(ts) == 0:
+            return
+        self.update_mask(self.channel_counts(chipid, channelid),
+                         np.max(ts) - np.min(ts))
+
+    def fit_file(self, filename, chunk_length=65536):
+        '''
+        Determine the mask with a first pass over a data file (or list of
+        files), reading only the chipid, channelid, and timestamp columns
+        '''
+        col = HitParser._name2col_map
+        counts = np.zeros(self.mask.shape, dtype='i8')
+        ts_min, ts_max = np.inf, -np.inf
+        for filename in expand_filenames(filename):
+            with h5py.File(filename, 'r') as datafile:
+                data = datafile['data']
+                for start in range(0, data.shape[0], chunk_length):
+                    rows = data[start:start+chunk_length]
+                    chunk_counts = self.channel_counts(rows[:,col['chipid']],
+                                                       rows[:,col['channelid']])
+                    counts = extend_table(counts, chunk_counts.shape) + chunk_counts
+                    ts_min = min(ts_min, rows[:,col['timestamp']].min())
+                    ts_max = max(ts_max, rows[:,col['timestamp']].max())
+        if np.isfinite(ts_min):
+            self.update_mask(counts, ts_max - ts_min)
+        logger.info('masked {} noisy channels'.format(np.count_nonzero(self.mask)))
+
+    def _mask_windows(self, block):
+        '''
+        Returns a mask of the hits of a sorted block to keep, each hit is
+        masked with the mask of the window before its own. The hits are
+        accumulated into rolling windows, updating the mask at each window
+        boundary
+        '''
+        keep = np.ones(len(block), dtype=bool)
+        start = 0
+        while start < len(block):
+            if self._window_start is None:
+                self._window_start = block['ts'][start]
+            window_end = self._window_start + self.window
+            stop = start + np.searchsorted(block['ts'][start:], window_end, side='left')
+            chipid, channelid = block['chipid'][start:stop], block['channelid'][start:stop]
+            keep[start:stop] = ~self.mask[chipid, channelid]
+            self._window_counts += self.channel_counts(chipid, channelid)
+            start = stop
+            if start < len(block):
+                self.update_mask(self._window_counts, self.window)
+                self._window_counts[:] = 0
+                self._window_start = window_end
+                if block['ts'][start] >= window_end + self.window:
+                    # skip empty windows, which have no noisy channels
+                    self.mask[:] = False
+                    self._window_start = block['ts'][start]
+        return keep
+
+    def __call__(self, block):
+        ''' Remove hits on masked channels from a hit block '''
+        self.extend(block['chipid'], block['channelid'])
+        if self.window is None:
+            keep = ~self.mask[block['chipid'], block['channelid']]
+        else:
+            keep = self._mask_windows(block)
+        self.n_hits += len(block)
+        self.n_masked_hits += len(block) - np.count_nonzero(keep)
+        return block[keep]
+
+    def write(self, recofile):
+        ''' Store the mask as metadata in the info group of a `RecoFile` '''
+        recofile.write_attr(noisy_channels=self.masked_channels,
+                            noisy_channel_threshold=self.threshold,
+                            noisy_channel_masked_hits=self.n_masked_hits)
+
+    def read(self, recofile, accumulate=False):
+        '''
+        Restore the masked hit count stored by `write`, or add it to the count
+        with `accumulate` (the mask itself is not restored)
+        '''
+        if not accumulate:
+            self.n_masked_hits = 0
+        self.n_masked_hits += int(recofile.read_attr('noisy_channel_masked_hits', default=0))
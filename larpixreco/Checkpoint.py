@@ -0,0 +1,93 @@
+'''
+Checkpoint and resume of long reconstruction runs
+
+`save_checkpoint` writes all queued output of a `RecoFile` and stores a
+checkpoint in its info group (see `RecoFile.checkpoint`):
+ - ``next_evid``: the event id following the last written event
+ - ``last_ts``: the time of the last hit of the last written event
+ - ``hit_row``: the last file row read by the `HitParser`
+ - ``nrows``: the number of rows of each output dataset
+
+The run totals of the `stages` passed to `save_checkpoint` (objects with
+`write` and `read` methods, e.g. the `EventFilter` or the
+`ReconstructionChain`) are written with each checkpoint, and are restored by
+`resume_event_builder`.
+
+`resume_event_builder` removes the output written after the checkpoint and
+returns an `EventBuilder` that continues with the next event. Because the
+file rows are only roughly time-ordered, reading restarts at the first row
+preceded only by hits up to ``last_ts`` (see `restart_row`), and the hits up
+to ``last_ts`` that are read again are removed before event building (see
+`SkipWritten`). The next event therefore starts with the same hit as in an
+uninterrupted run, unless the last written event was split at
+`EventBuilder.max_ev_len`.
+'''
+import h5py
+import numpy as np
+from larpixreco.HitParser import HitParser, expand_filenames
+from larpixreco.EventBuilder import EventBuilder
+from larpixreco.EventPlanner import _read_ts
+from larpixreco.RecoLogging import getLogger
+logger = getLogger(__name__)
+
+class SkipWritten(object):
+    ''' Hit stage that removes hits up to the checkpoint time `last_ts` '''
+    def __init__(self, last_ts):
+        self.last_ts = last_ts
+
+    def __call__(self, block):
+        return block[block['ts'] > self.last_ts]
+
+def save_checkpoint(recofile, event_builder, last_event, stages=()):
+    '''
+    Store a checkpoint after last_event (the last event queued to recofile) was
+    built by event_builder, along with the run totals of stages
+    '''
+    for stage in stages:
+        stage.write(recofile)
+    hit_row = None
+    if type(event_builder.data) is HitParser:
+        # cached and merged hits are not read in file row order
+        hit_row = int(event_builder.data.sort_buffer_idx)
+    recofile.checkpoint(next_evid=int(last_event.evid) + 1,
+                        last_ts=int(last_event.ts_end), hit_row=hit_row)
+
+def restart_row(filename, last_ts, hit_row=None, block_length=65536):
+    '''
+    Returns the first row of a raw data file that is preceded only by hits at
+    or before last_ts (at most hit_row + 1)
+    '''
+    with h5py.File(filename, 'r') as datafile:
+        data = datafile['data']
+        stop = data.shape[0] if hit_row is None else min(hit_row + 1, data.shape[0])
+        for start in range(0, stop, block_length):
+            ts = _read_ts(data, start, min(start + block_length, stop))
+            later = np.nonzero(ts > last_ts)[0]
+            if len(later) > 0:
+                return start + int(later[0])
+    return stop
+
+def resume_event_builder(recofile, filename, stages=(), **builder_kwargs):
+    '''
+    Remove the output of recofile written after its last checkpoint, restore
+    the run totals of stages, and return (event_builder, checkpoint) to
+    continue building events from the raw data file filename (a single file).
+    builder_kwargs are passed to the `EventBuilder`
+    '''
+    if len(expand_filenames(filename)) != 1:
+        raise ValueError('resuming is only supported for a single input file')
+    checkpoint = recofile.resume()
+    for stage in stages:
+        stage.read(recofile)
+    hit_stages = list(builder_kwargs.pop('hit_stages', None) or [])
+    start_row = 0
+    if checkpoint['last_ts'] is not None:
+        start_row = restart_row(filename, checkpoint['last_ts'], checkpoint['hit_row'])
+        hit_stages = [SkipWritten(checkpoint['last_ts'])] + hit_stages
+    builder_kwargs['use_cache'] = False
+    event_builder = EventBuilder(filename, row_range=(start_row, None),
+                                 evid_offset=checkpoint['next_evid'],
+                                 hit_stages=hit_stages, **builder_kwargs)
+    logger.info('resuming {} at event {} (row {})'.format(
+            filename, checkpoint['next_evid'], start_row))
+    return event_builder, checkpoint
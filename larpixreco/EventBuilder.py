@@ -1,18 +1,76 @@
+from collections import deque
+import numpy as np
 from larpixreco.types import Hit, Event
-from larpixreco.HitParser import HitParser
+from larpixreco.HitParser import HitParser, MultiFileHitParser, expand_filenames
+from larpixreco.HitCache import CachedHitParser, default_cache_filename, is_valid_cache
+from larpixreco.Metrics import metrics
 from larpixreco.RecoLogging import getLogger
 logger = getLogger(__name__)
 
+_events_built = metrics.counter('events_total', 'events built')
+_hits_built = metrics.counter('hits_total', 'hits in built events')
+
 class EventBuilder(object):
     max_ev_len = 5000
     min_ev_len = 5
     dt_cut = int(10e3) # ns
 
-    def __init__(self, filename, sort_buffer_length=100):
+    def __init__(self, filename, sort_buffer_length=100, sort_mode='buffer',
+                 sort_memory=int(256e6), use_cache=True, hit_stages=None,
+                 block_mode=False, row_range=None, evid_offset=0, event_filter=None):
+        '''
+        `filename` can be a single file, a glob pattern, or a list of files. Hits
+        from multiple files are merged into a single time-ordered stream.
+        See `HitParser` for a description of the sort options.
+        If `use_cache`, hits of a single file are read from a valid hit cache
+        (see `HitCache.ingest`) when one is present. The cache is already
+        sorted, so it takes precedence over the sort options (a warning is
+        logged if they differ from the defaults).
+        `hit_stages` is a list of callables applied to each sorted hit block
+        before event building (e.g. a `ChannelMask.NoisyChannelMask`).
+        In `block_mode`, event boundaries are found for whole sorted hit blocks
+        at once (see `find_events` and `iter_event_ranges`), and `Hit` objects
+        are only created for hits in events.
+        `row_range` limits event building to the (start, stop) rows of a single
+        file, and event ids start at `evid_offset` (see `EventPlanner`).
+        `event_filter` (an `EventFilter.EventFilter`) selects events before the
+        `Event` objects are created. In `block_mode` the filter is evaluated on
+        the hit block ranges, before any `Hit` objects are created.
+        '''
         self.filename = filename
-        self.data = HitParser(filename, sort_buffer_length=sort_buffer_length)
-        self.curr_evid = 0
+        filenames = expand_filenames(filename)
+        if row_range is not None and len(filenames) > 1:
+            raise ValueError('row_range requires a single file')
+        if len(filenames) > 1:
+            self.data = MultiFileHitParser(filenames,
+                                           sort_buffer_length=sort_buffer_length,
+                                           sort_mode=sort_mode,
+                                           sort_memory=sort_memory)
+        elif use_cache and row_range is None and is_valid_cache(default_cache_filename(filenames[0]),
+                                          filenames[0]):
+            logger.info('reading hits from cache {}'.format(
+                    default_cache_filename(filenames[0])))
+            sort_options = (sort_buffer_length, sort_mode, sort_memory)
+            if sort_options != EventBuilder.__init__.__defaults__[:3]:
+                logger.warning('sort options are ignored for the sorted hit cache {} '
+                               '(pass use_cache=False to sort the raw file)'.format(
+                        default_cache_filename(filenames[0])))
+            self.data = CachedHitParser(default_cache_filename(filenames[0]))
+        else:
+            self.data = HitParser(filenames[0],
+                                  sort_buffer_length=sort_buffer_length,
+                                  sort_mode=sort_mode, sort_memory=sort_memory,
+                                  row_range=row_range)
+        if hit_stages is not None:
+            self.data.stages += list(hit_stages)
+        self.block_mode = block_mode
+        self.evid_offset = evid_offset
+        self.event_filter = event_filter
+        self.curr_evid = evid_offset
         self.events = []
+        self._next_hit = None
+        self._event_ranges = None
+        self._pending_events = []
 
     @staticmethod
     def is_associated(hit, hits_to_compare):
@@ -23,15 +81,15 @@ class EventBuilder(object):
 
     @staticmethod
     def is_consecutive(hit, hits_to_compare):
-        ''' Check if hit is within `EventBuilder.dt_cut` of any hit in list '''
+        '''
+        Check if hit is within `EventBuilder.dt_cut` of any hit in list
+        Hits are time-ordered, so only the last hit in the list is compared
+        '''
         if hit is None:
             return False
         elif len(hits_to_compare) == 0:
             return True
-        for comp_hit in hits_to_compare:
-            if abs(hit.ts - comp_hit.ts) < EventBuilder.dt_cut:
-                return True
-        return False
+        return abs(hit.ts - hits_to_compare[-1].ts) < EventBuilder.dt_cut
 
     @staticmethod
     def is_event(hits):
@@ -39,41 +97,173 @@ class EventBuilder(object):
             return False
         return True
 
+    @classmethod
+    def find_events(cls, ts, dt_cut=None, min_ev_len=None, max_ev_len=None):
+        '''
+        Find events in an array of sorted timestamps
+        Events are split where consecutive hits are at least `dt_cut` apart and
+        every `max_ev_len` hits, and events with less than `min_ev_len` hits are
+        dropped. Returns arrays of (start, stop) indices of each event
+        '''
+        dt_cut = cls.dt_cut if dt_cut is None else dt_cut
+        min_ev_len = cls.min_ev_len if min_ev_len is None else min_ev_len
+        max_ev_len = cls.max_ev_len if max_ev_len is None else max_ev_len
+        ts = np.asarray(ts)
+        boundaries = np.nonzero(np.diff(ts) >= dt_cut)[0] + 1
+        run_starts = np.concatenate(([0], boundaries)).astype('i8')
+        run_stops = np.concatenate((boundaries, [len(ts)])).astype('i8')
+        if len(ts) == 0:
+            run_starts, run_stops = run_starts[:0], run_stops[:0]
+        # split runs longer than max_ev_len
+        n_split = np.maximum((run_stops - run_starts + max_ev_len - 1) // max_ev_len, 1)
+        split_offsets = np.arange(n_split.sum()) - np.repeat(np.cumsum(n_split) - n_split,
+                                                            n_split)
+        starts = np.repeat(run_starts, n_split) + split_offsets * max_ev_len
+        stops = np.minimum(starts + max_ev_len, np.repeat(run_stops, n_split))
+        is_event = stops - starts >= min_ev_len
+        return starts[is_event], stops[is_event]
+
+    def iter_event_ranges(self):
+        '''
+        Iterate over (hit_block, starts, stops), where events are the hit
+        block rows starts[i]:stops[i]
+        Hits following the last complete event of a block are carried over to
+        the next block
+        '''
+        carry = None
+        for block in self.data.iter_hit_blocks():
+            if carry is not None and len(carry) > 0:
+                block = np.concatenate((carry, block))
+            boundaries = np.nonzero(np.diff(block['ts']) >= self.dt_cut)[0] + 1
+            last_start = boundaries[-1] if len(boundaries) > 0 else 0
+            # full length events of the last run are complete
+            last_start += (len(block) - last_start) // self.max_ev_len * self.max_ev_len
+            carry = block[last_start:]
+            starts, stops = self.find_events(block['ts'][:last_start])
+            if len(starts) > 0:
+                yield block, starts, stops
+        if carry is not None and len(carry) > 0:
+            starts, stops = self.find_events(carry['ts'])
+            if len(starts) > 0:
+                yield carry, starts, stops
+
     def reset(self):
         ''' Resets internal loop to start of file '''
-        self.curr_evid = 0
-        self.events = []
+        self.curr_evid = self.evid_offset
+        self.events.clear()
 
     def clear(self):
         ''' Resets the events list without changing the position in the file '''
-        self.events = []
+        self.events.clear()
 
     def store_new_event(self, hits):
         event = Event(evid=self.curr_evid, hits=hits)
         self.events += [event]
         self.curr_evid += 1
+        _events_built.inc()
+        _hits_built.inc(len(hits))
         return event
 
     def get_next_event(self):
-        ''' Parse data file until a new event is found '''
+        '''
+        Parse data file until a new event is found
+        Events rejected by the `event_filter` are skipped, but use up an evid
+        '''
+        while True:
+            if self.block_mode:
+                hits = self._get_next_block_hits()
+            else:
+                hits = self._get_next_hits()
+                if hits and self.event_filter is not None and \
+                        not self.event_filter.select_hits(hits):
+                    hits = []
+            if hits is None:
+                return None
+            elif len(hits) == 0:
+                # rejected by filter
+                self.curr_evid += 1
+                continue
+            return self.store_new_event(hits=hits)
+
+    def _get_next_hits(self):
+        ''' Collect sorted hits until a new event is found, or None at end of file '''
         hits = []
-        while len(hits) < EventBuilder.max_ev_len:
+        if self._next_hit is not None:
+            hits = [self._next_hit]
+            self._next_hit = None
+        while True:
             curr_hit = self.data.get_next_sorted_hit()
-            if EventBuilder.is_associated(curr_hit, hits):
+            if curr_hit is None:
+                break
+            if len(hits) < EventBuilder.max_ev_len and \
+                    EventBuilder.is_associated(curr_hit, hits):
                 # hit should be associated with others -> store and continue
                 hits.append(curr_hit)
             elif EventBuilder.is_event(hits):
-                # collected hits are an event -> return
-                return self.store_new_event(hits=hits)
+                # collected hits are an event -> return, hit starts next event
+                self._next_hit = curr_hit
+                return hits
             else:
-                hits = []
-            
-            if curr_hit is None:
-                break
+                hits = [curr_hit]
 
         if EventBuilder.is_event(hits):
             # remaining hits are an event -> return
-            return self.store_new_event(hits=hits)
+            return hits
         else:
             return None
 
+    def iter_events(self, batch_size=None, window=0):
+        '''
+        Iterate over events, or lists of up to batch_size events
+        Only the `window` most recent events are kept in `events` (for
+        algorithms that need to look back), so memory use does not grow with
+        the number of events. When iteration ends, `events` is a list again
+        (with the retained events), which keeps every new event
+        '''
+        self.events = deque(self.events, maxlen=window)
+        try:
+            batch = []
+            while True:
+                event = self.get_next_event()
+                if event is None:
+                    break
+                if batch_size is None:
+                    yield event
+                    continue
+                batch += [event]
+                if len(batch) >= batch_size:
+                    yield batch
+                    batch = []
+            if batch_size is not None and len(batch) > 0:
+                yield batch
+        finally:
+            self.events = list(self.events)
+
+    def _get_next_block_hits(self):
+        '''
+        Returns the hits of the next event found with `iter_event_ranges`, an
+        empty list if the event is rejected by the `event_filter`, or None at the
+        end of the file
+        '''
+        if self._event_ranges is None:
+            self._event_ranges = self.iter_event_ranges()
+        while len(self._pending_events) == 0:
+            ranges = next(self._event_ranges, None)
+            if ranges is None:
+                return None
+            block, starts, stops = ranges
+            if self.event_filter is None:
+                keep = [True] * len(starts)
+            else:
+                # events are counted as they are returned, so that the counts
+                # match the events built so far (see `Checkpoint`)
+                keep = self.event_filter.select(block, starts, stops, count=False).tolist()
+            self._pending_events = [block[start:stop] if event_kept else None
+                                    for start, stop, event_kept
+                                    in zip(starts.tolist(), stops.tolist(), keep)][::-1]
+        event_block = self._pending_events.pop()
+        if self.event_filter is not None:
+            self.event_filter.count([event_block is not None])
+        if event_block is None:
+            return []
+        return self.data.convert_hit_block_to_hits(event_block)
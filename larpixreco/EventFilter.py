@@ -0,0 +1,107 @@
+import numpy as np
+from larpixreco.RecoLogging import getLogger
+logger = getLogger(__name__)
+
+class EventFilter(object):
+    '''
+    Event predicates evaluated on hit block ranges before any `Event` or `Hit`
+    objects are created (pass to the `EventBuilder` via `event_filter`)
+
+    Ranges are given as (min, max) tuples (inclusive), either of which may be
+    None:
+     - `nhit`: number of hits
+     - `time_span`: time between the first and last hit (ns)
+     - `q`: total charge
+    `chipids` is a set of chip ids, and `chip_mode` selects whether an event
+    needs a hit on ``'any'`` of the chips, hits on ``'all'`` of the chips, or
+    ``'only'`` hits on the chips.
+
+    Rejected events are counted in `n_rejected`, the number of evaluated events
+    in `n_events` (`select` with ``count=False`` leaves counting to the caller,
+    see `count`).
+    '''
+    chip_modes = ('any', 'all', 'only')
+
+    def __init__(self, nhit=None, time_span=None, q=None, chipids=None, chip_mode='any'):
+        if not chip_mode in self.chip_modes:
+            raise ValueError('chip_mode must be one of {}'.format(self.chip_modes))
+        self.nhit = nhit
+        self.time_span = time_span
+        self.q = q
+        self.chipids = None if chipids is None else np.unique(chipids)
+        self.chip_mode = chip_mode
+        self.n_events = 0
+        self.n_rejected = 0
+
+    @staticmethod
+    def in_range(values, value_range):
+        ''' Returns mask of values within an inclusive (min, max) range '''
+        keep = np.ones(len(values), dtype=bool)
+        if value_range is None:
+            return keep
+        value_min, value_max = value_range
+        if value_min is not None:
+            keep &= values >= value_min
+        if value_max is not None:
+            keep &= values <= value_max
+        return keep
+
+    @staticmethod
+    def range_sums(values, starts, stops):
+        ''' Returns the sums of values[starts[i]:stops[i]] '''
+        cumsum = np.concatenate(([0], np.cumsum(values)))
+        return cumsum[stops] - cumsum[starts]
+
+    def select(self, block, starts, stops, count=True):
+        '''
+        Returns a mask of the events block[starts[i]:stops[i]] that pass the
+        filter (the hits of each event are time-ordered)
+        '''
+        starts = np.asarray(starts, dtype='i8')
+        stops = np.asarray(stops, dtype='i8')
+        nhit = stops - starts
+        keep = self.in_range(nhit, self.nhit)
+        if self.time_span is not None:
+            span = block['ts'][stops - 1] - block['ts'][starts]
+            keep &= self.in_range(span, self.time_span)
+        if self.q is not None:
+            keep &= self.in_range(self.range_sums(block['q'], starts, stops), self.q)
+        if self.chipids is not None:
+            on_chips = np.isin(block['chipid'], self.chipids)
+            if self.chip_mode == 'any':
+                keep &= self.range_sums(on_chips, starts, stops) > 0
+            elif self.chip_mode == 'only':
+                keep &= self.range_sums(on_chips, starts, stops) == nhit
+            else:
+                for chipid in self.chipids:
+                    keep &= self.range_sums(block['chipid'] == chipid, starts, stops) > 0
+        if count:
+            self.count(keep)
+        return keep
+
+    def count(self, keep):
+        ''' Add the events of a selection mask to the counts '''
+        self.n_events += len(keep)
+        self.n_rejected += len(keep) - np.count_nonzero(keep)
+
+    def select_hits(self, hits):
+        ''' Returns True if a time-ordered list of `Hit` objects passes the filter '''
+        block = np.empty(len(hits), dtype=[('ts', 'i8'), ('q', 'f8'), ('chipid', 'i8')])
+        for field in block.dtype.names:
+            block[field] = [getattr(hit, field) for hit in hits]
+        return bool(self.select(block, [0], [len(hits)])[0])
+
+    def write(self, recofile):
+        ''' Store the filter counts as metadata in the info group of a `RecoFile` '''
+        recofile.write_attr(event_filter_events=self.n_events,
+                            event_filter_rejected=self.n_rejected)
+
+    def read(self, recofile, accumulate=False):
+        '''
+        Restore the counts stored by `write` (e.g. to resume a run), or add them
+        to the counts with `accumulate`
+        '''
+        if not accumulate:
+            self.n_events, self.n_rejected = 0, 0
+        self.n_events += int(recofile.read_attr('event_filter_events', default=0))
+        self.n_rejected += int(recofile.read_attr('event_filter_rejected', default=0))
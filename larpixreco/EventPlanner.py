@@ -0,0 +1,166 @@
+'''
+Planning of parallel event building over a single raw data file
+
+A file row is a safe cut between two ranges if every hit before it is at
+least `EventBuilder.dt_cut` earlier than every hit after it. Events can then
+never span the cut, even though the rows of the file are only roughly
+time-ordered, so the ranges are built and reconstructed independently (see
+`process_parallel`). The planner finds such cuts near the N-quantiles of the
+file rows by reading the timestamp column in blocks.
+
+Events of a range are numbered from 0 while it is processed. The shards are
+then renumbered by the number of event ids used by the ranges before them (see
+`RecoShards.consolidate`), so event ids are the same as in a serial run.
+'''
+import multiprocessing
+import numpy as np
+import h5py
+from larpixreco.HitParser import HitParser
+from larpixreco.EventBuilder import EventBuilder
+from larpixreco.RecoFile import RecoFile, MetadataRecord
+from larpixreco.RecoShards import open_shard, consolidate
+from larpixreco.Pipeline import default_reconstructions, reconstruct_batch
+from larpixreco.RecoLogging import getLogger
+logger = getLogger(__name__)
+
+def _read_ts(data, start, stop):
+    return data[start:stop, HitParser._name2col_map['timestamp']]
+
+def block_ts_bounds(data, block_length):
+    ''' Returns arrays of the minimum and maximum timestamp of each block of rows '''
+    nblocks = (data.shape[0] + block_length - 1) // block_length
+    mins = np.empty(nblocks)
+    maxs = np.empty(nblocks)
+    for block_idx in range(nblocks):
+        ts = _read_ts(data, block_idx * block_length, (block_idx + 1) * block_length)
+        mins[block_idx] = ts.min()
+        maxs[block_idx] = ts.max()
+    return mins, maxs
+
+def find_cuts(ts, ts_max_before, ts_min_after, dt_cut):
+    '''
+    Returns the indices i into ts at which the rows can be cut, such that all
+    hits before i (including those before ts, up to ts_max_before) are at least
+    dt_cut earlier than all hits from i on (including those after ts, from
+    ts_min_after)
+    '''
+    prefix_max = np.maximum.accumulate(np.concatenate(([ts_max_before], ts)))
+    suffix_min = np.minimum.accumulate(np.concatenate((ts, [ts_min_after]))[::-1])[::-1]
+    return np.nonzero(suffix_min - prefix_max >= dt_cut)[0]
+
+def plan_ranges(filename, n_ranges, dt_cut=None, block_length=65536, max_search_blocks=8):
+    '''
+    Split the rows of a raw data file into at most n_ranges independent
+    (start, stop) row ranges of roughly equal size
+    Each cut is the safe cut closest to its target row, searched for within
+    `max_search_blocks` blocks of `block_length` rows. If no safe cut is
+    found, the neighbouring ranges are merged
+    '''
+    dt_cut = EventBuilder.dt_cut if dt_cut is None else dt_cut
+    with h5py.File(filename, 'r') as datafile:
+        data = datafile['data']
+        nrows = data.shape[0]
+        if nrows == 0:
+            return []
+        mins, maxs = block_ts_bounds(data, block_length)
+        max_before = np.concatenate(([-np.inf], np.maximum.accumulate(maxs)))
+        min_after = np.concatenate((np.minimum.accumulate(mins[::-1])[::-1], [np.inf]))
+        cuts = []
+        for target in np.linspace(0, nrows, n_ranges + 1)[1:-1].astype(int):
+            target_block = target // block_length
+            search = [target_block]
+            for step in range(1, max_search_blocks):
+                search += [target_block + step, target_block - step]
+            for block_idx in search:
+                if not 0 <= block_idx < len(mins):
+                    continue
+                start = block_idx * block_length
+                block_cuts = start + find_cuts(
+                    _read_ts(data, start, start + block_length),
+                    max_before[block_idx], min_after[block_idx + 1], dt_cut)
+                block_cuts = block_cuts[(block_cuts > 0) & (block_cuts < nrows)]
+                if len(block_cuts) > 0:
+                    cuts += [block_cuts[np.argmin(np.abs(block_cuts - target))]]
+                    break
+            else:
+                logger.warning('no safe cut found near row {}'.format(target))
+    bounds = [0] + sorted(set(int(cut) for cut in cuts)) + [nrows]
+    ranges = list(zip(bounds[:-1], bounds[1:]))
+    logger.info('planned {} row ranges for {}'.format(len(ranges), filename))
+    return ranges
+
+def process_range(filename, outfile, shard_idx, row_range, reconstruct=True,
+                  make_reconstructions=default_reconstructions, recofile_kwargs=None,
+                  **builder_kwargs):
+    '''
+    Build (and reconstruct, with the reconstructions returned by
+    `make_reconstructions`) the events of a row range, writing them to a shard
+    of outfile. The events are reconstructed in batches of the write queue
+    length of the shard (see `Pipeline.reconstruct_batch`). Event ids start at 0.
+    Returns (shard filename, number of events, number of event ids used,
+    metadata of the hit stages, event filter and reconstructions)
+    '''
+    reconstructions = make_reconstructions() if reconstruct else []
+    builder_kwargs['use_cache'] = False
+    eb = EventBuilder(filename, row_range=row_range, **builder_kwargs)
+    recofile = open_shard(outfile, shard_idx, **(recofile_kwargs or {}))
+    n_events = 0
+    for events in eb.iter_events(batch_size=recofile.write_queue_length):
+        reconstruct_batch(reconstructions, events)
+        for event in events:
+            recofile.queue(event)
+        for reconstruction in reconstructions:
+            if hasattr(reconstruction, 'write_records'):
+                reconstruction.write_records(recofile)
+        n_events += len(events)
+    recofile.close()
+    stages = list(builder_kwargs.get('hit_stages') or []) + \
+        [builder_kwargs.get('event_filter')] + reconstructions
+    metadata = MetadataRecord.from_stages([stage for stage in stages if stage is not None])
+    return recofile.filename, n_events, eb.curr_evid - eb.evid_offset, metadata
+
+def process_parallel(filename, outfile, processes=None, n_ranges=None, reconstruct=True,
+                     block_length=65536, start_method=None,
+                     make_reconstructions=default_reconstructions, recofile_kwargs=None,
+                     stages=(), **builder_kwargs):
+    '''
+    Build and reconstruct the events of a raw data file with a pool of
+    processes, one shard per row range (see `plan_ranges`), and consolidate the
+    shards into outfile (see `RecoShards.consolidate`)
+    `make_reconstructions` is called in each process and returns the list of
+    reconstructions to run (it must be picklable), builder_kwargs and
+    `recofile_kwargs` are passed to each `EventBuilder` and shard `RecoFile`,
+    `start_method` selects the multiprocessing start method (default: platform
+    default). The run totals of the ranges are added to `stages` (see the
+    `read` methods of the stages).
+    Returns the number of events
+    '''
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    if n_ranges is None:
+        n_ranges = processes
+    ranges = plan_ranges(filename, n_ranges, block_length=block_length)
+    if len(ranges) == 0:
+        logger.info('no hits in {}'.format(filename))
+        RecoFile(outfile, opt='o', format_version=2).close()
+        return 0
+    with multiprocessing.get_context(start_method).Pool(processes) as pool:
+        results = [pool.apply_async(process_range, (filename, outfile, shard_idx,
+                                                    row_range, reconstruct,
+                                                    make_reconstructions,
+                                                    recofile_kwargs),
+                                    builder_kwargs)
+                   for shard_idx, row_range in enumerate(ranges)]
+        results = [result.get() for result in results]
+    evid_counts = [n_evids for shard, n_events, n_evids, metadata in results]
+    consolidate([shard for shard, n_events, n_evids, metadata in results], outfile,
+                evid_counts=evid_counts)
+    evid_offsets = np.cumsum([0] + evid_counts[:-1])
+    for (shard, n_events, n_evids, metadata), evid_offset in zip(results, evid_offsets):
+        for key, value in metadata.items():
+            if key.endswith('_evids'):
+                # stored evids are renumbered as the shard events
+                metadata[key] = np.asarray(value) + evid_offset
+        for stage in stages:
+            stage.read(metadata, accumulate=True)
+    return sum(n_events for shard, n_events, n_evids, metadata in results)
@@ -0,0 +1,154 @@
+'''
+A time-sorted, columnar cache of raw LArPix data files
+
+A raw file is ingested once into a cache file that stores each hit block
+field (see `HitParser.hit_block_desc`) in its own dataset, already in time
+order, along with a coarse time index. The cache records the size and
+modification time of the raw file and is ignored once the raw file changes.
+'''
+import os
+import h5py
+import numpy as np
+from larpixreco.HitParser import HitParser
+from larpixreco.RecoLogging import getLogger
+logger = getLogger(__name__)
+
+cache_version = 1
+
+def default_cache_filename(filename):
+    '''
+    Cache file used for a raw data file if none is specified, the extension is
+    appended so that glob patterns of raw files (e.g. ``run_*.h5``) do not match
+    '''
+    return filename + '.hitcache'
+
+def source_signature(filename):
+    ''' Returns the (size, mtime) used to validate a cache against its source '''
+    stat = os.stat(filename)
+    return stat.st_size, stat.st_mtime
+
+def is_valid_cache(cache_filename, filename):
+    ''' Check that cache file exists and was created from the current version of filename '''
+    if not os.path.isfile(cache_filename):
+        return False
+    try:
+        with h5py.File(cache_filename, 'r') as cachefile:
+            attrs = cachefile.attrs
+            if attrs.get('cache_version') != cache_version:
+                return False
+            size, mtime = source_signature(filename)
+            return attrs['source_size'] == size and attrs['source_mtime'] == mtime
+    except (OSError, KeyError):
+        return False
+
+def ingest(filename, cache_filename=None, sort_mode='external',
+           sort_buffer_length=100, sort_memory=int(256e6), index_step=1024):
+    '''
+    Convert a raw data file into a time-sorted hit cache file and return the
+    cache filename
+    The timestamp of every `index_step`-th hit is stored in the ``ts_index``
+    dataset, which allows seeking to a time without reading the ``ts`` column.
+    '''
+    if cache_filename is None:
+        cache_filename = default_cache_filename(filename)
+    size, mtime = source_signature(filename)
+    parser = HitParser(filename, sort_buffer_length=sort_buffer_length,
+                       sort_mode=sort_mode, sort_memory=sort_memory)
+    tmp_filename = cache_filename + '.tmp'
+    try:
+        with h5py.File(tmp_filename, 'w') as cachefile:
+            chunk_length = min(max(parser.nrows, 1), 65536)
+            for field, field_dtype in HitParser.hit_block_desc:
+                cachefile.create_dataset(field, (parser.nrows,), dtype=field_dtype,
+                                         chunks=(chunk_length,))
+            ts_index = []
+            n_written = 0
+            for block in parser.iter_sorted_blocks():
+                for field, _ in HitParser.hit_block_desc:
+                    cachefile[field][n_written:n_written+len(block)] = block[field]
+                first_indexed = -n_written % index_step
+                ts_index += [block['ts'][first_indexed::index_step]]
+                n_written += len(block)
+            if len(ts_index) > 0:
+                ts_index = np.concatenate(ts_index)
+            cachefile.create_dataset('ts_index', data=np.array(ts_index, dtype='i8'))
+            cachefile.attrs['cache_version'] = cache_version
+            cachefile.attrs['index_step'] = index_step
+            cachefile.attrs['nrows'] = n_written
+            cachefile.attrs['descripiton'] = parser.description
+            cachefile.attrs['sort_mode'] = sort_mode
+            cachefile.attrs['source_filename'] = os.path.abspath(filename)
+            cachefile.attrs['source_size'] = size
+            cachefile.attrs['source_mtime'] = mtime
+        os.replace(tmp_filename, cache_filename)
+    finally:
+        parser.datafile.close()
+        if os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+    logger.info('ingested {} hits from {} into {}'.format(n_written, filename,
+                                                          cache_filename))
+    return cache_filename
+
+class CachedHitParser(HitParser):
+    '''
+    A helper for reading `Hit` types from a hit cache file (see `ingest`)
+
+    Hits are read in time order directly from the cached columns, so no
+    sorting or row decoding is performed. Hit ids are row indices in the
+    source file.
+    '''
+    chunk_length = 65536
+
+    def __init__(self, cache_filename):
+        self.filename = cache_filename
+        self.datafile = h5py.File(self.filename, 'r')
+        self.data = None
+        self.description = self.datafile.attrs['descripiton']
+        self.source_filename = self.datafile.attrs['source_filename']
+        self.index_step = self.datafile.attrs['index_step']
+        self.ts_index = self.datafile['ts_index'][:]
+        self.nrows = int(self.datafile.attrs['nrows'])
+        self.ncols = len(HitParser._col2name_map)
+
+        self.sort_buffer_length = 1
+        self.sort_buffer_idx = 0
+        self.sort_mode = self.datafile.attrs['sort_mode']
+        self.sort_memory = None
+        self.stages = []
+        self._sorted_blocks = None
+        self._curr_hits = []
+        self._curr_hit_idx = 0
+
+    def get_row_data(self, row_idx):
+        ''' Fetch 1D array associated with specified row of the source file '''
+        with h5py.File(self.source_filename, 'r') as datafile:
+            data = datafile['data']
+            if row_idx >= data.shape[0]:
+                return None
+            return data[row_idx]
+
+    def find_ts(self, ts):
+        ''' Returns the position of the first cached hit with a timestamp >= ts '''
+        idx = np.searchsorted(self.ts_index, ts, side='left')
+        start = max(idx - 1, 0) * self.index_step
+        stop = min(idx * self.index_step + 1, self.nrows)
+        return start + int(np.searchsorted(self.datafile['ts'][start:stop], ts,
+                                           side='left'))
+
+    def read_hit_blocks(self, start=0, stop=None):
+        ''' Iterate over time-sorted hit blocks of at most `chunk_length` hits '''
+        if stop is None or stop > self.nrows:
+            stop = self.nrows
+        for block_start in range(start, stop, self.chunk_length):
+            block_end = min(block_start + self.chunk_length, stop)
+            block = np.empty(block_end - block_start, dtype=HitParser.hit_block_desc)
+            for field, _ in HitParser.hit_block_desc:
+                block[field] = self.datafile[field][block_start:block_end]
+            self.sort_buffer_idx = block_end - 1
+            yield block
+
+    def iter_sorted_blocks(self, sort_field='ts'):
+        ''' Iterate over cached hit blocks, which are already sorted by time '''
+        if sort_field != 'ts':
+            raise ValueError('hit cache is sorted by ts')
+        return self.read_hit_blocks()
@@ -1,10 +1,145 @@
+import glob
+import os
+import shutil
+import tempfile
 import h5py
-import operator
 import numpy as np
 from larpixreco.types import Hit
 from larpixreco.RecoLogging import getLogger
 logger = getLogger(__name__)
 
+def expand_filenames(filenames):
+    '''
+    Expand a filename, a glob pattern, or a list of either into a list of
+    filenames. Glob matches are sorted by name.
+    '''
+    if isinstance(filenames, str):
+        filenames = [filenames]
+    expanded = []
+    for filename in filenames:
+        if any(char in filename for char in '*?['):
+            matches = sorted(glob.glob(filename))
+            if len(matches) == 0:
+                raise FileNotFoundError('no files match {}'.format(filename))
+            expanded += matches
+        else:
+            expanded += [filename]
+    return expanded
+
+def sort_buffer_blocks(blocks, buffer_length, sort_field='ts'):
+    '''
+    Sort an iterable of hit blocks using a sliding buffer
+    At least `buffer_length` hits are held back after each block, so a hit
+    that is no more than `buffer_length` rows out of place is emitted in order
+    '''
+    pending = None
+    for block in blocks:
+        if pending is not None:
+            block = np.concatenate((pending, block))
+        block = block[np.argsort(block[sort_field], kind='stable')]
+        n_emit = max(len(block) - buffer_length, 0)
+        pending = block[n_emit:]
+        if n_emit > 0:
+            yield block[:n_emit]
+    if pending is not None and len(pending) > 0:
+        yield pending
+
+def merge_sorted_blocks(block_iters, sort_field='ts'):
+    '''
+    Merge several iterables of sorted hit blocks into one iterable of sorted
+    hit blocks (a k-way merge)
+    At most one block from each iterable is held in memory, and an iterable is
+    only advanced once its current block has been fully merged
+    '''
+    block_iters = [iter(block_iter) for block_iter in block_iters]
+    pending = [None] * len(block_iters)
+    first = np.full(len(block_iters), np.inf)
+    last = np.full(len(block_iters), np.inf)
+    to_load = list(range(len(block_iters)))
+    while True:
+        for idx in to_load:
+            block = next(block_iters[idx], None)
+            while block is not None and len(block) == 0:
+                block = next(block_iters[idx], None)
+            pending[idx] = block
+            if block is None:
+                first[idx], last[idx] = np.inf, np.inf
+            else:
+                first[idx], last[idx] = block[sort_field][0], block[sort_field][-1]
+        if np.all(np.isinf(first)):
+            return
+        # every pending hit up to the smallest last value is safe to emit
+        bound = last.min()
+        to_load = []
+        merged = []
+        for idx in np.nonzero(first <= bound)[0]:
+            n_take = np.searchsorted(pending[idx][sort_field], bound, side='right')
+            merged += [pending[idx][:n_take]]
+            pending[idx] = pending[idx][n_take:]
+            if len(pending[idx]) == 0:
+                to_load += [idx]
+            else:
+                first[idx] = pending[idx][sort_field][0]
+        merged = np.concatenate(merged)
+        yield merged[np.argsort(merged[sort_field], kind='stable')]
+
+def external_sort_blocks(blocks, memory_limit, sort_field='ts', tmpdir=None):
+    '''
+    Sort an iterable of hit blocks using an external merge sort
+    Hits are collected into runs of at most `memory_limit` bytes, each run is
+    sorted and spilled to a temporary file, and the runs are then merged while
+    reading roughly `memory_limit` bytes across all runs at a time.
+    The order is correct regardless of how far hits are out of place.
+    '''
+    run_dir = None
+    run_filenames = []
+    run = []
+    run_length = None
+    n_run = 0
+    try:
+        for block in blocks:
+            if run_length is None:
+                run_length = max(int(memory_limit // block.dtype.itemsize), 1)
+            while len(block) > 0:
+                n_take = min(run_length - n_run, len(block))
+                run += [block[:n_take]]
+                n_run += n_take
+                block = block[n_take:]
+                if n_run == run_length:
+                    if run_dir is None:
+                        run_dir = tempfile.mkdtemp(prefix='larpixreco_sort_',
+                                                   dir=tmpdir)
+                    run = np.concatenate(run)
+                    run_filenames += [os.path.join(run_dir, 'run_{}.npy'.format(
+                                len(run_filenames)))]
+                    np.save(run_filenames[-1],
+                            run[np.argsort(run[sort_field], kind='stable')])
+                    run = []
+                    n_run = 0
+        if len(run_filenames) == 0:
+            # everything fits in memory
+            if n_run > 0:
+                run = np.concatenate(run)
+                yield run[np.argsort(run[sort_field], kind='stable')]
+            return
+        runs = []
+        if n_run > 0:
+            run = np.concatenate(run)
+            runs += [[run[np.argsort(run[sort_field], kind='stable')]]]
+        read_length = max(run_length // (len(run_filenames) + len(runs)), 1)
+        runs += [_read_run(run_filename, read_length) for run_filename in run_filenames]
+        for block in merge_sorted_blocks(runs, sort_field):
+            yield block
+    finally:
+        if run_dir is not None:
+            shutil.rmtree(run_dir, ignore_errors=True)
+
+def _read_run(filename, read_length):
+    ''' Iterate over blocks of `read_length` hits stored in a spilled run '''
+    run = np.load(filename, mmap_mode='r')
+    for start in range(0, len(run), read_length):
+        yield np.array(run[start:start+read_length])
+
 class HitParser(object):
     ''' A helper for parsing data files into `Hit` types '''
     _col2name_map = { # col : name
@@ -22,18 +157,43 @@ class HitParser(object):
         11 : 'pdst_v'
         }
     _name2col_map = dict([(name, col) for col, name in _col2name_map.items()])
+    hit_block_desc = [ # describes hit blocks, fields follow the `Hit` argument order
+        ('hid', 'i8'), ('px', 'f8'), ('py', 'f8'), ('ts', 'i8'), ('q', 'f8'),
+        ('iochain', 'i8'), ('chipid', 'i8'), ('channelid', 'i8'), ('geom', 'i8')]
+    empty_value = -9999 # stands for a missing value (None on a `Hit`) in hit blocks
+    nullable_fields = ('iochain', 'geom')
+    chunk_length = 4096 # rows read from file at a time
+    sort_modes = ('buffer', 'external')
 
-    def __init__(self, filename, sort_buffer_length=1):
+    def __init__(self, filename, sort_buffer_length=1, sort_mode='buffer',
+                 sort_memory=int(256e6), row_range=None):
+        '''
+        `sort_mode` selects how hits are time-ordered:
+         - ``'buffer'`` uses a sliding buffer of `sort_buffer_length` hits
+         - ``'external'`` uses an external merge sort that keeps roughly
+           `sort_memory` bytes of hits in memory and spills the rest to
+           temporary files
+        `row_range` limits the sorted hit stream to the file rows (start, stop)
+        (see `EventPlanner.plan_ranges`)
+        '''
+        if not sort_mode in HitParser.sort_modes:
+            raise ValueError('sort_mode must be one of {}'.format(HitParser.sort_modes))
         self.filename = filename
         self.datafile = h5py.File(self.filename, 'r')
         self.data = self.datafile['data']
         self.description = self.data.attrs['descripiton']
         self.nrows = self.data.shape[0]
         self.ncols = self.data.shape[1]
+        self.row_range = (0, self.nrows) if row_range is None else tuple(row_range)
 
-        self._sort_buffer = None
         self.sort_buffer_length = sort_buffer_length
         self.sort_buffer_idx = 0
+        self.sort_mode = sort_mode
+        self.sort_memory = sort_memory
+        self.stages = []
+        self._sorted_blocks = None
+        self._curr_hits = []
+        self._curr_hit_idx = 0
 
     @staticmethod
     def convert_row_to_hit(row_data, hid):
@@ -43,6 +203,35 @@ class HitParser(object):
                   chipid=row_dict['chipid'], channelid=row_dict['channelid'])
         return hit
 
+    @staticmethod
+    def convert_rows_to_hit_block(rows, hids):
+        ''' Convert a 2D array of rows into a hit block (see `hit_block_desc`) '''
+        col = HitParser._name2col_map
+        block = np.empty(len(rows), dtype=HitParser.hit_block_desc)
+        block['hid'] = hids
+        block['px'] = rows[:, col['pixelx']]
+        block['py'] = rows[:, col['pixely']]
+        block['ts'] = rows[:, col['timestamp']]
+        block['q'] = rows[:, col['v']] - rows[:, col['pdst_v']]
+        block['iochain'] = HitParser.empty_value
+        block['chipid'] = rows[:, col['chipid']]
+        block['channelid'] = rows[:, col['channelid']]
+        block['geom'] = HitParser.empty_value
+        return block
+
+    @staticmethod
+    def convert_hit_block_to_hits(block):
+        '''
+        Create a list of hits from a hit block, `empty_value` entries of the
+        `nullable_fields` become None
+        '''
+        columns = [block[name].tolist() for name in block.dtype.names]
+        for name in HitParser.nullable_fields:
+            idx = block.dtype.names.index(name)
+            columns[idx] = [None if value == HitParser.empty_value else value
+                            for value in columns[idx]]
+        return [Hit(*values) for values in zip(*columns)]
+
     def get_row_data(self, row_idx):
         ''' Fetch 1D array associated with specified row, last column is row_idx '''
         if row_idx >= self.nrows:
@@ -62,37 +251,134 @@ class HitParser(object):
             return None
         return HitParser.convert_row_to_hit(row_data, row_idx)
 
-    def _load_next_sorted(self, sort_field='ts'):
+    def read_hit_blocks(self, start=0, stop=None):
+        ''' Iterate over hit blocks of at most `chunk_length` rows in file order '''
+        if stop is None or stop > self.nrows:
+            stop = self.nrows
+        for block_start in range(start, stop, self.chunk_length):
+            block_end = min(block_start + self.chunk_length, stop)
+            rows = self.data[block_start:block_end]
+            self.sort_buffer_idx = block_end - 1
+            yield HitParser.convert_rows_to_hit_block(rows,
+                np.arange(block_start, block_end))
+
+    def iter_sorted_blocks(self, sort_field='ts'):
+        ''' Iterate over hit blocks sorted according to `sort_mode` '''
+        blocks = self.read_hit_blocks(*self.row_range)
+        if self.sort_mode == 'external':
+            return external_sort_blocks(blocks, self.sort_memory, sort_field)
+        return sort_buffer_blocks(blocks, self.sort_buffer_length, sort_field)
+
+    def iter_hit_blocks(self, sort_field='ts'):
         '''
-        Load next row into sorted hit buffer
-        Removes first entry in buffer list
+        Iterate over sorted hit blocks after applying each of the `stages`
+        A stage is a callable that takes a hit block and returns a (possibly
+        modified or reduced) hit block
         '''
-        buffer_length = min(self.sort_buffer_length, self.nrows)
-        if not self._sort_buffer is None:
-            # sort buffer has been initialized
-            self.sort_buffer_idx += 1
-            new_hit = None
-            if self.sort_buffer_idx < self.nrows:
-                new_hit = HitParser.convert_row_to_hit(\
-                    self.get_row_data(self.sort_buffer_idx), self.sort_buffer_idx)
-            if not new_hit is None:
-                self._sort_buffer[0] = new_hit
-                self._sort_buffer.sort(key=operator.attrgetter(sort_field))
-            else:
-                # EOF reached, start shortening buffer
-                self._sort_buffer = self._sort_buffer[1:]
-        else:
-            # sort buffer has not been initialized
-            self.sort_buffer_idx = buffer_length - 1
-            self._sort_buffer = [HitParser.convert_row_to_hit(\
-                    row_data, row_idx) for row_idx, row_data in \
-                                     enumerate(self.data[:buffer_length])]
-            self._sort_buffer.sort(key=operator.attrgetter(sort_field))
+        for block in self.iter_sorted_blocks(sort_field):
+            for stage in self.stages:
+                block = stage(block)
+            if len(block) > 0:
+                yield block
 
     def get_next_sorted_hit(self, sort_field='ts'):
-        ''' Returns first row in sorted buffer '''
-        self._load_next_sorted(sort_field)
-        if len(self._sort_buffer) == 0:
+        ''' Returns next hit in sorted order, or None at the end of the file '''
+        if self._sorted_blocks is None:
+            self._sorted_blocks = self.iter_hit_blocks(sort_field)
+        while self._curr_hit_idx >= len(self._curr_hits):
+            block = next(self._sorted_blocks, None)
+            if block is None:
+                return None
+            self._curr_hits = HitParser.convert_hit_block_to_hits(block)
+            self._curr_hit_idx = 0
+        hit = self._curr_hits[self._curr_hit_idx]
+        self._curr_hit_idx += 1
+        return hit
+
+class MultiFileHitParser(HitParser):
+    '''
+    A helper for parsing several data files into one time-ordered stream of
+    `Hit` types
+
+    In ``'buffer'`` sort mode each file is sorted with its own sort buffer and
+    the sorted streams are merged, in ``'external'`` sort mode all files are
+    sorted together. Files are only opened while a chunk of rows is read, so many files
+    can be merged without holding their file handles open.
+    Hit ids are row indices into the concatenation of the files.
+    '''
+    chunk_length = 1024
+
+    def __init__(self, filenames, sort_buffer_length=1, sort_mode='buffer',
+                 sort_memory=int(256e6)):
+        if not sort_mode in HitParser.sort_modes:
+            raise ValueError('sort_mode must be one of {}'.format(HitParser.sort_modes))
+        self.filename = filenames
+        self.filenames = expand_filenames(filenames)
+        self.datafile = None
+        self.data = None
+        file_nrows = []
+        for filename in self.filenames:
+            with h5py.File(filename, 'r') as datafile:
+                data = datafile['data']
+                file_nrows += [data.shape[0]]
+                self.description = data.attrs['descripiton']
+                self.ncols = data.shape[1]
+        self.file_row_offsets = np.cumsum([0] + file_nrows)
+        self.nrows = int(self.file_row_offsets[-1])
+
+        self.sort_buffer_length = sort_buffer_length
+        self.sort_buffer_idx = 0
+        self.sort_mode = sort_mode
+        self.sort_memory = sort_memory
+        self._nrows_read = 0
+        self.stages = []
+        self._sorted_blocks = None
+        self._curr_hits = []
+        self._curr_hit_idx = 0
+
+    def get_row_data(self, row_idx):
+        ''' Fetch 1D array associated with specified row of the concatenated files '''
+        if row_idx >= self.nrows:
             return None
-        return self._sort_buffer[0]
+        file_idx = np.searchsorted(self.file_row_offsets, row_idx, side='right') - 1
+        with h5py.File(self.filenames[file_idx], 'r') as datafile:
+            return datafile['data'][row_idx - self.file_row_offsets[file_idx]]
+
+    def read_file_hit_blocks(self, file_idx, start=0, stop=None):
+        '''
+        Iterate over hit blocks of at most `chunk_length` rows from a single
+        file, the file is only open while a block is read
+        '''
+        offset = self.file_row_offsets[file_idx]
+        file_nrows = self.file_row_offsets[file_idx+1] - offset
+        if stop is None or stop > file_nrows:
+            stop = file_nrows
+        for block_start in range(start, stop, self.chunk_length):
+            block_end = min(block_start + self.chunk_length, stop)
+            with h5py.File(self.filenames[file_idx], 'r') as datafile:
+                rows = datafile['data'][block_start:block_end]
+            self._nrows_read += len(rows)
+            self.sort_buffer_idx = self._nrows_read - 1
+            yield HitParser.convert_rows_to_hit_block(rows,
+                np.arange(offset + block_start, offset + block_end))
+
+    def read_hit_blocks(self, start=0, stop=None):
+        ''' Iterate over hit blocks of the concatenated files in file order '''
+        if stop is None or stop > self.nrows:
+            stop = self.nrows
+        for file_idx in range(len(self.filenames)):
+            offset = self.file_row_offsets[file_idx]
+            file_start = max(start - offset, 0)
+            file_stop = min(stop - offset, self.file_row_offsets[file_idx+1] - offset)
+            if file_start < file_stop:
+                for block in self.read_file_hit_blocks(file_idx, file_start, file_stop):
+                    yield block
 
+    def iter_sorted_blocks(self, sort_field='ts'):
+        ''' Iterate over hit blocks of all files merged into sorted order '''
+        if self.sort_mode == 'external':
+            return HitParser.iter_sorted_blocks(self, sort_field)
+        return merge_sorted_blocks([sort_buffer_blocks(
+                    self.read_file_hit_blocks(file_idx), self.sort_buffer_length,
+                    sort_field) for file_idx in range(len(self.filenames))],
+                                   sort_field)
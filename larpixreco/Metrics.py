@@ -0,0 +1,175 @@
+'''
+Lightweight counters and histograms for throughput and hot-path metrics
+
+Metrics are registered once (usually at import) with the default registry
+`metrics` and updated with ``counter.inc(n)`` or ``histogram.observe(value)``,
+which only update a few python numbers. The registry is written to a JSON
+file or a Prometheus textfile (for the node exporter textfile collector)
+with `MetricsRegistry.dump`, or periodically with `MetricsRegistry.maybe_dump`.
+'''
+import bisect
+import json
+import os
+import time
+from larpixreco.RecoLogging import getLogger
+logger = getLogger(__name__)
+
+class Counter(object):
+    ''' A monotonically increasing count '''
+    def __init__(self, name, description=''):
+        self.name = name
+        self.description = description
+        self.value = 0
+
+    def inc(self, n=1):
+        self.value += n
+
+    def reset(self):
+        self.value = 0
+
+class Histogram(object):
+    ''' Counts of observed values in buckets with the upper edges `buckets` '''
+    default_buckets = (1e-4, 1e-3, 1e-2, 0.1, 1., 10.)
+
+    def __init__(self, name, description='', buckets=None):
+        self.name = name
+        self.description = description
+        self.buckets = sorted(buckets or self.default_buckets)
+        self.reset()
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def reset(self):
+        self.counts = [0] * (len(self.buckets) + 1) # last bucket is overflow
+        self.sum = 0.
+        self.count = 0
+
+class Timer(object):
+    ''' Context manager that observes the elapsed wall time in a histogram '''
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start)
+
+class MetricsRegistry(object):
+    '''
+    A collection of named counters and histograms
+
+    Use `configure` to set the output file, format (``'json'`` or
+    ``'prometheus'``), and the minimum interval between `maybe_dump` writes.
+    '''
+    formats = ('json', 'prometheus')
+    prefix = 'larpixreco_' # prefix of prometheus metric names
+
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+        self.filename = None
+        self.format = 'json'
+        self.interval = 10.
+        self.start_time = time.time()
+        self._last_dump = time.monotonic()
+
+    def counter(self, name, description=''):
+        ''' Returns the counter name, creating it if needed '''
+        if not name in self.counters:
+            self.counters[name] = Counter(name, description)
+        return self.counters[name]
+
+    def histogram(self, name, description='', buckets=None):
+        ''' Returns the histogram name, creating it if needed '''
+        if not name in self.histograms:
+            self.histograms[name] = Histogram(name, description, buckets)
+        return self.histograms[name]
+
+    def timer(self, name):
+        ''' Returns a `Timer` observing into histogram name '''
+        return Timer(self.histogram(name))
+
+    def reset(self):
+        ''' Reset all metrics and the start time '''
+        for metric in list(self.counters.values()) + list(self.histograms.values()):
+            metric.reset()
+        self.start_time = time.time()
+
+    def configure(self, filename=None, format='json', interval=10.):
+        if not format in self.formats:
+            raise ValueError('format must be one of {}'.format(self.formats))
+        self.filename = filename
+        self.format = format
+        self.interval = interval
+
+    def snapshot(self):
+        ''' Returns a dict of the current metric values, and rates per second '''
+        elapsed = max(time.time() - self.start_time, 1e-9)
+        return {
+            'timestamp' : time.time(),
+            'elapsed' : elapsed,
+            'counters' : dict((name, counter.value)
+                              for name, counter in self.counters.items()),
+            'rates' : dict((name, counter.value / elapsed)
+                           for name, counter in self.counters.items()),
+            'histograms' : dict((name, {'buckets' : histogram.buckets,
+                                        'counts' : histogram.counts,
+                                        'sum' : histogram.sum,
+                                        'count' : histogram.count})
+                                for name, histogram in self.histograms.items())
+            }
+
+    def prometheus_text(self):
+        ''' Returns the metrics in the Prometheus text exposition format '''
+        snapshot = self.snapshot()
+        lines = ['# TYPE {}elapsed_seconds gauge'.format(self.prefix),
+                 '{}elapsed_seconds {}'.format(self.prefix, snapshot['elapsed'])]
+        for name, counter in sorted(self.counters.items()):
+            name = self.prefix + name
+            lines += ['# HELP {} {}'.format(name, counter.description),
+                      '# TYPE {} counter'.format(name),
+                      '{} {}'.format(name, counter.value),
+                      '# TYPE {}_per_second gauge'.format(name),
+                      '{}_per_second {}'.format(name, snapshot['rates'][counter.name])]
+        for name, histogram in sorted(self.histograms.items()):
+            name = self.prefix + name
+            lines += ['# HELP {} {}'.format(name, histogram.description),
+                      '# TYPE {} histogram'.format(name)]
+            cumulative = 0
+            for edge, count in zip(histogram.buckets + ['+Inf'], histogram.counts):
+                cumulative += count
+                lines += ['{}_bucket{{le="{}"}} {}'.format(name, edge, cumulative)]
+            lines += ['{}_sum {}'.format(name, histogram.sum),
+                      '{}_count {}'.format(name, histogram.count)]
+        return '\n'.join(lines) + '\n'
+
+    def dump(self, filename=None, format=None):
+        '''
+        Write the metrics to filename (default: configured filename), replacing
+        the file atomically so that readers never see a partial file
+        '''
+        filename = filename or self.filename
+        format = format or self.format
+        if filename is None:
+            return
+        tmp_filename = filename + '.tmp'
+        with open(tmp_filename, 'w') as metrics_file:
+            if format == 'prometheus':
+                metrics_file.write(self.prometheus_text())
+            else:
+                json.dump(self.snapshot(), metrics_file, indent=2)
+        os.replace(tmp_filename, filename)
+        self._last_dump = time.monotonic()
+
+    def maybe_dump(self):
+        ''' Dump the metrics if a file is configured and the interval has passed '''
+        if self.filename is not None and \
+                time.monotonic() - self._last_dump >= self.interval:
+            self.dump()
+
+metrics = MetricsRegistry() # default registry
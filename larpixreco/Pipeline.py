@@ -0,0 +1,365 @@
+'''
+Multi-process reconstruction pipeline
+
+`run_pipeline` runs one reader process that builds events, a pool of worker
+processes that run the reconstructions, and writes the results from the
+calling process in event order:
+
+ - the reader packs batches of events into a single hit block (see
+   `HitParser.hit_block_desc`) with event offsets, which is passed through
+   shared memory (or pickled, without `use_shared_memory`). Each process
+   communicates with the calling process through its own pipe, so a dying
+   process can not block the others
+ - the calling process sends each batch to an idle worker, and keeps track of
+   the batch held by each worker and of the shared memory of each batch, which
+   it releases once the batch is done, lost, or the pipeline stops
+ - each worker rebuilds the `Event` objects of a batch and runs the
+   reconstructions on them, on the whole batch for reconstructions that have a
+   `do_batch_reconstruction` method (see `reconstruct_batch`). An exception in a
+   reconstruction only affects that event, which is written without
+   reconstructed objects. The per event records of the reconstructions (see
+   `ReconstructionChain.write_records`) are sent with each batch
+ - if a worker process dies (or holds a batch for longer than `batch_timeout`),
+   a new worker is started and the events of its batch are retried one at a
+   time, so that only an event that kills a worker is lost
+ - batches are numbered by the reader and written to the `RecoFile` in order
+'''
+import collections
+import multiprocessing
+import multiprocessing.connection
+import time
+import traceback
+import numpy as np
+from multiprocessing import shared_memory, resource_tracker
+from larpixreco.types import Event
+from larpixreco.HitParser import HitParser
+from larpixreco.EventBuilder import EventBuilder
+from larpixreco.RecoFile import RecoFile, MetadataRecord
+from larpixreco.RecoLogging import getLogger
+logger = getLogger(__name__)
+
+def default_reconstructions():
+    ''' Returns the reconstructions run on each event by default '''
+    from larpixreco.Reconstruction import TrackReconstruction
+    return [TrackReconstruction()]
+
+def pack_events(events, use_shared_memory=True):
+    '''
+    Pack a list of events into (evids, offsets, payload), where the hits of
+    event i are rows offsets[i]:offsets[i+1] of the hit block in payload
+    '''
+    names = [field for field, dtype in HitParser.hit_block_desc]
+    evids = np.array([event.evid for event in events], dtype='i8')
+    offsets = np.zeros(len(events) + 1, dtype='i8')
+    offsets[1:] = np.cumsum([len(event.hits) for event in events])
+    empty = HitParser.empty_value
+    block = np.array([tuple(empty if value is None else value
+                            for value in (getattr(hit, name) for name in names))
+                      for event in events for hit in event.hits],
+                     dtype=HitParser.hit_block_desc)
+    if not use_shared_memory:
+        return evids, offsets, ('array', block)
+    shm = shared_memory.SharedMemory(create=True, size=max(block.nbytes, 1))
+    np.ndarray(block.shape, dtype=block.dtype, buffer=shm.buf)[:] = block
+    payload = ('shm', shm.name, len(block))
+    shm.close()
+    return evids, offsets, payload
+
+def unpack_events(evids, offsets, payload, unlink=True):
+    '''
+    Rebuild the events packed by `pack_events`, releasing shared memory
+    (unless the caller releases it with `release_payload`)
+    '''
+    if payload[0] == 'shm':
+        shm = shared_memory.SharedMemory(name=payload[1])
+        block = np.ndarray((payload[2],), dtype=HitParser.hit_block_desc,
+                           buffer=shm.buf).copy()
+        shm.close()
+        if unlink:
+            shm.unlink()
+    else:
+        block = payload[1]
+    return [Event(evid, HitParser.convert_hit_block_to_hits(block[start:stop]))
+            for evid, start, stop in zip(evids.tolist(), offsets[:-1].tolist(),
+                                         offsets[1:].tolist())]
+
+def release_payload(payload):
+    ''' Unlink the shared memory of a payload packed by `pack_events` (if any) '''
+    if payload[0] != 'shm':
+        return
+    try:
+        shm = shared_memory.SharedMemory(name=payload[1])
+    except FileNotFoundError:
+        return
+    shm.close()
+    shm.unlink()
+
+def reconstruct_batch(reconstructions, events):
+    '''
+    Run the reconstructions on a list of events, reconstructions with a
+    `do_batch_reconstruction` method are run once for the whole list. If a
+    reconstruction raises, the events are reconstructed again one at a time, so
+    that only the failing events are left without reconstructed objects.
+    Returns the number of failed events
+    '''
+    try:
+        for reconstruction in reconstructions:
+            if hasattr(reconstruction, 'do_batch_reconstruction'):
+                reconstruction.do_batch_reconstruction(events)
+            else:
+                for event in events:
+                    reconstruction.do_reconstruction(event)
+        return 0
+    except Exception:
+        for event in events:
+            event.reco_objs = []
+        if len(events) > 1:
+            logger.warning('reconstruction of events {}-{} failed, retrying one event '
+                           'at a time'.format(events[0].evid, events[-1].evid))
+            return sum(reconstruct_batch(reconstructions, [event]) for event in events)
+        logger.error('reconstruction of event {} failed:\n{}'.format(
+                events[0].evid, traceback.format_exc()))
+        return 1
+
+def _read_events(filename, builder_kwargs, conn, batch_size, use_shared_memory,
+                 pending_batches):
+    '''
+    Reader process, sends ('batch', batch_idx, evids, offsets, payload) for
+    each batch and ('done', n_batches, metadata) at the end to conn
+    '''
+    eb = EventBuilder(filename, **builder_kwargs)
+    n_batches = 0
+    for batch in eb.iter_events(batch_size=batch_size):
+        pending_batches.acquire()
+        conn.send(('batch', n_batches) + pack_events(batch, use_shared_memory))
+        n_batches += 1
+    stages = list(builder_kwargs.get('hit_stages') or []) + \
+        [builder_kwargs.get('event_filter')]
+    conn.send(('done', n_batches, MetadataRecord.from_stages(
+                    [stage for stage in stages if stage is not None])))
+
+def _reconstruct_events(make_reconstructions, conn):
+    '''
+    Worker process, receives tasks (key, evids, offsets, payload) from conn
+    until None, and sends ('result', key, events, n_failed, records) for each
+    task and ('done', metadata) at the end
+    '''
+    reconstructions = make_reconstructions()
+    while True:
+        task = conn.recv()
+        if task is None:
+            break
+        key = task[0]
+        events = unpack_events(*task[1:], unlink=False)
+        n_failed = reconstruct_batch(reconstructions, events)
+        records = MetadataRecord()
+        for reconstruction in reconstructions:
+            if hasattr(reconstruction, 'write_records'):
+                reconstruction.write_records(records)
+        conn.send(('result', key, events, n_failed, records))
+    conn.send(('done', MetadataRecord.from_stages(reconstructions)))
+
+def _receive(conn):
+    ''' Returns the next message from conn, or None if the sender has exited '''
+    try:
+        return conn.recv()
+    except (EOFError, OSError):
+        return None
+
+def run_pipeline(filename, outfile, processes=None, batch_size=16,
+                 make_reconstructions=default_reconstructions, use_shared_memory=True,
+                 builder_kwargs=None, recofile_kwargs=None, start_method=None,
+                 max_pending_batches=None, timeout=1., batch_timeout=None, stages=()):
+    '''
+    Build events from filename, reconstruct them with `processes` worker
+    processes, and write them to the `RecoFile` outfile in order
+    `make_reconstructions` is called once in each worker and returns the list
+    of reconstructions to run, `builder_kwargs` and `recofile_kwargs` are passed
+    to the `EventBuilder` and `RecoFile`. At most `max_pending_batches`
+    (default: 2 per worker) batches are read but not yet written. A worker
+    that holds a batch for longer than `batch_timeout` seconds is stopped.
+    The run totals of the hit stages and event filter of the reader, and of the
+    reconstructions of the workers (except for workers that died), are added
+    to `stages` (see the `read` methods of the stages).
+    Returns a dict of counts (``n_events``, ``n_failed_events``,
+    ``n_lost_events``)
+    '''
+    if processes is None:
+        processes = max(multiprocessing.cpu_count() - 1, 1)
+    if max_pending_batches is None:
+        max_pending_batches = 2 * processes
+    context = multiprocessing.get_context(start_method)
+    if use_shared_memory:
+        # share one tracker between processes, so segments created by the reader
+        # and unlinked here are not reported as leaked
+        resource_tracker.ensure_running()
+    pending_batches = context.Semaphore(max_pending_batches)
+
+    reader_conn, reader_child_conn = context.Pipe(duplex=False)
+    reader = context.Process(target=_read_events, name='pipeline-reader',
+                             args=(filename, builder_kwargs or {}, reader_child_conn,
+                                   batch_size, use_shared_memory, pending_batches))
+    worker_conns = [None] * processes
+    def start_worker(worker_idx):
+        worker_conns[worker_idx], child_conn = context.Pipe()
+        worker = context.Process(target=_reconstruct_events,
+                                 name='pipeline-worker-{}'.format(worker_idx),
+                                 args=(make_reconstructions, child_conn))
+        worker.start()
+        child_conn.close()
+        return worker
+    reader.start()
+    reader_child_conn.close()
+    workers = [start_worker(worker_idx) for worker_idx in range(processes)]
+
+    recofile = RecoFile(outfile, **(recofile_kwargs or {}))
+    counts = dict(n_events=0, n_failed_events=0, n_lost_events=0)
+    payloads = {} # shared memory of each batch that is not done
+    tasks = collections.deque() # (key, evids, offsets, payload), key is (batch_idx, event_idx)
+    assigned = [None] * processes # task held by each worker
+    assigned_time = [None] * processes
+    parts = {} # events of the tasks of a batch that is retried one event at a time
+    results = {}
+    next_batch = 0
+    n_batches = None
+
+    def add_metadata(record):
+        record.write_tables(recofile)
+        for stage in stages:
+            stage.read(record, accumulate=True)
+
+    def complete(key, events):
+        batch_idx, event_idx = key
+        if event_idx is not None:
+            parts[batch_idx][event_idx] = events
+            if any(part is None for part in parts[batch_idx]):
+                return
+            events = sum(parts.pop(batch_idx), [])
+        results[batch_idx] = events
+        release_payload(payloads.pop(batch_idx))
+
+    def handle_message(worker_idx, message):
+        ''' Handle a worker message, returns False if the worker has exited '''
+        if message is None:
+            return False
+        if message[0] == 'done':
+            add_metadata(message[1])
+            return True
+        key, events, n_failed, records = message[1:]
+        records.write_tables(recofile)
+        counts['n_failed_events'] += n_failed
+        assigned[worker_idx] = None
+        complete(key, events)
+        return True
+
+    def lose_task(task):
+        (batch_idx, event_idx), evids, offsets, payload = task
+        if len(evids) > 1:
+            # retry the events one at a time, so that only an event that stops
+            # a worker is lost
+            parts[batch_idx] = [None] * len(evids)
+            tasks.extendleft([((batch_idx, idx), evids[idx:idx+1], offsets[idx:idx+2], payload)
+                              for idx in reversed(range(len(evids)))])
+            return
+        logger.error('event {} lost'.format(evids[0]))
+        counts['n_lost_events'] += len(evids)
+        complete((batch_idx, event_idx), [])
+
+    try:
+        while n_batches is None or next_batch < n_batches:
+            for worker_idx, conn in enumerate(worker_conns):
+                if assigned[worker_idx] is None and conn is not None and len(tasks) > 0:
+                    # record the task before sending it, so that it is retried
+                    # if the worker dies
+                    assigned[worker_idx] = tasks.popleft()
+                    assigned_time[worker_idx] = time.monotonic()
+                    try:
+                        conn.send(assigned[worker_idx])
+                    except OSError:
+                        tasks.appendleft(assigned[worker_idx]) # dead worker, handled below
+                        assigned[worker_idx] = None
+            conns = [conn for conn in [reader_conn] + worker_conns if not conn is None]
+            for conn in multiprocessing.connection.wait(conns, timeout):
+                if conn is reader_conn:
+                    message = _receive(conn)
+                    if message is None:
+                        reader_conn = None
+                    elif message[0] == 'batch':
+                        batch_idx, evids, offsets, payload = message[1:]
+                        payloads[batch_idx] = payload
+                        tasks.append(((batch_idx, None), evids, offsets, payload))
+                    else:
+                        n_batches = message[1]
+                        add_metadata(message[2])
+                    continue
+                worker_idx = worker_conns.index(conn)
+                if not handle_message(worker_idx, _receive(conn)):
+                    # process exited, a dead worker is handled below
+                    worker_conns[worker_idx] = None
+            for worker_idx, worker in enumerate(workers):
+                timed_out = batch_timeout is not None and assigned[worker_idx] is not None \
+                    and time.monotonic() - assigned_time[worker_idx] > batch_timeout
+                if worker.is_alive() and not timed_out:
+                    continue
+                if timed_out:
+                    worker.terminate()
+                    worker.join()
+                # results sent before the worker stopped
+                while worker_conns[worker_idx] is not None and \
+                        worker_conns[worker_idx].poll():
+                    if not handle_message(worker_idx, _receive(worker_conns[worker_idx])):
+                        break
+                task = assigned[worker_idx]
+                logger.error('worker {} {} during batch {}'.format(
+                        worker_idx, 'timed out' if timed_out else
+                        'exited with code {}'.format(worker.exitcode),
+                        None if task is None else task[0][0]))
+                assigned[worker_idx] = None
+                if task is not None:
+                    lose_task(task)
+                if worker_conns[worker_idx] is not None:
+                    worker_conns[worker_idx].close()
+                workers[worker_idx] = start_worker(worker_idx)
+            if n_batches is None and reader_conn is None and not reader.is_alive():
+                raise RuntimeError('pipeline reader exited with code {}'.format(
+                        reader.exitcode))
+            while next_batch in results:
+                for event in results.pop(next_batch):
+                    recofile.queue(event)
+                    counts['n_events'] += 1
+                next_batch += 1
+                pending_batches.release()
+    finally:
+        done = n_batches is not None and next_batch >= n_batches
+        for worker_idx, worker in enumerate(workers):
+            conn = worker_conns[worker_idx]
+            if done and conn is not None:
+                # collect the metadata of the worker
+                try:
+                    conn.send(None)
+                    while conn.poll(10 * timeout):
+                        message = _receive(conn)
+                        if message is None or message[0] == 'done':
+                            handle_message(worker_idx, message)
+                            break
+                except OSError:
+                    pass
+        for process in [reader] + workers:
+            if done:
+                process.join(10 * timeout)
+            if process.is_alive():
+                process.terminate()
+                process.join()
+        # batches that were read but not done
+        while reader_conn is not None and reader_conn.poll():
+            message = _receive(reader_conn)
+            if message is None:
+                break
+            if message[0] == 'batch':
+                payloads[message[1]] = message[-1]
+        for payload in payloads.values():
+            release_payload(payload)
+        recofile.close()
+    logger.info('pipeline wrote {n_events} events ({n_failed_events} failed events, '
+                '{n_lost_events} lost events)'.format(**counts))
+    return counts
@@ -0,0 +1,167 @@
+'''
+A content-addressed on-disk cache of per-event reconstruction results
+
+Results are stored as small ``.npz`` files in a cache directory, named by a
+hash of the reconstruction inputs (see `RecoCache.key`), which include the
+hit arrays, the algorithm parameters, and a hash of the algorithm source
+(`hough_version`), so a changed input or algorithm never returns a stale
+result. Entries are written atomically, so several processes can share a
+cache directory.
+
+The cache is bounded to `max_bytes`: each hit updates the modification time
+of its entry, and the least recently used entries are removed when the cache
+grows beyond the limit.
+'''
+import hashlib
+import inspect
+import os
+import tempfile
+import zipfile
+import numpy as np
+import larpixreco.algorithms.hough as hough
+from larpixreco.Metrics import metrics
+from larpixreco.RecoLogging import getLogger
+logger = getLogger(__name__)
+
+cache_version = 1
+hough_version = hashlib.sha1(inspect.getsource(hough).encode()).hexdigest()
+
+_cache_hits = metrics.counter('reco_cache_hits_total', 'reconstruction cache hits')
+_cache_misses = metrics.counter('reco_cache_misses_total', 'reconstruction cache misses')
+
+class RecoCache(object):
+    '''
+    An LRU cache directory of arrays keyed by `key`
+    When the cache exceeds `max_bytes`, entries are removed (oldest use first)
+    until it is below `low_water` times `max_bytes`
+    '''
+    extension = '.npz'
+
+    def __init__(self, directory, max_bytes=int(1e9), low_water=0.9):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.low_water = low_water
+        os.makedirs(directory, exist_ok=True)
+        self.n_hits = 0
+        self.n_misses = 0
+        self.nbytes = sum(size for mtime, size, filename in self.entries())
+
+    @staticmethod
+    def key(*inputs):
+        '''
+        Returns the hex digest of the inputs (arrays or values with a
+        deterministic repr) and the cache and algorithm versions
+        '''
+        sha = hashlib.sha1('{} {}'.format(cache_version, hough_version).encode())
+        for value in inputs:
+            if isinstance(value, np.ndarray):
+                sha.update('{} {}'.format(value.dtype.str, value.shape).encode())
+                sha.update(np.ascontiguousarray(value).tobytes())
+            else:
+                sha.update(repr(value).encode())
+        return sha.hexdigest()
+
+    def filename(self, key):
+        return os.path.join(self.directory, key[:2], key + self.extension)
+
+    def entries(self):
+        ''' Returns a list of (mtime, size, filename) of the cache entries '''
+        entries = []
+        for dirpath, dirnames, filenames in os.walk(self.directory):
+            for filename in filenames:
+                if not filename.endswith(self.extension):
+                    continue
+                filename = os.path.join(dirpath, filename)
+                try:
+                    stat = os.stat(filename)
+                except FileNotFoundError: # removed by another process
+                    continue
+                entries += [(stat.st_mtime, stat.st_size, filename)]
+        return entries
+
+    def get(self, key):
+        ''' Returns the dict of arrays stored for key, or None '''
+        filename = self.filename(key)
+        try:
+            with np.load(filename) as entry:
+                arrays = dict(entry)
+            os.utime(filename)
+        except (OSError, ValueError, zipfile.BadZipFile):
+            self.n_misses += 1
+            _cache_misses.inc()
+            return None
+        self.n_hits += 1
+        _cache_hits.inc()
+        return arrays
+
+    def put(self, key, **arrays):
+        ''' Store arrays for key, and evict old entries if needed '''
+        filename = self.filename(key)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        fd, tmp_filename = tempfile.mkstemp(dir=os.path.dirname(filename), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as entry:
+                np.savez(entry, **arrays)
+            os.replace(tmp_filename, filename)
+        except BaseException:
+            os.remove(tmp_filename)
+            raise
+        self.nbytes += os.path.getsize(filename)
+        if self.nbytes > self.max_bytes:
+            self.evict()
+
+    def evict(self):
+        ''' Remove least recently used entries until below the low water mark '''
+        entries = sorted(self.entries())
+        self.nbytes = sum(size for mtime, size, filename in entries)
+        n_removed = 0
+        for mtime, size, filename in entries:
+            if self.nbytes <= self.low_water * self.max_bytes:
+                break
+            try:
+                os.remove(filename)
+            except FileNotFoundError:
+                pass
+            self.nbytes -= size
+            n_removed += 1
+        logger.debug('evicted {} cache entries'.format(n_removed))
+
+    def clear(self):
+        ''' Remove all entries '''
+        for mtime, size, filename in self.entries():
+            os.remove(filename)
+        self.nbytes = 0
+
+def lines_to_arrays(lines):
+    '''
+    Convert the lines found by `hough.run_iterative_hough` (a dict of `Line`
+    -> hit indices) into a dict of arrays
+    '''
+    lines = list(lines.items())
+    idcs = [np.asarray(hit_idcs, dtype='i8') for line, hit_idcs in lines]
+    nan_cov = np.full((4, 4), np.nan) # fit errors not available
+    return {
+        'coords' : np.array([line.coords() for line, hit_idcs in lines],
+                            dtype='f8').reshape(-1, 4),
+        'cov' : np.array([nan_cov if line.cov is None else line.cov
+                          for line, hit_idcs in lines], dtype='f8').reshape(-1, 4, 4),
+        'start' : np.array([line.start for line, hit_idcs in lines],
+                           dtype='f8').reshape(-1, 3),
+        'end' : np.array([line.end for line, hit_idcs in lines],
+                         dtype='f8').reshape(-1, 3),
+        'offsets' : np.cumsum([0] + [len(hit_idcs) for hit_idcs in idcs]),
+        'hit_idcs' : np.concatenate(idcs) if idcs else np.zeros(0, dtype='i8')
+        }
+
+def arrays_to_lines(arrays):
+    ''' Inverse of `lines_to_arrays` '''
+    lines = {}
+    offsets = arrays['offsets']
+    for line_idx, coords in enumerate(arrays['coords']):
+        line = hough.Line(*coords.tolist())
+        cov = arrays['cov'][line_idx]
+        line.cov = None if np.all(np.isnan(cov)) else cov
+        line.start = arrays['start'][line_idx]
+        line.end = arrays['end'][line_idx]
+        lines[line] = arrays['hit_idcs'][offsets[line_idx]:offsets[line_idx+1]]
+    return lines
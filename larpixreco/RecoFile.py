@@ -1,13 +1,84 @@
 import h5py
+import json
 import numpy as np
 import larpixreco.types as recotypes
 import os.path as path
 import os
+import threading
+import queue
+import time
+from larpixreco.Metrics import metrics
 from larpixreco.RecoLogging import getLogger
 logger = getLogger(__name__)
 
+_write_time = metrics.histogram('write_seconds', 'time to write a batch of rows')
+_rows_written = metrics.counter('rows_written_total', 'rows written to reco files')
+
 region_ref = h5py.special_dtype(ref=h5py.RegionReference)
 
+def read_ranges(dataset, starts, stops):
+    '''
+    Read rows [starts[i], stops[i]) of a dataset for each i
+    Nearby ranges are read with a single slice and split using vectorized
+    indexing. Returns (data, offsets), such that the rows of range i are
+    data[offsets[i]:offsets[i+1]]
+    '''
+    starts = np.asarray(starts, dtype='i8').reshape(-1)
+    stops = np.asarray(stops, dtype='i8').reshape(-1)
+    lengths = np.maximum(stops - starts, 0)
+    offsets = np.zeros(len(starts)+1, dtype='i8')
+    offsets[1:] = np.cumsum(lengths)
+    if offsets[-1] == 0:
+        return dataset[0:0], offsets
+    nonempty = lengths > 0
+    first = starts[nonempty].min()
+    last = stops[nonempty].max()
+    if last - first > 2 * offsets[-1] + 1024:
+        # ranges are sparse, read each range separately
+        data = np.concatenate([dataset[start:stop] for start, stop in
+                               zip(starts[nonempty], stops[nonempty])])
+        return data, offsets
+    block = dataset[first:last]
+    idcs = np.repeat(starts - first - offsets[:-1], lengths) + np.arange(offsets[-1])
+    return block[idcs], offsets
+
+class MetadataRecord(dict):
+    '''
+    Collects the info group metadata written with `RecoFile.write_attr` in a
+    dict, e.g. to return the run totals of stages from worker processes
+    (see the `read` methods of the stages). Rows written with `write_table` are
+    collected in `tables` (see `write_tables`)
+    '''
+    def __init__(self, *args, **kwargs):
+        dict.__init__(self, *args, **kwargs)
+        self.tables = {}
+    @classmethod
+    def from_stages(cls, stages):
+        ''' Returns the metadata written by the stages that have a `write` method '''
+        record = cls()
+        for stage in stages:
+            if hasattr(stage, 'write'):
+                stage.write(record)
+        return record
+
+    def write_attr(self, dataset=None, **kwargs):
+        if not dataset is None:
+            raise ValueError('only info group metadata can be recorded')
+        self.update(kwargs)
+
+    def read_attr(self, key, dataset=None, default=None):
+        return self.get(key, default)
+
+    def write_table(self, name, data):
+        if name in self.tables:
+            data = np.concatenate((self.tables[name], data))
+        self.tables[name] = data
+
+    def write_tables(self, recofile):
+        ''' Append the collected table rows to recofile '''
+        for name, data in self.tables.items():
+            recofile.write_table(name, data)
+
 class RecoFile(object):
     ''' Class to handle io from reconstruction hdf5 file '''
     larpixreco_type_dataset = { # maps between a larpixreco type (see types.py) and a dataset in file
@@ -34,18 +105,134 @@ class RecoFile(object):
             ('sigma_y', 'f8'), ('length', 'f8'), ('start', '(3,)f8'),
             ('end', '(3,)f8')],
         }
+    index_dataset_desc = { # format version 2, relations are stored as row indices
+        'info' : None,
+        'hits' : [
+            ('hid', 'i8'),
+            ('px', 'i8'), ('py', 'i8'), ('ts', 'i8'), ('q', 'i8'),
+            ('iochain', 'i8'), ('chipid', 'i8'), ('channelid', 'i8'),
+            ('geom', 'i8'), ('event_idx', 'i8'), ('track_idx', 'i8')],
+        'events' : [
+            ('evid', 'i8'), ('track_start', 'i8'), ('track_stop', 'i8'),
+            ('hit_start', 'i8'), ('hit_stop', 'i8'),
+            ('nhit', 'i8'), ('q', 'i8'), ('ts_start', 'i8'), ('ts_end', 'i8')],
+        'tracks' : [
+            ('track_id','i8'), ('event_idx', 'i8'), ('hit_start', 'i8'),
+            ('hit_stop', 'i8'), ('theta', 'f8'),
+            ('phi', 'f8'), ('xp', 'f8'), ('yp', 'f8'), ('nhit', 'i8'),
+            ('q', 'i8'), ('ts_start', 'i8'), ('ts_end', 'i8'),
+            ('sigma_theta', 'f8'), ('sigma_phi', 'f8'), ('sigma_x', 'f8'),
+            ('sigma_y', 'f8'), ('length', 'f8'), ('start', '(3,)f8'),
+            ('end', '(3,)f8')],
+        }
+    assoc_dataset_desc = { # format version 3, hits are stored once per event and
+                           # linked to tracks by (track_idx, hit_idx) pairs
+        'info' : None,
+        'hits' : [
+            ('hid', 'i8'),
+            ('px', 'i8'), ('py', 'i8'), ('ts', 'i8'), ('q', 'i8'),
+            ('iochain', 'i8'), ('chipid', 'i8'), ('channelid', 'i8'),
+            ('geom', 'i8'), ('event_idx', 'i8')],
+        'events' : index_dataset_desc['events'],
+        'tracks' : [
+            ('track_id','i8'), ('event_idx', 'i8'), ('assoc_start', 'i8'),
+            ('assoc_stop', 'i8'), ('theta', 'f8'),
+            ('phi', 'f8'), ('xp', 'f8'), ('yp', 'f8'), ('nhit', 'i8'),
+            ('q', 'i8'), ('ts_start', 'i8'), ('ts_end', 'i8'),
+            ('sigma_theta', 'f8'), ('sigma_phi', 'f8'), ('sigma_x', 'f8'),
+            ('sigma_y', 'f8'), ('length', 'f8'), ('start', '(3,)f8'),
+            ('end', '(3,)f8')],
+        'track_hits' : [('track_idx', 'i8'), ('hit_idx', 'i8')],
+        }
+    format_versions = { # maps between file format version and dataset description
+        1 : dataset_desc,
+        2 : index_dataset_desc,
+        3 : assoc_dataset_desc
+        }
+
+    storage_profiles = { # dataset creation options, chunk_bytes is the target chunk size
+        'default' : {'chunk_bytes' : None, 'compression' : None, 'shuffle' : False},
+        'fast-write' : {'chunk_bytes' : 1<<20, 'compression' : None, 'shuffle' : False},
+        'compact' : {'chunk_bytes' : 1<<18, 'compression' : 'gzip',
+                     'compression_opts' : 6, 'shuffle' : True},
+        'analysis-read' : {'chunk_bytes' : 1<<22, 'compression' : 'lzf',
+                           'shuffle' : True},
+        }
+    rows_per_event = { # expected number of rows per event, used to limit chunk size
+        'events' : 1,
+        'tracks' : 2,
+        'hits' : 100,
+        'track_hits' : 100
+        }
+    growth_factor = 1.5 # datasets are over-allocated by this factor when extended
+
+    def __init__(self, filename, write_queue_length=10, opt='o', format_version=None,
+                 storage_profile='default', expected_nevents=None, async_write=False,
+                 max_pending_batches=2):
+        '''
+        `format_version` selects how relations between events, tracks, and hits
+        are stored:
+         - 1: h5py region references (``event_ref``, ``track_ref``, ``hit_ref``)
+         - 2: row indices of parents (``event_idx``, ``track_idx``) and row
+           ranges of daughters (``hit_start``/``hit_stop``,
+           ``track_start``/``track_stop``), which are faster to write and read
+         - 3: as version 2, but the hits of an event are stored once and track
+           membership is stored in the ``track_hits`` dataset of
+           (``track_idx``, ``hit_idx``) pairs. Tracks store the row range of
+           their pairs (``assoc_start``/``assoc_stop``). Hits shared by several
+           tracks are not duplicated
+        Defaults to the version of an existing file, or 1 for a new file.
+
+        `storage_profile` selects the chunking and compression of new datasets
+        (see `storage_profiles`). Chunks hold roughly ``chunk_bytes`` of rows, but
+        no more than the rows expected for `expected_nevents` events.
 
-    def __init__(self, filename, write_queue_length=10, opt='o'):
+        With `async_write`, full write queues are handed to a writer thread, which
+        assembles and writes them while the caller continues. At most
+        `max_pending_batches` batches wait for the writer, after which `queue`
+        blocks. An exception raised by the writer is re-raised by the next call to
+        `queue`, `flush`, or `close`.
+        '''
         self.filename = filename
 
         self.queued_bytes = 0
         self._write_queue = []
         self.write_queue_length = write_queue_length
         self.datafile = None
+        self._nrows = {} # number of rows in use per dataset (datasets are over-allocated)
+        self.format_version = None
+
+        if not storage_profile in self.storage_profiles:
+            raise ValueError('unknown storage profile {}'.format(storage_profile))
+        self.storage_profile = storage_profile
+        self.expected_nevents = expected_nevents
 
-        self.init_file(opt=opt)
+        self.async_write = async_write
+        self.max_pending_batches = max_pending_batches
+        self._writer = None
+        self._writer_queue = None
+        self._writer_error = None
 
-    def init_file(self, opt):
+        self.init_file(opt=opt, format_version=format_version)
+
+    def dataset_options(self, dataset_name):
+        ''' Returns the h5py dataset creation options for the storage profile '''
+        profile = dict(self.storage_profiles[self.storage_profile])
+        chunk_bytes = profile.pop('chunk_bytes')
+        if chunk_bytes is None:
+            chunk_rows = None
+        else:
+            row_bytes = np.dtype(self.dataset_desc[dataset_name]).itemsize
+            chunk_rows = max(chunk_bytes // row_bytes, 1)
+            if not self.expected_nevents is None:
+                chunk_rows = min(chunk_rows, max(self.expected_nevents *
+                                                 self.rows_per_event[dataset_name], 1))
+        options = dict((key, value) for key, value in profile.items() if value)
+        if not chunk_rows is None:
+            options['chunks'] = (chunk_rows,)
+        return options
+
+    def init_file(self, opt, format_version=None):
         # ready file for reading/writing
         if 'o' in opt:
             try:
@@ -57,19 +244,41 @@ class RecoFile(object):
             else:
                 opt = opt.replace('o','a')
         self.datafile = h5py.File(self.filename, opt)
+        if 'format_version' in self.datafile.attrs:
+            file_version = int(self.datafile.attrs['format_version'])
+            if not format_version is None and format_version != file_version:
+                raise ValueError('file format version is {}'.format(file_version))
+            format_version = file_version
+        elif format_version is None:
+            format_version = 1
+        if not format_version in self.format_versions:
+            raise ValueError('unknown format version {}'.format(format_version))
+        self.format_version = format_version
+        self.dataset_desc = self.format_versions[format_version]
+        if self.datafile.mode != 'r':
+            self.datafile.attrs['format_version'] = format_version
+            if not 'storage_profile' in self.datafile.attrs:
+                self.datafile.attrs['storage_profile'] = self.storage_profile
         for dataset_name, dataset_dtype in self.dataset_desc.items():
             if not dataset_name in self.datafile:
                 if not dataset_dtype is None:
                     self.datafile.create_dataset(dataset_name, (0,),
                                                  maxshape=(None,),
-                                                 dtype=dataset_dtype)
+                                                 dtype=dataset_dtype,
+                                                 **self.dataset_options(dataset_name))
                 else:
                     self.datafile.create_group(dataset_name)
+            if not dataset_dtype is None:
+                dataset = self.datafile[dataset_name]
+                self._nrows[dataset_name] = int(dataset.attrs.get('nrows',
+                                                                  dataset.shape[0]))
 
     @classmethod
-    def fill_empty_dict(cls, data_dict, dataset_name):
+    def fill_empty_dict(cls, data_dict, dataset_name, dataset_desc=None):
         ''' Fill with empty values (if necessary) '''
-        for entry_desc in cls.dataset_desc[dataset_name]:
+        if dataset_desc is None:
+            dataset_desc = cls.dataset_desc
+        for entry_desc in dataset_desc[dataset_name]:
             key = entry_desc[0]
             if not key in data_dict:
                 if entry_desc[1] == region_ref:
@@ -81,30 +290,40 @@ class RecoFile(object):
                     data_dict[key] = -9999
 
     @classmethod
-    def larpixreco_type_to_hdf5(cls, larpixreco_type_obj, **kwargs):
+    def larpixreco_type_to_tuple(cls, larpixreco_type_obj, dataset_desc=None, **kwargs):
         '''
-        Automatically generate numpy array used by hdf5
+        Generate a tuple of the values stored in file for an object (in the order
+        of the dataset description)
         Additional attributes can be set (or overridden by kwargs)
         '''
+        if dataset_desc is None:
+            dataset_desc = cls.dataset_desc
         if not type(larpixreco_type_obj) in cls.larpixreco_type_dataset.keys():
             raise TypeError('object type is not in list of known types')
-        data_dict = vars(larpixreco_type_obj)
+        data_dict = dict(vars(larpixreco_type_obj))
         dataset_name = cls.larpixreco_type_dataset[type(larpixreco_type_obj)]
         for value_name, value in kwargs.items():
             data_dict[value_name] = value
-        cls.fill_empty_dict(data_dict, dataset_name)
-        data_tuple = tuple(data_dict[entry_desc[0]] for entry_desc in \
-                               cls.dataset_desc[dataset_name])
+        cls.fill_empty_dict(data_dict, dataset_name, dataset_desc)
+        return tuple(data_dict[entry_desc[0]] for entry_desc in \
+                         dataset_desc[dataset_name])
+
+    @classmethod
+    def larpixreco_type_to_hdf5(cls, larpixreco_type_obj, **kwargs):
+        '''
+        Automatically generate numpy array used by hdf5
+        Additional attributes can be set (or overridden by kwargs)
+        '''
+        data_tuple = cls.larpixreco_type_to_tuple(larpixreco_type_obj, **kwargs)
+        dataset_name = cls.larpixreco_type_dataset[type(larpixreco_type_obj)]
         return np.array(data_tuple, dtype=cls.dataset_desc[dataset_name])
 
     def hit_data(self, hits, **kwargs):
         '''
         Generate hit data to be stored in file
         '''
-        data_list = []
-        for hit in hits:
-            data_list += [self.larpixreco_type_to_hdf5(hit, **kwargs)]
-        return np.array(data_list)
+        return [self.larpixreco_type_to_tuple(hit, self.dataset_desc, **kwargs)
+                for hit in hits]
 
     def track_data(self, track, **kwargs):
         '''
@@ -120,63 +339,199 @@ class RecoFile(object):
             'sigma_x': s_x,
             'sigma_y': s_y,
         }
-        return self.larpixreco_type_to_hdf5(track, **kwargs,
+        return self.larpixreco_type_to_tuple(track, self.dataset_desc, **kwargs,
                 **new_kwargs)
 
     def event_data(self, event, **kwargs):
         '''
         Generate event data to be stored in file
         '''
-        return self.larpixreco_type_to_hdf5(event, **kwargs)
+        return self.larpixreco_type_to_tuple(event, self.dataset_desc, **kwargs)
 
-    def _resize_by(self, n, dataset_name):
-        ''' Extend dataset by n columns '''
+    def _reserve(self, n, dataset_name):
+        '''
+        Make room for n more rows in dataset
+        Datasets are extended geometrically, the unused rows are removed on close
+        '''
         dataset = self.datafile[dataset_name]
-        curr_len = dataset.shape[0]
-        dataset.resize(curr_len + n, axis=0)
+        n_needed = self._nrows[dataset_name] + n
+        if n_needed > dataset.shape[0]:
+            dataset.resize(max(n_needed, int(dataset.shape[0] * self.growth_factor)),
+                           axis=0)
 
     def _fill(self, data, dataset_name):
-        ''' Fill last chunk of file with new data '''
-        if data is None:
+        ''' Write new rows after the last used row of a dataset '''
+        if data is None or len(data) == 0:
             return
         dataset = self.datafile[dataset_name]
-        try:
-            dataset[-len(data):] = data
-        except TypeError:
-            dataset[-1:] = data
+        start = self._nrows[dataset_name]
+        dataset[start:start+len(data)] = data
+        self._nrows[dataset_name] += len(data)
+        dataset.attrs['nrows'] = self._nrows[dataset_name]
+
+    def _trim(self):
+        ''' Remove unused rows from datasets '''
+        for dataset_name, nrows in self._nrows.items():
+            if self.datafile[dataset_name].shape[0] != nrows:
+                self.datafile[dataset_name].resize(nrows, axis=0)
+
+    def _attrs(self, dataset):
+        ''' Returns the attrs of a dataset name or class (None for the info group) '''
+        if isinstance(dataset, type):
+            return self.datafile[self.larpixreco_type_dataset[dataset]].attrs
+        elif isinstance(dataset, str):
+            return self.datafile[dataset].attrs
+        elif dataset is None:
+            return self.datafile['info'].attrs
+        return None
 
     def write_attr(self, dataset=None, **kwargs):
         '''
         Write attr to dataset, attr names and values are passed via kwargs
         Can take either a string or class as argument for writing
         '''
-        attrs = None
-        if isinstance(dataset, type):
-            attrs = self.datafile[larpixreco_type_dataset[dataset]].attrs
-        elif isinstance(dataset, str):
-            attrs = self.datafile[dataset].attrs
-        elif dataset is None:
-            attrs = self.datafile['info']
+        attrs = self._attrs(dataset)
         if attrs is None: return
         for key, value in kwargs.items():
             attrs[key] = value
 
+    def read_attr(self, key, dataset=None, default=None):
+        ''' Read an attr written with `write_attr`, or default if it is not set '''
+        attrs = self._attrs(dataset)
+        if attrs is None or not key in attrs:
+            return default
+        return attrs[key]
+
+    def write_table(self, name, data):
+        '''
+        Append the rows of a structured array to a dataset of the info group,
+        which is created with the dtype of the first rows
+        '''
+        info = self.datafile['info']
+        if not name in info:
+            info.create_dataset(name, data=data, maxshape=(None,), chunks=True)
+            return
+        dataset = info[name]
+        start = dataset.shape[0]
+        dataset.resize(start + len(data), axis=0)
+        dataset[start:] = data
+
+    def checkpoint(self, **state):
+        '''
+        Write all queued objects and store a checkpoint in the info group: the
+        number of rows of each dataset and the state passed via kwargs (see
+        `Checkpoint.save_checkpoint`). The file is flushed to disk
+        '''
+        self.flush()
+        checkpoint = dict(state, nrows=dict(self._nrows))
+        self.datafile['info'].attrs['checkpoint'] = json.dumps(checkpoint)
+        self.datafile.flush()
+
+    def read_checkpoint(self):
+        ''' Returns the last checkpoint stored with `checkpoint`, or None '''
+        if not 'checkpoint' in self.datafile['info'].attrs:
+            return None
+        return json.loads(self.datafile['info'].attrs['checkpoint'])
+
+    def resume(self):
+        '''
+        Remove the rows written after the last checkpoint and return the
+        checkpoint. Raises a ValueError if the file has no checkpoint
+        '''
+        checkpoint = self.read_checkpoint()
+        if checkpoint is None:
+            raise ValueError('{} has no checkpoint'.format(self.filename))
+        for dataset_name, nrows in checkpoint['nrows'].items():
+            if self._nrows[dataset_name] != nrows:
+                logger.info('removing {} rows of {} written after the checkpoint'.format(
+                        self._nrows[dataset_name] - nrows, dataset_name))
+            self._nrows[dataset_name] = nrows
+            self.datafile[dataset_name].resize(nrows, axis=0)
+            self.datafile[dataset_name].attrs['nrows'] = nrows
+        return checkpoint
+
     def queue(self, obj, **kwargs):
         '''
         Add a data object to write queue
         Writes to file if queue is full after new object
         '''
+        self._raise_writer_error()
         self._write_queue += [(obj, kwargs)]
         if len(self._write_queue) >= self.write_queue_length:
-            self.flush()
+            if self.async_write:
+                self._submit(self._write_queue)
+                self.clear_queue()
+            else:
+                self.flush()
 
     def flush(self):
         '''
         Write remaining object in write queue to file and clear queue
+        All queued objects are assembled into one block of rows per dataset,
+        which is then written with a single resize and write per dataset
+        In asynchronous mode, waits until the writer thread has written all
+        batches
+        '''
+        if self.async_write:
+            if self._write_queue:
+                self._submit(self._write_queue)
+                self.clear_queue()
+            if not self._writer_queue is None:
+                self._writer_queue.join()
+            self._raise_writer_error()
+        elif self._write_queue:
+            self._write_batch(self._write_queue)
+            self.clear_queue()
+
+    def _write_batch(self, batch):
+        ''' Assemble and write a list of (obj, kwargs) '''
+        rows = dict((dataset_name, []) for dataset_name in self._nrows)
+        for obj, kwargs in batch:
+            self._assemble(obj, rows, **kwargs)
+        self._write_rows(rows)
+
+    def _submit(self, batch):
+        ''' Pass a batch to the writer thread, starting it if needed '''
+        if self._writer is None:
+            self._writer_queue = queue.Queue(maxsize=self.max_pending_batches)
+            self._writer = threading.Thread(target=self._run_writer,
+                                            name='RecoFile-writer', daemon=True)
+            self._writer.start()
+        self._writer_queue.put(batch)
+
+    def _run_writer(self):
         '''
-        for obj, kwargs in self._write_queue:
-            self.write(obj, **kwargs)
-        self.clear_queue()
+        Writer thread loop, writes batches until None is received
+        After an exception, remaining batches are discarded so that the caller
+        does not block
+        '''
+        while True:
+            batch = self._writer_queue.get()
+            try:
+                if batch is None:
+                    return
+                if self._writer_error is None:
+                    self._write_batch(batch)
+            except Exception as err:
+                logger.error('writer thread failed: {}'.format(err))
+                self._writer_error = err
+            finally:
+                self._writer_queue.task_done()
+
+    def _stop_writer(self):
+        ''' Drain and stop the writer thread '''
+        if self._writer is None:
+            return
+        self._writer_queue.put(None)
+        self._writer.join()
+        self._writer = None
+        self._writer_queue = None
+
+    def _raise_writer_error(self):
+        if not self._writer_error is None:
+            err = self._writer_error
+            self._writer_error = None
+            raise err
 
     def clear_queue(self):
         '''
@@ -184,6 +539,61 @@ class RecoFile(object):
         '''
         self._write_queue = []
 
+    def close(self):
+        '''
+        Flush write queue, remove unused rows, and close file
+        '''
+        if self.datafile is None:
+            return
+        try:
+            self.flush()
+        finally:
+            # release the file even if a (writer) error is raised
+            try:
+                self._stop_writer()
+                self._trim()
+            finally:
+                self.datafile.close()
+                self.datafile = None
+
+    def _write_rows(self, rows):
+        '''
+        Convert assembled rows into arrays and write them to file
+        Region references in rows are given as (dataset_name, idx) or
+        (dataset_name, start_idx, end_idx) tuples and are created here, after
+        the datasets have been extended
+        '''
+        start_time = time.perf_counter()
+        for dataset_name, dataset_rows in rows.items():
+            self._reserve(len(dataset_rows), dataset_name)
+            _rows_written.inc(len(dataset_rows))
+        refs = {}
+        for dataset_name, dataset_rows in rows.items():
+            if len(dataset_rows) == 0:
+                continue
+            ref_cols = [col for col, entry_desc in
+                        enumerate(self.dataset_desc[dataset_name])
+                        if entry_desc[1] == region_ref]
+            for row_idx, row in enumerate(dataset_rows):
+                row = list(row)
+                for col in ref_cols:
+                    ref_desc = row[col]
+                    if ref_desc is None:
+                        continue
+                    if not ref_desc in refs:
+                        refs[ref_desc] = self._region_ref(*ref_desc)
+                    row[col] = refs[ref_desc]
+                dataset_rows[row_idx] = tuple(row)
+            self._fill(np.array(dataset_rows, dtype=self.dataset_desc[dataset_name]),
+                       dataset_name)
+        _write_time.observe(time.perf_counter() - start_time)
+
+    def _region_ref(self, dataset_name, start, end=None):
+        ''' Create a region reference to a row (or slice of rows) of a dataset '''
+        if end is None:
+            return self.datafile[dataset_name].regionref[start]
+        return self.datafile[dataset_name].regionref[start:end]
+
     def write(self, obj, **kwargs):
         '''
         Assemble larpixreco data type into correct file formatting and append to file
@@ -199,83 +609,182 @@ class RecoFile(object):
         To extend the file format, one must do the following:
         - Include the dataset name and dtype description in the class variable dataset_desc
         - Include a map from larpixreco type object to dataset name in the class variable larpixreco_type_dataset
-        - Update write statement to specifications above, using your new data type
+        - Update _assemble to specifications above, using your new data type
+        '''
+        if self.async_write:
+            self.flush()
+        rows = dict((dataset_name, []) for dataset_name in self._nrows)
+        return_ref = self._assemble(obj, rows, **kwargs)
+        self._write_rows(rows)
+        return return_ref
+
+    def _relation_fields(self, event=None, track=None, hits=None, tracks=None,
+                         assoc=None):
+        '''
+        Returns the data fields that store relations between objects in the
+        current format version
+        event and track are row indices of a parent event or track, hits and
+        tracks are (start, stop) row ranges of daughter hits or tracks, and assoc
+        is the (start, stop) row range of track_hits pairs (version 3)
+        '''
+        fields = {}
+        if self.format_version == 1:
+            if not event is None:
+                fields['event_ref'] = ('events', event)
+            if not track is None:
+                fields['track_ref'] = ('tracks', track)
+            if not hits is None and hits[1] > hits[0]:
+                fields['hit_ref'] = ('hits',) + tuple(hits)
+            if not tracks is None and tracks[1] > tracks[0]:
+                fields['track_ref'] = ('tracks',) + tuple(tracks)
+        else:
+            if not event is None:
+                fields['event_idx'] = event
+            if not track is None and self.format_version == 2:
+                fields['track_idx'] = track
+            if not hits is None:
+                fields['hit_start'], fields['hit_stop'] = hits
+            if not tracks is None:
+                fields['track_start'], fields['track_stop'] = tracks
+            if not assoc is None:
+                fields['assoc_start'], fields['assoc_stop'] = assoc
+        return fields
+
+    def read_daughters(self, rows, dataset_name='hits'):
+        '''
+        Read the daughter hits (or tracks) of event or track rows with
+        vectorized slicing (format version 2 or 3)
+        Returns (data, offsets), such that the daughters of rows[i] are
+        data[offsets[i]:offsets[i+1]]
+        The hits of track rows in format version 3 are found via the
+        track_hits pairs
+        '''
+        if self.format_version < 2:
+            raise ValueError('reading by row ranges requires format version 2')
+        prefix = {'hits' : 'hit', 'tracks' : 'track'}[dataset_name]
+        rows = np.atleast_1d(rows)
+        if dataset_name == 'hits' and 'assoc_start' in rows.dtype.names:
+            pairs, offsets = read_ranges(self.datafile['track_hits'],
+                                         rows['assoc_start'], rows['assoc_stop'])
+            hit_idx = pairs['hit_idx']
+            if len(hit_idx) == 0:
+                return self.datafile['hits'][0:0], offsets
+            unique_idx, inverse = np.unique(hit_idx, return_inverse=True)
+            return self.datafile['hits'][unique_idx][inverse], offsets
+        return read_ranges(self.datafile[dataset_name], rows[prefix + '_start'],
+                           rows[prefix + '_stop'])
+
+    def _assemble(self, obj, rows, **kwargs):
+        '''
+        Append the rows needed to store obj to rows (a dict of dataset name ->
+        list of row tuples) and return (dataset_name, first_row_idx, last_row_idx)
+        of obj as it will be written to file
         '''
         dtype = type(obj)
         return_ref = None
 
-        # Initialize data chunks
-        hits_write_data = None
-        tracks_write_data = None
-        events_write_data = None
+        def next_idx(dataset_name):
+            return self._nrows[dataset_name] + len(rows[dataset_name])
 
         if dtype is recotypes.HitCollection:
             # Store hit collection as hits
-            hits_data_start = self.datafile['hits'].shape[0]
+            hits_data_start = next_idx('hits')
             hits_data_end = hits_data_start + obj.nhit
-            self._resize_by(obj.nhit, 'hits')
-            hits_write_data = self.hit_data(obj.hits, **kwargs)
+            rows['hits'] += self.hit_data(obj.hits, **kwargs)
             return_ref = ('hits', hits_data_start, hits_data_end)
 
+        elif dtype is recotypes.Track and self.format_version >= 3:
+            # Store track hits, then link them to the track by index
+            hits_dataset, hits_data_start, hits_data_end = self._assemble(
+                recotypes.HitCollection(obj.hits), rows, **kwargs)
+            return_ref = self._assemble_assoc(obj, rows, obj.get_hit_attr('hid'),
+                                              hits_data_start, **kwargs)
+
         elif dtype is recotypes.Track:
             # Store track data along with linked hits
-            track_id = self.datafile['tracks'].shape[0]
-            tracks_data_start = self.datafile['tracks'].shape[0]
-            tracks_data_end = tracks_data_start + 1
-            self._resize_by(1, 'tracks')
-            track_ref = self.datafile['tracks'].regionref[track_id]
-
-            hits_dataset, hits_data_start, hits_data_end = self.write(recotypes.HitCollection(obj.hits),
-                                                                      track_ref=track_ref, **kwargs)
-            if obj.nhit > 0:
-                hit_ref = self.datafile['hits'].regionref[hits_data_start:
-                                                              hits_data_end]
-            else:
-                hit_ref = None
-            tracks_write_data = self.track_data(obj, track_id=track_id,
-                                               hit_ref=hit_ref, **kwargs)
-            return_ref = ('tracks', tracks_data_start, tracks_data_end)
+            track_id = next_idx('tracks')
+            hit_kwargs = dict(kwargs, **self._relation_fields(track=track_id))
+            hits_dataset, hits_data_start, hits_data_end = self._assemble(
+                recotypes.HitCollection(obj.hits), rows, **hit_kwargs)
+            track_kwargs = dict(kwargs, **self._relation_fields(
+                    hits=(hits_data_start, hits_data_end)))
+            rows['tracks'] += [self.track_data(obj, track_id=track_id,
+                                               **track_kwargs)]
+            return_ref = ('tracks', track_id, track_id+1)
+
+        elif dtype is recotypes.Event and self.format_version >= 3:
+            event_idx = next_idx('events')
+            event_kwargs = self._relation_fields(event=event_idx)
+            tracks = [reco_obj for reco_obj in obj.reco_objs
+                      if isinstance(reco_obj, recotypes.Track)]
+            # Store each event hit once, followed by track hits not in event
+            hids = obj.get_hit_attr('hid')
+            hits = list(obj.hits)
+            if len(tracks) > 0:
+                track_hits = [hit for track in tracks for hit in track.hits]
+                is_extra = ~np.isin([hit.hid for hit in track_hits], hids)
+                extra = dict((hit.hid, hit) for hit, extra in zip(track_hits, is_extra)
+                             if extra)
+                hits += list(extra.values())
+                hids = np.append(hids, list(extra.keys())).astype('i8')
+            hits_data_start = next_idx('hits')
+            if len(hits) > 0:
+                self._assemble(recotypes.HitCollection(hits), rows, **event_kwargs)
+            hits_data_end = next_idx('hits')
+            tracks_data_start = next_idx('tracks')
+            for track in tracks:
+                self._assemble_assoc(track, rows, hids, hits_data_start,
+                                     **event_kwargs)
+            tracks_data_end = next_idx('tracks')
+            rows['events'] += [self.event_data(obj, **self._relation_fields(
+                        hits=(hits_data_start, hits_data_end),
+                        tracks=(tracks_data_start, tracks_data_end)))]
+            return_ref = ('events', event_idx, event_idx+1)
 
         elif dtype is recotypes.Event:
-            event_idx = self.datafile['events'].shape[0]
-            self._resize_by(1, 'events')
+            event_idx = next_idx('events')
             #  Generate references for event
-            event_ref = self.datafile['events'].regionref[event_idx]
+            event_kwargs = self._relation_fields(event=event_idx)
             # Store sub-objects
             tracks = [reco_obj for reco_obj in obj.reco_objs
                       if isinstance(reco_obj, recotypes.Track)]
-            hits_data_start = self.datafile['hits'].shape[0]
-            hits_data_end = self.datafile['hits'].shape[0]
-            tracks_data_start = self.datafile['tracks'].shape[0]
-            tracks_data_end = self.datafile['tracks'].shape[0]
+            hits_data_start = next_idx('hits')
+            tracks_data_start = next_idx('tracks')
+            track_hids = []
             for track in tracks:
-                track_dataset_name, _, tracks_data_end = self.write(track,
-                                                                    event_ref=event_ref)
-                hits_data_end += track.nhit
+                self._assemble(track, rows, **event_kwargs)
+                track_hids += [hit.hid for hit in track.hits]
+            tracks_data_end = next_idx('tracks')
             #  Catch any hits in event that are not yet stored
-            orphans = []
-            for hit in obj.hits:
-                if not hit.hid in self.datafile['hits'][hits_data_start:hits_data_end]:
-                    orphans += [hit]
-            hits_data_end += len(orphans)
-            self.write(recotypes.HitCollection(orphans), event_ref=event_ref)
-            if obj.nhit > 0:
-                hit_ref = self.datafile['hits'].regionref[hits_data_start
-                                                          :hits_data_end]
-            else:
-                hit_ref = None
-            if len(tracks) > 0:
-                track_ref = self.datafile['tracks'].regionref[tracks_data_start:
-                                                                  tracks_data_end]
-            else:
-                track_ref = None
-            events_write_data = self.event_data(obj, track_ref=track_ref,
-                                                hit_ref=hit_ref)
+            is_orphan = ~np.isin(obj.get_hit_attr('hid'), track_hids)
+            orphans = [hit for hit, orphan in zip(obj.hits, is_orphan) if orphan]
+            if len(orphans) > 0:
+                self._assemble(recotypes.HitCollection(orphans), rows,
+                               **event_kwargs)
+            hits_data_end = next_idx('hits')
+            rows['events'] += [self.event_data(obj, **self._relation_fields(
+                        hits=(hits_data_start, hits_data_end),
+                        tracks=(tracks_data_start, tracks_data_end)))]
             return_ref = ('events', event_idx, event_idx+1)
-        # Write data to file
-        self._fill(hits_write_data, 'hits')
-        self._fill(tracks_write_data, 'tracks')
-        self._fill(events_write_data, 'events')
 
         # Return reference to data
         return return_ref
+
+    def _assemble_assoc(self, track, rows, hids, hits_data_start, **kwargs):
+        '''
+        Append a track row and its (track_idx, hit_idx) pairs to rows (format
+        version 3), where hids are the hids of the hit rows starting at
+        hits_data_start
+        '''
+        track_idx = self._nrows['tracks'] + len(rows['tracks'])
+        assoc_start = self._nrows['track_hits'] + len(rows['track_hits'])
+        hids = np.asarray(hids, dtype='i8')
+        order = np.argsort(hids, kind='stable')
+        pos = np.searchsorted(hids, track.get_hit_attr('hid'), sorter=order)
+        hit_idx = hits_data_start + order[pos]
+        rows['track_hits'] += [(track_idx, idx) for idx in hit_idx.tolist()]
+        track_kwargs = dict(kwargs, **self._relation_fields(
+                assoc=(assoc_start, assoc_start + len(hit_idx))))
+        rows['tracks'] += [self.track_data(track, track_id=track_idx,
+                                           **track_kwargs)]
+        return ('tracks', track_idx, track_idx+1)
@@ -0,0 +1,316 @@
+import os
+import h5py
+import numpy as np
+from larpixreco.RecoFile import read_ranges
+from larpixreco.RecoShards import shard_datasets, shard_offset_fields
+from larpixreco.RecoLogging import getLogger
+logger = getLogger(__name__)
+
+index_version = 1
+
+class DatasetView(object):
+    '''
+    Lazy view of a reconstruction output dataset, limited to the rows in use
+    Slicing (e.g. ``view[i:j]``) reads the rows as a numpy structured array
+
+    For consolidated shards, `shard_rows` are the first rows of each shard in
+    this dataset and `shard_offsets` maps fields that store shard-local row
+    indices to the offsets of each shard, which are added to rows as they are
+    read.
+    '''
+    def __init__(self, dataset, nrows, shard_rows=None, shard_offsets=None):
+        self.dataset = dataset
+        self.nrows = nrows
+        self.shard_rows = shard_rows
+        self.shard_offsets = shard_offsets
+
+    def _apply_offsets(self, data, rows, field=None):
+        ''' Convert shard-local row indices to global row indices '''
+        if self.shard_rows is None or len(data) == 0:
+            return data
+        shard = np.searchsorted(self.shard_rows, rows, side='right') - 1
+        for offset_field, offsets in self.shard_offsets.items():
+            if field is None:
+                values = data[offset_field]
+            elif field == offset_field:
+                values = data
+            else:
+                continue
+            valid = values != -9999
+            values[valid] += offsets[shard[valid]]
+        return data
+
+    def read_ranges(self, starts, stops):
+        ''' Read row ranges (see `RecoFile.read_ranges`) '''
+        data, offsets = read_ranges(self.dataset, starts, stops)
+        if self.shard_rows is not None and len(data) > 0:
+            lengths = np.diff(offsets)
+            rows = np.repeat(np.asarray(starts) - offsets[:-1], lengths) \
+                + np.arange(offsets[-1])
+            self._apply_offsets(data, rows)
+        return data, offsets
+
+    def __len__(self):
+        return self.nrows
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            key = slice(*key.indices(self.nrows))
+            return self._apply_offsets(self.dataset[key],
+                                       np.arange(key.start, key.stop, key.step))
+        elif isinstance(key, (int, np.integer)):
+            if key < 0:
+                key += self.nrows
+            if not 0 <= key < self.nrows:
+                raise IndexError('row {} out of range'.format(key))
+            return self._apply_offsets(self.dataset[key:key+1], [key])[0]
+        elif isinstance(key, str):
+            return self.column(key)
+        key = np.asarray(key)
+        if key.dtype == bool:
+            key = np.nonzero(key)[0]
+        if np.any(key >= self.nrows) or np.any(key < 0):
+            raise IndexError('rows out of range')
+        if len(key) == 0:
+            return self.dataset[0:0]
+        order = np.argsort(key)
+        sorted_key, inverse = np.unique(key[order], return_inverse=True)
+        data = self.dataset[sorted_key]
+        result = np.empty(len(key), dtype=data.dtype)
+        result[order] = data[inverse]
+        return self._apply_offsets(result, key)
+
+    def column(self, field, start=0, stop=None):
+        ''' Read a single field of rows start to stop '''
+        if stop is None or stop > self.nrows:
+            stop = self.nrows
+        return self._apply_offsets(self.dataset.fields(field)[start:stop],
+                                   np.arange(start, stop), field)
+
+class RecoReader(object):
+    '''
+    Class to read reconstruction output files written by `RecoFile`
+
+    Datasets are opened lazily and read in batches as numpy structured arrays:
+    ``reader.events[i:j]``, ``reader.tracks_for(evid)``,
+    ``reader.hits_for(track_id)``, or single columns with
+    ``reader.column('hits', 'q')``.
+
+    Relations are resolved with an index of row ranges per event and track.
+    For format version 2 files the index is read directly from the range
+    columns. For format version 1 files it is built by dereferencing the region
+    references once, and cached next to the file (see `index_filename`) when
+    `cache_index` is set.
+
+    Files created by `RecoShards.consolidate` are read as a single file, with
+    row indices converted from shard-local to global.
+
+    For format version 3 files, `hits_for` expands the ``track_hits``
+    association pairs, and `tracks_for_hits` gives the inverse mapping.
+    '''
+    def __init__(self, filename, cache_index=True):
+        self.filename = filename
+        self.cache_index = cache_index
+        self.datafile = h5py.File(self.filename, 'r')
+        self.format_version = int(self.datafile.attrs.get('format_version', 1))
+        self.shard_offsets = None
+        if 'info' in self.datafile and 'shard_offsets' in self.datafile['info']:
+            self.shard_offsets = self.datafile['info/shard_offsets'][:]
+        self.events = self._view('events')
+        self.tracks = self._view('tracks')
+        self.hits = self._view('hits')
+        self.track_hits = None
+        if 'track_hits' in self.datafile:
+            self.track_hits = self._view('track_hits')
+        self._index = None
+        self._hit_tracks = None
+
+    def _view(self, dataset_name):
+        dataset = self.datafile[dataset_name]
+        nrows = int(dataset.attrs.get('nrows', dataset.shape[0]))
+        if self.shard_offsets is None or not dataset_name in shard_datasets:
+            return DatasetView(dataset, nrows)
+        col = shard_datasets.index(dataset_name)
+        shard_offsets = dict((field, self.shard_offsets[:-1, shard_datasets.index(target)])
+                             for field, target in shard_offset_fields[dataset_name].items())
+        return DatasetView(dataset, nrows, self.shard_offsets[:-1, col], shard_offsets)
+
+    def close(self):
+        self.datafile.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @property
+    def index_filename(self):
+        return self.filename + '.index.npz'
+
+    @property
+    def index(self):
+        '''
+        Dict of index arrays:
+         - ``evid``, ``evid_order``: evid of each event row and the event rows
+           sorted by evid
+         - ``event_hit_start``, ``event_hit_stop``, ``event_track_start``,
+           ``event_track_stop``: daughter row ranges of each event row
+         - ``track_event_idx``, ``track_hit_start``, ``track_hit_stop``:
+           parent event row and daughter hit row range of each track row
+           (``track_assoc_start``, ``track_assoc_stop``: row range of
+           ``track_hits`` pairs of each track row for format version 3)
+        '''
+        if self._index is None:
+            self._index = self._load_index()
+            if self._index is None:
+                self._index = self.build_index()
+                if self.cache_index and self.format_version == 1:
+                    self._save_index()
+        return self._index
+
+    def _signature(self):
+        stat = os.stat(self.filename)
+        return np.array([index_version, stat.st_size, stat.st_mtime])
+
+    def _load_index(self):
+        if not self.cache_index or not os.path.isfile(self.index_filename):
+            return None
+        try:
+            with np.load(self.index_filename) as index_file:
+                index = dict(index_file)
+        except (OSError, ValueError):
+            return None
+        if not np.array_equal(index.pop('signature'), self._signature()):
+            return None
+        return index
+
+    def _save_index(self):
+        try:
+            np.savez(self.index_filename, signature=self._signature(), **self._index)
+        except OSError as err:
+            logger.warning('could not cache index: {}'.format(err))
+
+    def _ref_bounds(self, refs, dataset_name):
+        ''' Convert region references into (start, stop) row ranges '''
+        dataset_id = self.datafile[dataset_name].id
+        starts = np.zeros(len(refs), dtype='i8')
+        stops = np.zeros(len(refs), dtype='i8')
+        for i, ref in enumerate(refs):
+            if ref:
+                bounds = h5py.h5r.get_region(ref, dataset_id).get_select_bounds()
+                starts[i], stops[i] = bounds[0][0], bounds[1][0] + 1
+        return starts, stops
+
+    def build_index(self):
+        ''' Build index of row ranges from the events and tracks datasets '''
+        index = {}
+        index['evid'] = self.events.column('evid')
+        index['evid_order'] = np.argsort(index['evid'], kind='stable')
+        if self.format_version >= 2:
+            for field in ('hit_start', 'hit_stop', 'track_start', 'track_stop'):
+                index['event_' + field] = self.events.column(field)
+            track_fields = ('event_idx', 'hit_start', 'hit_stop')
+            if self.format_version >= 3:
+                track_fields = ('event_idx', 'assoc_start', 'assoc_stop')
+            for field in track_fields:
+                index['track_' + field] = self.tracks.column(field)
+        else:
+            index['event_hit_start'], index['event_hit_stop'] = self._ref_bounds(
+                self.events.column('hit_ref'), 'hits')
+            index['event_track_start'], index['event_track_stop'] = self._ref_bounds(
+                self.events.column('track_ref'), 'tracks')
+            index['track_event_idx'], _ = self._ref_bounds(
+                self.tracks.column('event_ref'), 'events')
+            index['track_hit_start'], index['track_hit_stop'] = self._ref_bounds(
+                self.tracks.column('hit_ref'), 'hits')
+        return index
+
+    def event_rows(self, evids):
+        ''' Returns event row indices for evids (-1 if not found) '''
+        evid = self.index['evid']
+        order = self.index['evid_order']
+        evids = np.asarray(evids)
+        if len(order) == 0:
+            return np.full(evids.shape, -1)
+        pos = np.clip(np.searchsorted(evid[order], evids), 0, len(order) - 1)
+        rows = order[pos]
+        return np.where(evid[rows] == evids, rows, -1)
+
+    def _read_daughters(self, view, starts, stops, scalar):
+        data, offsets = view.read_ranges(starts, stops)
+        if scalar:
+            return data
+        return data, offsets
+
+    def _event_ranges(self, evids, prefix):
+        rows = np.atleast_1d(self.event_rows(evids))
+        if np.any(rows < 0):
+            raise KeyError('evid not found')
+        return (self.index['event_{}_start'.format(prefix)][rows],
+                self.index['event_{}_stop'.format(prefix)][rows])
+
+    def event(self, evid):
+        ''' Returns the event row with evid '''
+        row = self.event_rows(evid)
+        if row < 0:
+            raise KeyError('evid {} not found'.format(evid))
+        return self.events[int(row)]
+
+    def tracks_for(self, evids):
+        '''
+        Returns the tracks of an event, or (tracks, offsets) for an array of
+        evids, such that the tracks of evids[i] are tracks[offsets[i]:offsets[i+1]]
+        '''
+        starts, stops = self._event_ranges(evids, 'track')
+        return self._read_daughters(self.tracks, starts, stops, np.ndim(evids) == 0)
+
+    def hits_for_event(self, evids):
+        '''
+        Returns the hits of an event, or (hits, offsets) for an array of evids
+        '''
+        starts, stops = self._event_ranges(evids, 'hit')
+        return self._read_daughters(self.hits, starts, stops, np.ndim(evids) == 0)
+
+    def hits_for(self, track_ids):
+        '''
+        Returns the hits of a track, or (hits, offsets) for an array of track ids
+        '''
+        rows = np.atleast_1d(track_ids)
+        if self.format_version >= 3:
+            pairs, offsets = self.track_hits.read_ranges(
+                self.index['track_assoc_start'][rows],
+                self.index['track_assoc_stop'][rows])
+            hits = self.hits[pairs['hit_idx']]
+            if np.ndim(track_ids) == 0:
+                return hits
+            return hits, offsets
+        return self._read_daughters(self.hits, self.index['track_hit_start'][rows],
+                                    self.index['track_hit_stop'][rows],
+                                    np.ndim(track_ids) == 0)
+
+    def tracks_for_hits(self, hit_rows):
+        '''
+        Returns the track rows that each hit row belongs to as (track_rows,
+        offsets), such that the tracks of hit_rows[i] are
+        track_rows[offsets[i]:offsets[i+1]] (format version 3 only)
+        '''
+        if self.track_hits is None:
+            raise ValueError('file has no hit/track association table')
+        if self._hit_tracks is None:
+            # association pairs sorted by hit, read once per reader
+            pairs = self.track_hits[:]
+            order = np.argsort(pairs['hit_idx'], kind='stable')
+            self._hit_tracks = (pairs['hit_idx'][order], pairs['track_idx'][order])
+        sorted_hits, track_rows = self._hit_tracks
+        hit_rows = np.atleast_1d(hit_rows)
+        starts = np.searchsorted(sorted_hits, hit_rows, side='left')
+        stops = np.searchsorted(sorted_hits, hit_rows, side='right')
+        offsets = np.zeros(len(hit_rows) + 1, dtype='i8')
+        offsets[1:] = np.cumsum(stops - starts)
+        idcs = np.repeat(starts - offsets[:-1], stops - starts) + np.arange(offsets[-1])
+        return track_rows[idcs], offsets
+
+    def column(self, dataset_name, field, start=0, stop=None):
+        ''' Read a single column of a dataset '''
+        return getattr(self, dataset_name).column(field, start, stop)
@@ -0,0 +1,139 @@
+'''
+Sharded reconstruction output
+
+Parallel workers each write their own shard `RecoFile` (see `open_shard`). The
+shards are then presented as a single file by `consolidate`, which creates
+HDF5 virtual datasets that map onto the shard datasets without copying them.
+Tables in the info group of the shards (see `RecoFile.write_table`) are
+concatenated in the same way.
+
+Row indices stored in a shard (``event_idx``, ``track_idx``, ``hit_start``,
+...) are local to that shard. The row offsets of each shard are stored in the
+``info/shard_offsets`` dataset of the consolidated file, and are applied by
+`RecoReader.RecoReader` when reading.
+'''
+import os
+import h5py
+import numpy as np
+from larpixreco.RecoFile import RecoFile
+from larpixreco.RecoLogging import getLogger
+logger = getLogger(__name__)
+
+shard_datasets = ('events', 'tracks', 'hits') # column order of shard_offsets
+shard_offset_fields = { # maps between a dataset and its fields storing row indices into another dataset
+    'events' : {'track_start' : 'tracks', 'track_stop' : 'tracks',
+                'hit_start' : 'hits', 'hit_stop' : 'hits'},
+    'tracks' : {'track_id' : 'tracks', 'event_idx' : 'events', 'hit_start' : 'hits',
+                'hit_stop' : 'hits'},
+    'hits' : {'event_idx' : 'events', 'track_idx' : 'tracks'}
+    }
+
+def shard_filename(filename, shard_idx):
+    ''' Filename of a shard of the output file filename '''
+    base, ext = os.path.splitext(filename)
+    return '{}.shard{:04d}{}'.format(base, shard_idx, ext)
+
+def open_shard(filename, shard_idx, **kwargs):
+    '''
+    Create the `RecoFile` for a shard of the output file filename, kwargs are
+    passed to the `RecoFile`
+    Shards use format version 2, since region references can not point across
+    files
+    '''
+    kwargs['format_version'] = 2
+    return RecoFile(shard_filename(filename, shard_idx), **kwargs)
+
+def renumber_events(shard, evid_offset):
+    '''
+    Offset the event ids of a shard file (whose event ids start at 0) by
+    evid_offset in place, including the ``evid`` field of the tables in its info
+    group. The offset is stored in the ``evid_offset`` attr of the events
+    dataset, so renumbering a shard again only applies the difference
+    '''
+    with h5py.File(shard, 'r+') as shardfile:
+        delta = evid_offset - int(shardfile['events'].attrs.get('evid_offset', 0))
+        if delta == 0:
+            return
+        datasets = [shardfile['events']] + [table for table in shardfile['info'].values()
+                                            if 'evid' in (table.dtype.names or ())]
+        for dataset in datasets:
+            nrows = int(dataset.attrs.get('nrows', dataset.shape[0]))
+            if nrows == 0:
+                continue
+            rows = dataset[:nrows]
+            rows['evid'] += delta
+            dataset[:nrows] = rows
+        shardfile['events'].attrs['evid_offset'] = evid_offset
+
+def consolidate(shard_filenames, filename, evid_counts=None):
+    '''
+    Create a file that presents the shards as one logical output file using
+    virtual datasets. The shard files are referenced relative to the
+    consolidated file, so they should be kept in the same relative location.
+    With `evid_counts`, the number of event ids used by each shard (whose event
+    ids start at 0), the event ids of each shard are offset by the event ids
+    used by the shards before it (the shards are modified in place, see
+    `renumber_events`, so consolidating the same shards again is safe).
+    Returns the number of rows per dataset
+    '''
+    if evid_counts is not None:
+        evid_offsets = np.cumsum([0] + list(evid_counts)[:-1])
+        for shard, evid_offset in zip(shard_filenames, evid_offsets):
+            renumber_events(shard, int(evid_offset))
+    nrows = np.zeros((len(shard_filenames), len(shard_datasets)), dtype='i8')
+    shapes = np.zeros_like(nrows)
+    dtypes = {}
+    table_lengths = {} # number of rows of each table in the info group of each shard
+    for shard_idx, shard in enumerate(shard_filenames):
+        with h5py.File(shard, 'r') as shardfile:
+            if int(shardfile.attrs.get('format_version', 1)) != 2:
+                raise ValueError('{} is not format version 2'.format(shard))
+            for col, dataset_name in enumerate(shard_datasets):
+                dataset = shardfile[dataset_name]
+                nrows[shard_idx, col] = dataset.attrs.get('nrows', dataset.shape[0])
+                shapes[shard_idx, col] = dataset.shape[0]
+                dtypes[dataset_name] = dataset.dtype
+            for table_name, table in shardfile['info'].items():
+                table_lengths.setdefault(table_name, [0] * len(shard_filenames))
+                table_lengths[table_name][shard_idx] = table.shape[0]
+                dtypes['info/' + table_name] = table.dtype
+    offsets = np.zeros((len(shard_filenames) + 1, len(shard_datasets)), dtype='i8')
+    offsets[1:] = np.cumsum(nrows, axis=0)
+
+    outdir = os.path.dirname(os.path.abspath(filename))
+    with h5py.File(filename, 'w') as datafile:
+        for col, dataset_name in enumerate(shard_datasets):
+            layout = h5py.VirtualLayout(shape=(offsets[-1, col],),
+                                        dtype=dtypes[dataset_name])
+            for shard_idx, shard in enumerate(shard_filenames):
+                if nrows[shard_idx, col] == 0:
+                    continue
+                source = h5py.VirtualSource(os.path.relpath(os.path.abspath(shard),
+                                                            outdir),
+                                            dataset_name,
+                                            shape=(shapes[shard_idx, col],),
+                                            dtype=dtypes[dataset_name])
+                source = source[:nrows[shard_idx, col]]
+                layout[offsets[shard_idx, col]:offsets[shard_idx+1, col]] = source
+            dataset = datafile.create_virtual_dataset(dataset_name, layout)
+            dataset.attrs['nrows'] = offsets[-1, col]
+        info = datafile.create_group('info')
+        for table_name, lengths in table_lengths.items():
+            dataset_name = 'info/' + table_name
+            layout = h5py.VirtualLayout(shape=(sum(lengths),), dtype=dtypes[dataset_name])
+            start = 0
+            for shard, length in zip(shard_filenames, lengths):
+                if length == 0:
+                    continue
+                layout[start:start+length] = h5py.VirtualSource(
+                    os.path.relpath(os.path.abspath(shard), outdir), dataset_name,
+                    shape=(length,), dtype=dtypes[dataset_name])
+                start += length
+            info.create_virtual_dataset(table_name, layout)
+        info.create_dataset('shard_offsets', data=offsets)
+        info.attrs['shard_files'] = [str(shard) for shard in shard_filenames]
+        datafile.attrs['format_version'] = 2
+        datafile.attrs['consolidated'] = True
+    logger.info('consolidated {} shards into {}'.format(len(shard_filenames),
+                                                       filename))
+    return dict(zip(shard_datasets, offsets[-1]))
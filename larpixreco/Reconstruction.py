@@ -1,12 +1,24 @@
 import numpy as np
 from larpixreco.types import Track, Shower
 import larpixreco.algorithms.hough as hough
+from larpixreco.RecoCache import RecoCache, lines_to_arrays, arrays_to_lines
 from functools import wraps
 import sys
 import traceback
+import time
+import json
+import importlib
+import cProfile
+import pstats
+import tracemalloc
+from larpixreco.Metrics import metrics
 from larpixreco.RecoLogging import getLogger
 logger = getLogger(__name__)
 
+_peak_memory = metrics.histogram('reco_stage_peak_bytes',
+                                 'peak memory of a reconstruction stage per event',
+                                 buckets=(1e6, 1e7, 1e8, 1e9, 1e10))
+
 def safe_failure(func):
     @wraps(func)
     def new_func(*args, **kwargs):
@@ -29,12 +41,29 @@ class Reconstruction(object):
 
 class TrackReconstruction(Reconstruction):
     ''' Class for reconstructing events into straight line segments '''
-    def __init__(self, hough_threshold=5, hough_ndir=1000, hough_dr_mm=3):
+    def __init__(self, hough_threshold=5, hough_ndir=1000, hough_dr_mm=3,
+                 result_cache=None, max_accumulator_mb=None, max_dr_mm=None):
+        '''
+        `result_cache` is a `RecoCache.RecoCache` (or its directory) used to
+        look up the Hough results of events with identical hits and parameters
+        With `max_accumulator_mb`, the Hough accumulator of each event is
+        planned to fit this budget (see `hough.plan_accumulator`), using a
+        bin size of at most `max_dr_mm`. Events that do not fit are skipped
+        and listed in `skipped_evids`
+        '''
         Reconstruction.__init__(self)
         self.hough_ndir = hough_ndir
         self.hough_dr = hough_dr_mm
         self.hough_threshold = hough_threshold
         self.cache = hough.setup_fit_errors()
+        if isinstance(result_cache, str):
+            result_cache = RecoCache(result_cache)
+        self.result_cache = result_cache
+        self.max_accumulator_bytes = None
+        if max_accumulator_mb is not None:
+            self.max_accumulator_bytes = int(max_accumulator_mb * 1e6)
+        self.max_dr = max_dr_mm
+        self.skipped_evids = []
 
     @safe_failure
     def do_reconstruction(self, event):
@@ -43,11 +72,32 @@ class TrackReconstruction(Reconstruction):
         y = np.array(event['py'])/10 # "
         z = (np.array(event['ts']) - event.ts_start)/1000 # convert to us
         points = np.array(list(zip(x,y,z)))
-        params = hough.HoughParameters()
-        params.ndirections = self.hough_ndir
-        params.dr = self.hough_dr
-        lines, points, params = hough.run_iterative_hough(points,
-                params, self.hough_threshold, self.cache)
+        dr, dtype = self.hough_dr, None
+        if self.max_accumulator_bytes is not None:
+            plan = hough.plan_accumulator(points, self.hough_ndir, dr,
+                                          self.max_accumulator_bytes, self.max_dr)
+            if plan.action == 'skip':
+                logger.warning('skipping event {}: Hough accumulator needs {} bytes'.format(
+                        event.evid, plan.nbytes))
+                self.skipped_evids += [event.evid]
+                return []
+            dr, dtype = plan.dr, plan.dtype
+        lines = None
+        if self.result_cache is not None:
+            key = RecoCache.key(self.__class__.__name__, points, self.hough_ndir,
+                                dr, self.hough_threshold)
+            arrays = self.result_cache.get(key)
+            if arrays is not None:
+                lines = arrays_to_lines(arrays)
+        if lines is None:
+            params = hough.HoughParameters()
+            params.ndirections = self.hough_ndir
+            params.dr = dr
+            params.dtype = dtype
+            lines, points, params = hough.run_iterative_hough(points,
+                    params, self.hough_threshold, self.cache)
+            if self.result_cache is not None:
+                self.result_cache.put(key, **lines_to_arrays(lines))
 
         tracks = []
         for line, hit_idcs in lines.items():
@@ -58,6 +108,20 @@ class TrackReconstruction(Reconstruction):
         event.reco_objs += tracks
         return tracks
 
+    def write(self, recofile):
+        ''' Store the skipped events as metadata in the info group of a `RecoFile` '''
+        recofile.write_attr(hough_skipped_evids=np.array(self.skipped_evids, dtype='i8'))
+
+    def read(self, recofile, accumulate=False):
+        '''
+        Restore the skipped events stored by `write` (e.g. to resume a run), or
+        add them to the skipped events with `accumulate`
+        '''
+        if not accumulate:
+            self.skipped_evids = []
+        self.skipped_evids += [int(evid) for evid in
+                               recofile.read_attr('hough_skipped_evids', default=[])]
+
 class ShowerReconstruction(Reconstruction):
     ''' Class for reconstructing events into showers '''
     def __init__(self):
@@ -68,3 +132,234 @@ class ShowerReconstruction(Reconstruction):
         # Split up event into showers (not implemented)
         pass
 
+
+class ReconstructionChain(Reconstruction):
+    '''
+    An ordered list of reconstruction stages, run on each event
+
+    The wall time, CPU time, and number of reco objects added by each stage are
+    summed per stage (see `summary`), and recorded per stage per event if
+    `record_events` (see `records` and `write_records`). The time of a stage
+    run on a batch of events (see `do_batch_reconstruction`) is split evenly
+    between the events of the batch. Each stage can be profiled with
+    `cProfile` (``'profile': true`` in the config), or with any profiler that
+    has ``enable()`` and ``disable()`` methods (``'profile': 'module:factory'``,
+    e.g. a sampling profiler).
+
+    With `trace_memory`, the peak memory allocated during each stage is
+    measured with `tracemalloc` (the largest per stage is in `summary`, and
+    the peak per event in the records). To record the peak of each event,
+    batch stages are then run one event at a time if `record_events`.
+    Tracing slows down the reconstruction, so it is off by default.
+
+    A chain is configured with a JSON file (see `from_file`)::
+
+        {"stages": [
+            {"type": "TrackReconstruction", "kwargs": {"hough_threshold": 5},
+             "profile": false},
+            {"type": "mypackage.module:MyReconstruction"}
+            ],
+         "trace_memory": false}
+
+    '''
+    stage_types = { # reconstructions that can be referred to by name in a config
+        'TrackReconstruction' : TrackReconstruction,
+        'ShowerReconstruction' : ShowerReconstruction
+        }
+    record_desc = [ # describes per stage per event records
+        ('evid', 'i8'), ('stage', 'i8'), ('wall_time', 'f8'), ('cpu_time', 'f8'),
+        ('n_objs', 'i8'), ('peak_bytes', 'i8')]
+
+    def __init__(self, stages=None, names=None, profilers=None, record_events=False,
+                 trace_memory=False):
+        Reconstruction.__init__(self)
+        self.stages = list(stages or [])
+        self.names = list(names or [type(stage).__name__ for stage in self.stages])
+        self.profilers = list(profilers or [None] * len(self.stages))
+        self.record_events = record_events
+        self.records = []
+        self.n_events = np.zeros(len(self.stages), dtype='i8')
+        self.wall_time = np.zeros(len(self.stages))
+        self.cpu_time = np.zeros(len(self.stages))
+        self.n_objs = np.zeros(len(self.stages), dtype='i8')
+        self.trace_memory = trace_memory
+        self.peak_bytes = np.full(len(self.stages), -1, dtype='i8')
+
+    @staticmethod
+    def resolve(name, types=None):
+        ''' Returns the object named by a key of types or a ``module:attr`` path '''
+        if types is not None and name in types:
+            return types[name]
+        if not ':' in name:
+            raise ValueError('unknown reconstruction stage {}'.format(name))
+        module_name, attr = name.split(':')
+        return getattr(importlib.import_module(module_name), attr)
+
+    @classmethod
+    def from_config(cls, config):
+        ''' Create a chain from a config dict (see class description) '''
+        stages, names, profilers = [], [], []
+        for stage_config in config['stages']:
+            stage_type = cls.resolve(stage_config['type'], cls.stage_types)
+            stages += [stage_type(**stage_config.get('kwargs', {}))]
+            names += [stage_config.get('name', stage_config['type'])]
+            profile = stage_config.get('profile', False)
+            if profile is True:
+                profilers += [cProfile.Profile()]
+            elif profile:
+                profilers += [cls.resolve(profile)()]
+            else:
+                profilers += [None]
+        return cls(stages, names, profilers,
+                   record_events=config.get('record_events', False),
+                   trace_memory=config.get('trace_memory', False))
+
+    @classmethod
+    def from_file(cls, filename):
+        ''' Create a chain from a JSON config file '''
+        with open(filename) as config_file:
+            return cls.from_config(json.load(config_file))
+
+    def _run_stage(self, stage_idx, func, events):
+        ''' Run func on a list of events, recording the time spent '''
+        n_objs_before = [len(event.reco_objs) for event in events]
+        profiler = self.profilers[stage_idx]
+        peak_bytes = -1
+        # tracing started here is stopped after the stage, so that code outside
+        # of the chain is not slowed down
+        start_tracing = self.trace_memory and not tracemalloc.is_tracing()
+        if start_tracing:
+            tracemalloc.start()
+        if self.trace_memory:
+            tracemalloc.reset_peak()
+            memory_start = tracemalloc.get_traced_memory()[0]
+        if profiler is not None:
+            profiler.enable()
+        wall_start, cpu_start = time.perf_counter(), time.process_time()
+        try:
+            func()
+        finally:
+            wall_time = time.perf_counter() - wall_start
+            cpu_time = time.process_time() - cpu_start
+            if profiler is not None:
+                profiler.disable()
+            if self.trace_memory:
+                peak_bytes = tracemalloc.get_traced_memory()[1] - memory_start
+                self.peak_bytes[stage_idx] = max(self.peak_bytes[stage_idx], peak_bytes)
+                _peak_memory.observe(peak_bytes)
+            if start_tracing:
+                tracemalloc.stop()
+        n_objs = [len(event.reco_objs) - n_before
+                  for event, n_before in zip(events, n_objs_before)]
+        self.n_events[stage_idx] += len(events)
+        self.wall_time[stage_idx] += wall_time
+        self.cpu_time[stage_idx] += cpu_time
+        self.n_objs[stage_idx] += sum(n_objs)
+        if self.record_events:
+            # batch times are split evenly between the events of the batch
+            self.records += [(event.evid, stage_idx, wall_time / len(events),
+                              cpu_time / len(events), n_event_objs, peak_bytes)
+                             for event, n_event_objs in zip(events, n_objs)]
+
+    def do_reconstruction(self, event):
+        ''' Run each stage on event '''
+        for stage_idx, stage in enumerate(self.stages):
+            self._run_stage(stage_idx, lambda: stage.do_reconstruction(event), [event])
+        return event.reco_objs
+
+    def do_batch_reconstruction(self, events):
+        '''
+        Run each stage on a list of events, stages with a
+        `do_batch_reconstruction` method are run once for the whole batch
+        (unless the peak memory of each event is recorded)
+        '''
+        per_event_memory = self.trace_memory and self.record_events
+        for stage_idx, stage in enumerate(self.stages):
+            if hasattr(stage, 'do_batch_reconstruction') and not per_event_memory:
+                self._run_stage(stage_idx, lambda: stage.do_batch_reconstruction(events),
+                                events)
+            else:
+                for event in events:
+                    self._run_stage(stage_idx, lambda: stage.do_reconstruction(event),
+                                    [event])
+        return events
+
+    def summary(self):
+        ''' Returns a dict of timing totals per stage name '''
+        return dict((name, {'n_events' : int(self.n_events[i]),
+                            'wall_time' : float(self.wall_time[i]),
+                            'cpu_time' : float(self.cpu_time[i]),
+                            'n_objs' : int(self.n_objs[i]),
+                            'peak_bytes' : int(self.peak_bytes[i])})
+                    for i, name in enumerate(self.names))
+
+    def records_array(self):
+        '''
+        Returns the per stage per event records (since the last `write_records`)
+        as a structured array
+        '''
+        return np.array(self.records, dtype=self.record_desc)
+
+    def write_records(self, recofile):
+        '''
+        Append the per stage per event records to the ``reco_stage_records``
+        dataset of the info group of a `RecoFile`, and clear them (call
+        periodically, so that the records of a run are not kept in memory)
+        '''
+        if len(self.records) > 0:
+            recofile.write_table('reco_stage_records', self.records_array())
+            self.records = []
+
+    def profile_stats(self, stage_idx):
+        ''' Returns `pstats.Stats` of a stage profiled with cProfile '''
+        return pstats.Stats(self.profilers[stage_idx])
+
+    def dump_profiles(self, prefix):
+        ''' Write the stats of each profiled stage to ``<prefix>.<stage name>.prof`` '''
+        for name, profiler in zip(self.names, self.profilers):
+            if hasattr(profiler, 'dump_stats'):
+                profiler.dump_stats('{}.{}.prof'.format(prefix, name.replace(':', '.')))
+
+    def write(self, recofile):
+        '''
+        Store the timing totals, the remaining records (see `write_records`),
+        and the metadata of stages that have a `write` method, in the info group
+        of a `RecoFile`
+        '''
+        self.write_records(recofile)
+        recofile.write_attr(reco_stages=np.array(self.names, dtype='S'),
+                            reco_stage_n_events=self.n_events,
+                            reco_stage_wall_time=self.wall_time,
+                            reco_stage_cpu_time=self.cpu_time,
+                            reco_stage_n_objs=self.n_objs,
+                            reco_stage_peak_bytes=self.peak_bytes)
+        for stage in self.stages:
+            if hasattr(stage, 'write'):
+                stage.write(recofile)
+
+    def read(self, recofile, accumulate=False):
+        '''
+        Restore the totals stored by `write` (e.g. to resume a run), and the
+        metadata of stages that have a `read` method. With `accumulate`, the
+        totals are added (the peak memory is the maximum)
+        '''
+        names = recofile.read_attr('reco_stages')
+        if names is not None:
+            names = [name.decode() for name in names]
+            if names != self.names:
+                logger.warning('stages {} differ from stored stages {}, totals are not '
+                               'restored'.format(self.names, names))
+                return
+            for field in ('n_events', 'wall_time', 'cpu_time', 'n_objs', 'peak_bytes'):
+                value = recofile.read_attr('reco_stage_' + field)
+                if value is None:
+                    continue
+                value = np.array(value)
+                if accumulate and field == 'peak_bytes':
+                    value = np.maximum(self.peak_bytes, value)
+                elif accumulate:
+                    value = getattr(self, field) + value
+                setattr(self, field, value)
+        for stage in self.stages:
+            if hasattr(stage, 'read'):
+                stage.read(recofile, accumulate=accumulate)
@@ -0,0 +1,154 @@
+'''
+Synthetic raw data files in the `HitParser` format, for tests and benchmarks
+
+Each event is a set of straight tracks through a square pixel plane. Hits are
+sampled along each track every `hit_spacing` (in the mm, mm, us space used
+by `TrackReconstruction`), and snapped to the nearest pixel. Events are
+separated by more than `EventBuilder.dt_cut`, and uncorrelated noise hits
+are added at `noise_rate`. The rows of the file are ordered by readout time,
+i.e. each hit is delayed by up to `max_delay` ns, so the file is only roughly
+time-ordered.
+
+The generated files are deterministic for a given seed. The true tracks are
+stored in the ``'truth'`` dataset (see `truth_desc`, ``evid`` is the index of
+the generated event).
+
+`generate_events` returns reconstructed `Event` objects with random hits and
+tracks instead, e.g. to benchmark writing output files.
+'''
+import h5py
+import numpy as np
+from larpixreco.types import Hit, Event, Track
+from larpixreco.HitParser import HitParser
+from larpixreco.EventBuilder import EventBuilder
+from larpixreco.RecoLogging import getLogger
+logger = getLogger(__name__)
+
+pixel_pitch = 30 # pixel coordinate units (0.1 mm)
+n_pixels = 32 # per side
+channels_per_chip = 32
+pedestal = 500.
+
+truth_desc = [('evid', 'i8'), ('start', 'f8', (3,)), ('end', 'f8', (3,)),
+              ('nhit', 'i8')]
+
+def generate_track(rng, length_range=(30., 80.), hit_spacing=1.5):
+    '''
+    Returns the (start, end, points) of a random straight track in (mm, mm,
+    us) coordinates, points are sampled every hit_spacing along the track
+    '''
+    size = n_pixels * pixel_pitch / 10.
+    start = np.array([rng.uniform(0, size), rng.uniform(0, size), rng.uniform(0, 50.)])
+    direction = rng.normal(size=3)
+    direction /= np.linalg.norm(direction)
+    if direction[2] < 0:
+        direction = -direction
+    direction[2] = max(direction[2], 0.2) # avoid tracks parallel to the pixel plane
+    direction /= np.linalg.norm(direction)
+    length = rng.uniform(*length_range)
+    steps = np.arange(0, length, hit_spacing)
+    points = start + steps[:, np.newaxis] * direction
+    # keep the part of the track inside the pixel plane
+    inside = np.all((points[:, :2] >= 0) & (points[:, :2] < size), axis=1)
+    points = points[inside]
+    if len(points) == 0:
+        return start, start, points
+    return points[0], points[-1], points
+
+def hits_to_rows(px_idx, py_idx, ts, q):
+    ''' Returns raw data rows (see `HitParser._col2name_map`) for pixel hits '''
+    col = HitParser._name2col_map
+    rows = np.zeros((len(ts), len(HitParser._col2name_map)))
+    pixelid = px_idx * n_pixels + py_idx
+    rows[:, col['channelid']] = pixelid % channels_per_chip
+    rows[:, col['chipid']] = pixelid // channels_per_chip
+    rows[:, col['pixelid']] = pixelid
+    rows[:, col['pixelx']] = (px_idx + 0.5) * pixel_pitch
+    rows[:, col['pixely']] = (py_idx + 0.5) * pixel_pitch
+    rows[:, col['raw_adc']] = np.round(q)
+    rows[:, col['adc']] = np.round(q)
+    rows[:, col['raw_timestamp']] = ts % 2**24
+    rows[:, col['timestamp']] = ts
+    rows[:, col['v']] = pedestal + q
+    rows[:, col['pdst_v']] = pedestal
+    return rows
+
+def generate_rows(n_events, tracks_per_event=2., noise_rate=1e3, max_delay=1000,
+                  event_spacing=int(1e6), hit_spacing=1.5, seed=0):
+    '''
+    Returns (rows, truth) for n_events events in readout order
+    `tracks_per_event` is the mean (Poisson, at least 1) number of tracks,
+    `noise_rate` the rate of noise hits (Hz), `max_delay` the maximum readout
+    delay of a hit (ns) and `event_spacing` the mean time between events (ns)
+    '''
+    rng = np.random.RandomState(seed)
+    min_spacing = 2 * EventBuilder.dt_cut + int(100e3)
+    event_ts = np.cumsum(min_spacing + rng.exponential(event_spacing, size=n_events))
+    hits = []
+    truth = []
+    for evid, ts_start in enumerate(event_ts.astype(int)):
+        for _ in range(max(rng.poisson(tracks_per_event), 1)):
+            start, end, points = generate_track(rng, hit_spacing=hit_spacing)
+            px_idx = (points[:, 0] * 10 // pixel_pitch).astype(int)
+            py_idx = (points[:, 1] * 10 // pixel_pitch).astype(int)
+            ts = ts_start + (points[:, 2] * 1000).astype(int)
+            q = rng.gamma(4., 10., size=len(points))
+            hits += [(px_idx, py_idx, ts, q)]
+            truth += [(evid, start, end, len(points))]
+    time_span = int(event_ts[-1]) + event_spacing if n_events > 0 else 0
+    n_noise = rng.poisson(noise_rate * time_span * 1e-9)
+    hits += [(rng.randint(n_pixels, size=n_noise), rng.randint(n_pixels, size=n_noise),
+              rng.randint(0, max(time_span, 1), size=n_noise),
+              rng.gamma(2., 10., size=n_noise))]
+    px_idx, py_idx, ts, q = [np.concatenate(values) for values in zip(*hits)]
+    rows = hits_to_rows(px_idx, py_idx, ts, q)
+    readout_ts = ts + rng.randint(0, max_delay + 1, size=len(ts))
+    rows = rows[np.argsort(readout_ts, kind='stable')]
+    return rows, np.array(truth, dtype=truth_desc)
+
+def write_file(filename, n_events=100, n_rows=None, **kwargs):
+    '''
+    Write a synthetic raw data file, kwargs are passed to `generate_rows`
+    If `n_rows` is given, events are generated until the file has n_rows rows
+    (the last event may be truncated). Returns the number of rows
+    '''
+    rows, truth = generate_rows(n_events, **kwargs)
+    while n_rows is not None and len(rows) < n_rows:
+        n_events = int(n_events * 1.2 * n_rows / max(len(rows), 1)) + 1
+        rows, truth = generate_rows(n_events, **kwargs)
+    if n_rows is not None:
+        rows = rows[:n_rows]
+    with h5py.File(filename, 'w') as datafile:
+        dataset = datafile.create_dataset('data', data=rows)
+        dataset.attrs['descripiton'] = 'synthetic data'
+        datafile.create_dataset('truth', data=truth)
+    logger.info('wrote {} synthetic rows to {}'.format(len(rows), filename))
+    return len(rows)
+
+def generate_events(n_events, hits_per_event=100, tracks_per_event=2, seed=0, overlap=0):
+    '''
+    Returns reconstructed `Event` objects with random hits and tracks (e.g. to
+    benchmark the output), each track shares `overlap` hits with the next track
+    '''
+    rng = np.random.RandomState(seed)
+    events = []
+    hid = 0
+    for evid in range(n_events):
+        ts = np.sort(rng.randint(0, 10000, size=hits_per_event)) + evid * 100000
+        px = rng.randint(0, 300, size=hits_per_event)
+        py = rng.randint(0, 300, size=hits_per_event)
+        q = rng.randint(0, 200, size=hits_per_event)
+        hits = [Hit(hid+i, px[i], py[i], ts[i], q[i], chipid=rng.randint(256),
+                    channelid=rng.randint(32)) for i in range(hits_per_event)]
+        hid += hits_per_event
+        event = Event(evid, hits)
+        hits_per_track = hits_per_event // (tracks_per_event + 1)
+        for track_idx in range(tracks_per_event):
+            track_hits = hits[track_idx*hits_per_track:
+                              (track_idx+1)*hits_per_track + overlap]
+            event.reco_objs += [Track(track_hits, *rng.uniform(size=4),
+                                      cov=np.diag(rng.uniform(size=4)),
+                                      start=rng.uniform(size=3),
+                                      end=rng.uniform(size=3))]
+        events += [event]
+    return events
@@ -3,12 +3,24 @@ Compute the 3D Hough transform from a point cloud.
 Based on the algorithm described in Dalitz, Schramke, Jeltsch [2017].
 
 '''
+import time
 import numpy as np
 import sympy as sp
 
+from larpixreco.Metrics import metrics
 from larpixreco.RecoLogging import getLogger
 logger = getLogger(__name__)
 
+_iterations = metrics.counter('hough_iterations_total', 'iterative Hough iterations')
+_votes = metrics.counter('hough_votes_total', 'votes cast in Hough accumulators')
+_accumulator_size = metrics.histogram('hough_accumulator_bins',
+                                      'number of bins of new Hough accumulators',
+                                      buckets=(1e3, 1e4, 1e5, 1e6, 1e7, 1e8))
+_fit_time = metrics.histogram('hough_fit_seconds', 'time to compute line fit errors')
+_planned = dict((action, metrics.counter('hough_plan_{}_total'.format(action),
+                                         'accumulators planned with action {}'.format(action)))
+                for action in ('narrow', 'coarsen', 'skip'))
+
 class Line(object):
     '''A line in 3D.'''
 
@@ -307,6 +319,9 @@ class HoughParameters(object):
 
         The found_mask boolean array tells which points have already
         been assigned to a line (True) or have not yet (False).
+
+        The dtype of the accumulator array is float64 unless dtype is
+        set (see ``plan_accumulator``).
     '''
     def __init__(self):
         self.ndirections = None
@@ -316,6 +331,7 @@ class HoughParameters(object):
         self.translation = None
         self.accumulator = None
         self.dr = None
+        self.dtype = None
 
         self.found_mask = None
 
@@ -361,14 +377,16 @@ def compute_hough(points, params, op='+'):
         params.accumulator = np.zeros((
             len(test_directions),
             len(xp_edges) - 1,
-            len(yp_edges) - 1))
+            len(yp_edges) - 1), dtype=params.dtype)
         accumulator = params.accumulator
+        _accumulator_size.observe(accumulator.size)
     else:
         accumulator = params.accumulator
     max_xp_i = accumulator.shape[1] - 1
     max_yp_i = accumulator.shape[2] - 1
 
     # Compute the Hough transformation
+    _votes.inc(len(points) * len(test_directions))
     for point in points:
         for i, (theta, phi) in enumerate(test_directions):
                 xp, yp = compute_xp_yp(theta, phi, *point)
@@ -384,6 +402,76 @@ def compute_hough(points, params, op='+'):
 
     return params
 
+class AccumulatorPlan(object):
+    '''
+        The accumulator size and number of votes estimated by
+        ``plan_accumulator`` for a point cloud, with the dtype and dr
+        chosen to fit a memory budget.
+
+        The action is one of:
+         - ``'none'``: the float64 accumulator fits
+         - ``'narrow'``: the smallest integer dtype that can hold the
+           votes fits (the lines found are unchanged)
+         - ``'coarsen'``: dr is increased so that the narrow accumulator
+           fits (the lines found can change)
+         - ``'skip'``: the accumulator does not fit, even with the
+           largest dr allowed
+    '''
+    def __init__(self, npoints, ndirections, npositions, dr, dtype, action):
+        self.npoints = npoints
+        self.ndirections = ndirections
+        self.npositions = npositions
+        self.dr = dr
+        self.dtype = dtype
+        self.action = action
+        self.nbytes = ndirections * npositions**2 * np.dtype(dtype).itemsize
+        self.nvotes = npoints * ndirections
+
+def count_positions(points, dr):
+    '''
+        Return the number of x-prime/y-prime bins that
+        ``get_xp_yp_edges`` creates for the point cloud.
+    '''
+    ranges = 0.5 * (points.max(axis=0) - points.min(axis=0))
+    return int(np.ceil(np.linalg.norm(ranges)/dr))
+
+def vote_dtype(npoints):
+    '''
+        Return the smallest signed integer dtype that can hold the votes
+        of npoints points in a bin.
+    '''
+    for dtype in ('i1', 'i2', 'i4'):
+        if npoints <= np.iinfo(dtype).max:
+            return dtype
+    return 'i8'
+
+def plan_accumulator(points, ndirections, dr, max_bytes=None, max_dr=None):
+    '''
+        Estimate the accumulator size for the given points before it is
+        allocated, and return an ``AccumulatorPlan`` that fits the
+        accumulator into max_bytes: first with a narrower dtype, then
+        with a coarser dr (up to max_dr), or else by skipping the points.
+    '''
+    npoints = len(points)
+    npositions = count_positions(points, dr)
+    plan = AccumulatorPlan(npoints, ndirections, npositions, dr, 'f8', 'none')
+    if max_bytes is None or plan.nbytes <= max_bytes:
+        return plan
+    dtype = vote_dtype(npoints)
+    plan = AccumulatorPlan(npoints, ndirections, npositions, dr, dtype, 'narrow')
+    if plan.nbytes > max_bytes:
+        max_positions = int(np.sqrt(max_bytes / (ndirections * np.dtype(dtype).itemsize)))
+        range_dist = npositions * dr
+        coarse_dr = range_dist / max(max_positions, 1) * (1 + 1e-9)
+        if max_positions < 1 or (max_dr is not None and coarse_dr > max_dr):
+            plan.action = 'skip'
+        else:
+            plan = AccumulatorPlan(npoints, ndirections,
+                                   count_positions(points, coarse_dr), coarse_dr,
+                                   dtype, 'coarsen')
+    _planned[plan.action].inc()
+    return plan
+
 def line_accumulator_max(params):
     '''
         Return the line specified by the maximum bin in the accumulator.
@@ -671,9 +759,12 @@ def run_iterative_hough(points, params, threshold, cache=None):
         closer, farther, params, mask, best_fit_line = (
                 iterate_hough_once(points, params, threshold,
                     undo_points))
+        _iterations.inc()
         found_good_line = (closer is not None)
         if found_good_line:
+            start_time = time.perf_counter()
             best_fit_line.cov = fit_errors(closer, best_fit_line, cache)
+            _fit_time.observe(time.perf_counter() - start_time)
             start, end = get_endpoints(best_fit_line, closer)
             best_fit_line.start = start
             best_fit_line.end = end
@@ -682,6 +773,6 @@ def run_iterative_hough(points, params, threshold, cache=None):
                     not found_mask[i]]]
             for i in lines[best_fit_line]:
                 found_mask[i] = True
-            logger.debug('found good line with %d points' % len(closer))
+            logger.debug('found good line with %d points', len(closer))
 
     return lines, points, params
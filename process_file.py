@@ -1,38 +1,194 @@
 import argparse
+import itertools
+import time
 from larpixreco.EventBuilder import EventBuilder
-from larpixreco.Reconstruction import TrackReconstruction
+from larpixreco.HitParser import expand_filenames
+from larpixreco.Reconstruction import TrackReconstruction, ReconstructionChain
 from larpixreco.RecoFile import RecoFile
 from larpixreco.RecoLogging import initializeLogger
+from larpixreco.ChannelMask import NoisyChannelMask
+from larpixreco.Calibration import Calibration
+from larpixreco.EventPlanner import process_parallel
+from larpixreco.EventFilter import EventFilter
+from larpixreco.Pipeline import run_pipeline
+from larpixreco.Metrics import metrics
+from larpixreco.Checkpoint import save_checkpoint, resume_event_builder
+from larpixreco.RecoCache import RecoCache
 
 parser = argparse.ArgumentParser()
 parser.add_argument('infile')
 parser.add_argument('outfile')
 parser.add_argument('-l', '--logfile', default=None)
 parser.add_argument('-n', '--num', default=-1, type=int, help='num events to process')
+parser.add_argument('--sort_mode', default='buffer', choices=['buffer', 'external'],
+                    help='hit sorting method (default: %(default)s), a valid hit cache '
+                    'of the input file (see HitCache.ingest) is read instead')
+parser.add_argument('--sort_memory', default=256, type=float,
+                    help='memory limit for external sort in MB (default: %(default)s, '
+                    'not used with a hit cache)')
+parser.add_argument('--noise_threshold', default=None, type=float,
+                    help='mask channels with a hit rate above this threshold in Hz')
+parser.add_argument('--calibration', default=None,
+                    help='per-channel calibration table (see Calibration.from_file)')
+parser.add_argument('--block_mode', action='store_true',
+                    help='find event boundaries for whole hit blocks at once')
+parser.add_argument('--nhit', nargs=2, default=None, type=int, metavar=('MIN', 'MAX'),
+                    help='only reconstruct events with MIN to MAX hits')
+parser.add_argument('--min_q', default=None, type=float,
+                    help='only reconstruct events with at least this total charge')
+parser.add_argument('--chipids', nargs='+', default=None, type=int,
+                    help='only reconstruct events with hits on any of these chips')
+parser.add_argument('--async_write', action='store_true',
+                    help='write output in a background thread')
+parser.add_argument('-j', '--processes', default=1, type=int,
+                    help='build and reconstruct row ranges of the input file in '
+                    'parallel, writing one shard per range (ignores --num)')
+parser.add_argument('-w', '--workers', default=0, type=int,
+                    help='reconstruct events in this many worker processes, with a '
+                    'separate reader process and ordered output (ignores --num)')
+parser.add_argument('--chain', default=None,
+                    help='JSON config of the reconstruction stages (see '
+                    'ReconstructionChain, default: TrackReconstruction)')
+parser.add_argument('--result_cache', default=None,
+                    help='cache directory of track reconstruction results, reused for '
+                    'events with unchanged hits (default chain only)')
+parser.add_argument('--result_cache_size', default=1000, type=float,
+                    help='size limit of the result cache in MB (default: %(default)s)')
+parser.add_argument('--max_accumulator_mb', default=None, type=float,
+                    help='memory budget of the Hough accumulator of an event, larger '
+                    'events use a narrower dtype, coarser bins, or are skipped '
+                    '(default chain only)')
+parser.add_argument('--max_dr_mm', default=None, type=float,
+                    help='largest Hough bin size used to fit --max_accumulator_mb')
+parser.add_argument('--trace_memory', action='store_true',
+                    help='measure the peak memory of each stage per event with tracemalloc')
+parser.add_argument('--profile_prefix', default=None,
+                    help='write stats of profiled stages to <prefix>.<stage>.prof')
+parser.add_argument('--metrics_file', default=None,
+                    help='periodically write throughput metrics to this file (metrics '
+                    'of -j/-w child processes are not included)')
+parser.add_argument('--metrics_format', default='json', choices=metrics.formats,
+                    help='metrics file format (default: %(default)s)')
+parser.add_argument('--metrics_interval', default=10, type=float,
+                    help='seconds between metrics file updates (default: %(default)s)')
+parser.add_argument('--checkpoint_interval', default=600, type=float,
+                    help='seconds between checkpoints of the output file (default: '
+                    '%(default)s)')
+parser.add_argument('--resume', action='store_true',
+                    help='continue from the last checkpoint of outfile')
 args = parser.parse_args()
+if args.resume and (args.processes > 1 or args.workers > 0):
+    parser.error('--resume can not be combined with -j or -w')
+if args.resume and len(expand_filenames(args.infile)) != 1:
+    parser.error('--resume requires a single input file')
+if args.profile_prefix is not None and (args.processes > 1 or args.workers > 0):
+    parser.error('--profile_prefix can not be combined with -j or -w')
 
 infile = args.infile
 outfile = args.outfile
 n_events = args.num
 logger = initializeLogger(level='debug', filename=args.logfile)
-eb = EventBuilder(infile, sort_buffer_length=100)
-track_reco = TrackReconstruction()
-outfile = RecoFile(outfile, opt='o')
+metrics.configure(args.metrics_file, format=args.metrics_format,
+                  interval=args.metrics_interval)
+def make_chain():
+    if args.chain is not None:
+        chain = ReconstructionChain.from_file(args.chain)
+    else:
+        result_cache = None
+        if args.result_cache is not None:
+            result_cache = RecoCache(args.result_cache,
+                                     max_bytes=int(args.result_cache_size*1e6))
+        chain = ReconstructionChain([TrackReconstruction(
+                    result_cache=result_cache, max_accumulator_mb=args.max_accumulator_mb,
+                    max_dr_mm=args.max_dr_mm)])
+    chain.trace_memory = chain.trace_memory or args.trace_memory
+    return chain
+def make_reconstructions():
+    return [make_chain()]
+hit_stages = []
+if args.calibration is not None:
+    hit_stages += [Calibration.from_file(args.calibration)]
+if args.noise_threshold is not None:
+    noise_mask = NoisyChannelMask(threshold=args.noise_threshold)
+    noise_mask.fit_file(infile)
+    hit_stages += [noise_mask]
+event_filter = None
+if args.nhit is not None or args.min_q is not None or args.chipids is not None:
+    event_filter = EventFilter(nhit=args.nhit,
+                               q=None if args.min_q is None else (args.min_q, None),
+                               chipids=args.chipids)
+builder_kwargs = dict(sort_buffer_length=100, sort_mode=args.sort_mode,
+                      sort_memory=int(args.sort_memory*1e6), hit_stages=hit_stages,
+                      block_mode=args.block_mode, event_filter=event_filter)
+track_reco = make_chain()
+# stages with run totals that are stored with each checkpoint
+checkpoint_stages = [stage for stage in (event_filter, track_reco) if stage is not None]
+
+def write_metadata(outfile):
+    ''' Store the run totals in outfile and close it '''
+    if args.noise_threshold is not None:
+        noise_mask.write(outfile)
+    if event_filter is not None:
+        event_filter.write(outfile)
+    track_reco.write(outfile)
+    for name, stage_summary in track_reco.summary().items():
+        logger.info('{}: {}'.format(name, stage_summary))
+    if args.profile_prefix is not None:
+        track_reco.dump_profiles(args.profile_prefix)
+    outfile.close()
+    metrics.dump()
+
+if args.processes > 1 or args.workers > 0:
+    # run totals of the child processes are added to the stages of this process
+    stages = [stage for stage in hit_stages + checkpoint_stages if hasattr(stage, 'read')]
+    if args.processes > 1:
+        n_processed = process_parallel(infile, outfile, processes=args.processes,
+                                       make_reconstructions=make_reconstructions,
+                                       recofile_kwargs=dict(async_write=args.async_write),
+                                       stages=stages, start_method='fork',
+                                       **builder_kwargs) # script is not import-safe
+    else:
+        n_processed = run_pipeline(infile, outfile, processes=args.workers,
+                                   make_reconstructions=make_reconstructions,
+                                   builder_kwargs=builder_kwargs,
+                                   recofile_kwargs=dict(async_write=args.async_write),
+                                   stages=stages, start_method='fork')['n_events']
+    logger.info('processed {} events'.format(n_processed))
+    write_metadata(RecoFile(outfile, opt='a'))
+    raise SystemExit(0)
+if args.resume:
+    outfile = RecoFile(outfile, opt='a', async_write=args.async_write)
+    eb, checkpoint = resume_event_builder(outfile, infile, stages=checkpoint_stages,
+                                          **builder_kwargs)
+else:
+    eb = EventBuilder(infile, **builder_kwargs)
+    outfile = RecoFile(outfile, opt='o', async_write=args.async_write)
 
-curr_event = None
 n_processed = 0
+last_event = None
+last_checkpoint = time.monotonic()
+events = eb.iter_events()
+if n_events >= 0:
+    events = itertools.islice(events, n_events)
 while True:
-    if n_events >= 0 and n_processed >= n_events:
+    # reconstruct one write queue of events at a time, with the batch method of
+    # stages that have one
+    batch = list(itertools.islice(events, outfile.write_queue_length))
+    if len(batch) == 0:
         break
+    track_reco.do_batch_reconstruction(batch)
 
-    curr_event = eb.get_next_event()
-    if curr_event is None:
-        break
-    if curr_event.evid % 100 == 0:
-        logger.info('ev {} hit {}/{}'.format(curr_event.evid, eb.data.sort_buffer_idx, eb.data.nrows))
-
-    track_reco.do_reconstruction(curr_event)
-
-    outfile.queue(curr_event)
-    n_processed += 1
-outfile.flush()
+    for curr_event in batch:
+        if curr_event.evid % 100 == 0:
+            logger.info('ev {} hit {}/{}'.format(curr_event.evid, eb.data.sort_buffer_idx, eb.data.nrows))
+        outfile.queue(curr_event)
+    track_reco.write_records(outfile)
+    n_processed += len(batch)
+    last_event = batch[-1]
+    metrics.maybe_dump()
+    if time.monotonic() - last_checkpoint >= args.checkpoint_interval:
+        save_checkpoint(outfile, eb, last_event, stages=checkpoint_stages)
+        last_checkpoint = time.monotonic()
+if last_event is not None:
+    save_checkpoint(outfile, eb, last_event, stages=checkpoint_stages)
+write_metadata(outfile)
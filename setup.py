@@ -29,4 +29,5 @@ setup(
         keywords='dune physics',
         packages=['larpixreco'],
         install_requires=['pytest', 'h5py', 'numpy', 'sympy'],
+        extras_require={'arrow': ['pyarrow']},
 )
@@ -0,0 +1,11 @@
+import pytest
+import os.path
+from larpixreco.SyntheticData import write_file
+
+@pytest.fixture(scope='session', autouse=True)
+def synthetic_datafile():
+    ''' Generate the raw data file used by the tests, if it does not exist '''
+    filename = os.path.join(os.path.dirname(__file__), 'test_datafile.h5')
+    if not os.path.exists(filename):
+        write_file(filename, n_rows=20000, max_delay=5000, seed=0)
+    return filename
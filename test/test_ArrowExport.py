@@ -0,0 +1,48 @@
+import pytest
+import numpy as np
+from larpixreco.RecoFile import RecoFile
+from larpixreco.RecoReader import RecoReader
+from test_RecoFile import make_event
+pa = pytest.importorskip('pyarrow')
+pq = pytest.importorskip('pyarrow.parquet')
+from larpixreco.ArrowExport import *
+
+@pytest.mark.parametrize('format_version', [1, 2, 3])
+def test_export_parquet(tmpdir, format_version):
+    filename = str(tmpdir.join('reco.h5'))
+    recofile = RecoFile(filename, format_version=format_version)
+    for evid in range(10):
+        recofile.queue(make_event(evid))
+    recofile.close()
+
+    filenames = export_parquet(filename, batch_rows=8)
+    assert ('track_hits' in filenames) == (format_version == 3)
+    with RecoReader(filename) as reader:
+        for dataset_name in ('events', 'tracks', 'hits'):
+            table = pq.read_table(filenames[dataset_name])
+            view = getattr(reader, dataset_name)
+            assert table.num_rows == len(view)
+            metadata = pq.ParquetFile(filenames[dataset_name]).metadata
+            assert metadata.num_row_groups == (len(view) + 7) // 8
+            assert metadata.row_group(0).column(0).statistics.has_min_max
+        tracks = pq.read_table(filenames['tracks'])
+        assert pa.types.is_fixed_size_list(tracks.schema.field('start').type)
+        assert np.array_equal(np.array(tracks['end'].to_pylist()), reader.tracks[:]['end'])
+        field = 'hit_start' if format_version < 3 else 'assoc_start'
+        assert tracks[field].to_pylist() == reader.index['track_' + field].tolist()
+        hits = pq.read_table(filenames['hits'])
+        assert hits['event_idx'].to_pylist() == \
+            np.repeat(np.arange(10), len(hits) // 10).tolist()
+        assert 'event_ref' not in hits.column_names
+
+def test_export_flatten(tmpdir):
+    filename = str(tmpdir.join('reco.h5'))
+    recofile = RecoFile(filename, format_version=2)
+    recofile.write(make_event(0))
+    recofile.close()
+    with RecoReader(filename) as reader:
+        batches = list(iter_record_batches(reader, 'tracks', vector_mode='flatten'))
+    assert len(batches) == 1
+    assert batches[0].column(batches[0].schema.get_field_index('start_z')).to_pylist() \
+        == [0., 0.]
+    assert not 'start' in batches[0].schema.names
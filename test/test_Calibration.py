@@ -0,0 +1,35 @@
+import pytest
+import numpy as np
+import larpixreco
+from larpixreco.Calibration import *
+from larpixreco.HitParser import HitParser
+
+def test_calibrate_block(tmpdir):
+    table_filename = str(tmpdir.join('calib.txt'))
+    with open(table_filename, 'w') as table:
+        table.write('chipid channelid pedestal gain geom px\n')
+        table.write('1 2 10 2 7 123.5\n')
+        table.write('3 4 -1 0.5 8 nan\n')
+    calibration = Calibration.from_file(table_filename)
+
+    block = np.zeros(3, dtype=HitParser.hit_block_desc)
+    block['chipid'] = [1, 3, 5]
+    block['channelid'] = [2, 4, 6]
+    block['q'] = 20
+    block['px'] = 1
+    block = calibration(block)
+    assert block['q'].tolist() == [20, 10.5, 20]
+    assert block['geom'].tolist() == [7, 8, HitParser.empty_value]
+    assert block['px'].tolist() == [123.5, 1, 1]
+
+    with pytest.raises(ValueError):
+        Calibration.from_arrays([0], [0], not_a_field=[0])
+
+def test_calibrate_large_ids():
+    calibration = Calibration.from_arrays([300], [70], gain=[2])
+    block = np.zeros(3, dtype=HitParser.hit_block_desc)
+    block['chipid'] = [300, 1, 500]
+    block['channelid'] = [70, 2, 100]
+    block['q'] = 10
+    block = calibration(block)
+    assert block['q'].tolist() == [20, 10, 10]
@@ -0,0 +1,64 @@
+import pytest
+import numpy as np
+import larpixreco
+from larpixreco.ChannelMask import *
+from larpixreco.HitParser import HitParser
+from larpixreco.RecoFile import RecoFile
+
+def make_block(ts, chipid, channelid):
+    block = np.zeros(len(ts), dtype=HitParser.hit_block_desc)
+    block['ts'] = ts
+    block['chipid'] = chipid
+    block['channelid'] = channelid
+    return block
+
+def test_fit_and_mask(tmpdir):
+    # 1 ms of data, channel (3, 7) fires at 1 MHz, channel (2, 5) at 10 kHz
+    hot_ts = np.arange(0, 1000000, 1000)
+    quiet_ts = np.arange(0, 1000000, 100000)
+    block = make_block(np.concatenate((hot_ts, quiet_ts)),
+                       np.concatenate((np.full(len(hot_ts), 3), np.full(len(quiet_ts), 2))),
+                       np.concatenate((np.full(len(hot_ts), 7), np.full(len(quiet_ts), 5))))
+    mask = NoisyChannelMask(threshold=1e5)
+    mask.fit(block['chipid'], block['channelid'], block['ts'])
+    assert mask.masked_channels.tolist() == [[3, 7]]
+    masked_block = mask(block)
+    assert len(masked_block) == len(quiet_ts)
+    assert mask.n_masked_hits == len(hot_ts)
+
+    recofile = RecoFile(str(tmpdir.join('reco.h5')))
+    mask.write(recofile)
+    assert recofile.datafile['info'].attrs['noisy_channels'].tolist() == [[3, 7]]
+
+def test_rolling_window():
+    ts = np.arange(0, 3000000, 1000)
+    chipid = np.where(ts < 1000000, 1, 0)
+    mask = NoisyChannelMask(threshold=1e5, window=500000)
+    blocks = [make_block(ts[i:i+250], chipid[i:i+250], 0) for i in range(0, len(ts), 250)]
+    masked = [mask(block) for block in blocks]
+    # chip 1 is masked after the first window, chip 0 after it becomes noisy
+    assert np.all(masked[0]['chipid'] == 1)
+    assert mask.n_masked_hits > 0
+    assert mask.masked_channels.tolist() == [[0, 0]]
+
+def test_rolling_window_block_length():
+    ts = np.arange(0, 1500000, 1000)
+    chipid = np.where(ts < 500000, 1, 0)
+    # a single block spanning three windows is masked as blocks within windows
+    mask = NoisyChannelMask(threshold=1e5, window=500000)
+    masked = mask(make_block(ts, chipid, 0))
+    block_mask = NoisyChannelMask(threshold=1e5, window=500000)
+    block_masked = np.concatenate([block_mask(make_block(ts[i:i+100], chipid[i:i+100], 0))
+                                   for i in range(0, len(ts), 100)])
+    assert np.array_equal(masked, block_masked)
+    # chip 0 is masked in the third window only
+    assert np.count_nonzero(masked['chipid'] == 0) == 500
+    assert mask.n_masked_hits == 500
+
+def test_large_ids():
+    mask = NoisyChannelMask(threshold=1e5)
+    block = make_block(np.arange(0, 1000000, 1000), 300, 70)
+    mask.fit(block['chipid'], block['channelid'], block['ts'])
+    assert mask.masked_channels.tolist() == [[300, 70]]
+    assert len(mask(make_block([0, 1], [1, 300], [2, 70]))) == 1
+    assert len(mask(make_block([0], [400], [80]))) == 1
@@ -0,0 +1,87 @@
+import pytest
+import h5py
+import numpy as np
+from larpixreco.HitParser import HitParser
+from larpixreco.EventBuilder import EventBuilder
+from larpixreco.RecoFile import RecoFile
+from larpixreco.SyntheticData import write_file
+from larpixreco.EventFilter import EventFilter
+from larpixreco.Reconstruction import ReconstructionChain, ShowerReconstruction
+from larpixreco.Checkpoint import *
+
+def written_events(filename):
+    with h5py.File(filename, 'r') as datafile:
+        return datafile['events'][:][['evid', 'nhit', 'ts_start', 'ts_end']], \
+            datafile['hits']['hid']
+
+@pytest.mark.parametrize('block_mode', [False, True])
+def test_resume(tmpdir, block_mode):
+    datafile = str(tmpdir.join('raw.h5'))
+    write_file(datafile, n_events=60, max_delay=20000, seed=6)
+
+    def make_stages():
+        return [EventFilter(nhit=(25, None)), ReconstructionChain([ShowerReconstruction()])]
+
+    reference = str(tmpdir.join('reference.h5'))
+    recofile = RecoFile(reference, opt='o')
+    reference_stages = make_stages()
+    for event in EventBuilder(datafile, use_cache=False, block_mode=block_mode,
+                              event_filter=reference_stages[0]).iter_events():
+        reference_stages[1].do_reconstruction(event)
+        recofile.queue(event)
+    recofile.close()
+    assert 0 < reference_stages[0].n_rejected < reference_stages[0].n_events
+
+    # run that writes events after its last checkpoint and is interrupted
+    outfile = str(tmpdir.join('reco.h5'))
+    recofile = RecoFile(outfile, opt='o', write_queue_length=3)
+    stages = make_stages()
+    eb = EventBuilder(datafile, use_cache=False, block_mode=block_mode,
+                      event_filter=stages[0])
+    eb.data.chunk_length = 100
+    for n_events, event in enumerate(eb.iter_events()):
+        stages[1].do_reconstruction(event)
+        recofile.queue(event)
+        if n_events == 20:
+            save_checkpoint(recofile, eb, event, stages=stages)
+        if n_events == 30:
+            break
+    recofile.close()
+    assert len(written_events(outfile)[0]) > 21
+
+    recofile = RecoFile(outfile, opt='a')
+    stages = make_stages()
+    eb, checkpoint = resume_event_builder(recofile, datafile, stages=stages,
+                                          block_mode=block_mode, event_filter=stages[0])
+    assert checkpoint['next_evid'] == written_events(reference)[0]['evid'][21]
+    assert recofile._nrows['events'] == 21
+    assert stages[1].n_events.tolist() == [21]
+    for event in eb.iter_events():
+        stages[1].do_reconstruction(event)
+        recofile.queue(event)
+    recofile.close()
+    for written, expected in zip(written_events(outfile), written_events(reference)):
+        assert np.all(written == expected)
+    assert (stages[0].n_events, stages[0].n_rejected) == \
+        (reference_stages[0].n_events, reference_stages[0].n_rejected)
+    assert stages[1].n_events.tolist() == reference_stages[1].n_events.tolist()
+
+def test_restart_row(tmpdir):
+    datafile = str(tmpdir.join('raw.h5'))
+    write_file(datafile, n_events=10, seed=7)
+    with h5py.File(datafile, 'r') as f:
+        ts = f['data'][:, HitParser._name2col_map['timestamp']]
+    last_ts = np.sort(ts)[len(ts) // 2]
+    row = restart_row(datafile, last_ts, block_length=7)
+    assert np.all(ts[:row] <= last_ts)
+    assert ts[row] > last_ts
+    assert restart_row(datafile, last_ts, hit_row=2) <= 3
+
+def test_no_checkpoint(tmpdir):
+    recofile = RecoFile(str(tmpdir.join('reco.h5')), opt='o')
+    assert recofile.read_checkpoint() is None
+    with pytest.raises(ValueError):
+        resume_event_builder(recofile, 'raw.h5')
+    with pytest.raises(ValueError):
+        resume_event_builder(recofile, ['raw_0.h5', 'raw_1.h5'])
+    recofile.close()
@@ -0,0 +1,84 @@
+import pytest
+import gc
+import weakref
+import numpy as np
+from larpixreco.EventBuilder import EventBuilder
+from test_HitParser import write_datafile
+
+def test_find_events():
+    ts = np.array([0, 1, 2, 3, 4, 5, 100, 101, 102, 200, 201, 202, 203, 204, 205, 206])
+    starts, stops = EventBuilder.find_events(ts, dt_cut=10, min_ev_len=3, max_ev_len=4)
+    assert starts.tolist() == [0, 6, 9, 13]
+    assert stops.tolist() == [4, 9, 13, 16]
+    starts, stops = EventBuilder.find_events(ts, dt_cut=10, min_ev_len=1, max_ev_len=100)
+    assert list(zip(starts, stops)) == [(0, 6), (6, 9), (9, 16)]
+    starts, stops = EventBuilder.find_events(np.array([], dtype='i8'))
+    assert len(starts) == 0
+
+def event_timestamps(seed=0):
+    rng = np.random.RandomState(seed)
+    ts = []
+    t0 = 0
+    for nhit in rng.randint(1, 30, size=40):
+        ts += list(t0 + np.sort(rng.randint(0, 5000, size=nhit)))
+        t0 += 100000
+    return np.array(ts)
+
+@pytest.mark.parametrize('block_mode', [False, True])
+def test_get_next_event(tmpdir, monkeypatch, block_mode):
+    monkeypatch.setattr(EventBuilder, 'max_ev_len', 20)
+    filename = str(tmpdir.join('data.h5'))
+    ts = event_timestamps()
+    write_datafile(filename, ts)
+    eb = EventBuilder(filename, sort_buffer_length=1, use_cache=False,
+                      block_mode=block_mode)
+    eb.data.chunk_length = 37
+    events = []
+    while True:
+        event = eb.get_next_event()
+        if event is None:
+            break
+        events += [event]
+    starts, stops = EventBuilder.find_events(ts)
+    assert [event.evid for event in events] == list(range(len(starts)))
+    assert [event.get_hit_attr('ts') for event in events] == \
+        [ts[start:stop].tolist() for start, stop in zip(starts, stops)]
+
+def test_iter_events_batches(tmpdir):
+    filename = str(tmpdir.join('data.h5'))
+    ts = event_timestamps()
+    write_datafile(filename, ts)
+    eb = EventBuilder(filename, use_cache=False)
+    batches = list(eb.iter_events(batch_size=4, window=3))
+    starts, stops = EventBuilder.find_events(ts)
+    assert [len(batch) for batch in batches[:-1]] == [4] * (len(batches) - 1)
+    assert sum(len(batch) for batch in batches) == len(starts)
+    assert [event.evid for event in eb.events] == \
+        [event.evid for event in batches[-1][-3:]]
+
+    eb = EventBuilder(filename, use_cache=False)
+    events = eb.iter_events(window=2)
+    first = [next(events) for _ in range(3)]
+    events.close()
+    assert isinstance(eb.events, list)
+    assert eb.events == first[1:]
+    eb.get_next_event()
+    eb.get_next_event()
+    assert [event.evid for event in eb.events] == [1, 2, 3, 4]
+
+@pytest.mark.parametrize('block_mode', [False, True])
+def test_iter_events_memory(tmpdir, block_mode):
+    filename = str(tmpdir.join('data.h5'))
+    n_events = 3000
+    ts = (np.arange(n_events)[:,np.newaxis] * 100000 + np.arange(10)).reshape(-1)
+    write_datafile(filename, ts)
+    eb = EventBuilder(filename, use_cache=False, block_mode=block_mode)
+    refs = []
+    for event in eb.iter_events(window=5):
+        refs += [weakref.ref(event)]
+    del event
+    gc.collect()
+    assert len(refs) == n_events
+    alive = [ref() for ref in refs if ref() is not None]
+    assert len(alive) <= 5
+    assert [event.evid for event in alive] == list(range(n_events - 5, n_events))
@@ -0,0 +1,50 @@
+import pytest
+import numpy as np
+from larpixreco.HitParser import HitParser
+from larpixreco.EventBuilder import EventBuilder
+from larpixreco.EventFilter import *
+from test_HitParser import write_datafile
+from test_EventBuilder import event_timestamps
+
+def make_block():
+    block = np.zeros(10, dtype=HitParser.hit_block_desc)
+    block['ts'] = [0, 1, 5, 100, 101, 102, 103, 200, 210, 230]
+    block['q'] = [1, 1, 1, 5, 5, 5, 5, 2, 2, 2]
+    block['chipid'] = [1, 1, 2, 3, 3, 3, 3, 1, 2, 3]
+    return block
+
+def test_select():
+    block = make_block()
+    starts, stops = [0, 3, 7], [3, 7, 10]
+    assert EventFilter(nhit=(4, None)).select(block, starts, stops).tolist() == \
+        [False, True, False]
+    assert EventFilter(time_span=(None, 10)).select(block, starts, stops).tolist() == \
+        [True, True, False]
+    assert EventFilter(q=(6, 20)).select(block, starts, stops).tolist() == \
+        [False, True, True]
+    assert EventFilter(chipids=[1]).select(block, starts, stops).tolist() == \
+        [True, False, True]
+    assert EventFilter(chipids=[1, 2], chip_mode='all').select(
+        block, starts, stops).tolist() == [True, False, True]
+    event_filter = EventFilter(chipids=[1, 2], chip_mode='only')
+    assert event_filter.select(block, starts, stops).tolist() == [True, False, False]
+    assert (event_filter.n_events, event_filter.n_rejected) == (3, 2)
+    with pytest.raises(ValueError):
+        EventFilter(chip_mode='none')
+
+@pytest.mark.parametrize('block_mode', [False, True])
+def test_event_builder_filter(tmpdir, block_mode):
+    filename = str(tmpdir.join('data.h5'))
+    ts = event_timestamps()
+    write_datafile(filename, ts)
+    event_filter = EventFilter(nhit=(10, 20))
+    eb = EventBuilder(filename, use_cache=False, block_mode=block_mode,
+                      event_filter=event_filter)
+    events = list(eb.iter_events())
+    starts, stops = EventBuilder.find_events(ts)
+    nhit = stops - starts
+    passed = np.nonzero((nhit >= 10) & (nhit <= 20))[0]
+    assert [event.evid for event in events] == passed.tolist()
+    assert [event.nhit for event in events] == nhit[passed].tolist()
+    assert event_filter.n_events == len(starts)
+    assert event_filter.n_rejected == len(starts) - len(passed)
@@ -0,0 +1,76 @@
+import pytest
+import numpy as np
+from larpixreco.EventBuilder import EventBuilder
+from larpixreco.EventPlanner import *
+from larpixreco.EventFilter import EventFilter
+from larpixreco.RecoReader import RecoReader
+from test_HitParser import write_datafile
+from test_EventBuilder import event_timestamps
+
+def shuffled_timestamps(seed=0):
+    ''' Event timestamps with local disorder in file order '''
+    ts = event_timestamps(seed)
+    rng = np.random.RandomState(seed)
+    return ts[np.argsort(np.arange(len(ts)) + rng.randint(0, 8, size=len(ts)))]
+
+def build_events(filename, **kwargs):
+    eb = EventBuilder(filename, sort_buffer_length=16, use_cache=False, **kwargs)
+    events = []
+    while True:
+        event = eb.get_next_event()
+        if event is None:
+            return events
+        events += [event]
+
+def test_find_cuts():
+    ts = np.array([0, 2, 1, 20, 21, 40, 30])
+    assert find_cuts(ts, -np.inf, np.inf, 10).tolist() == [0, 3, 7]
+    assert find_cuts(ts, 15, 35, 10).tolist() == []
+
+def test_plan_ranges(tmpdir):
+    filename = str(tmpdir.join('data.h5'))
+    ts = shuffled_timestamps()
+    write_datafile(filename, ts)
+    ranges = plan_ranges(filename, 4, block_length=64)
+    assert len(ranges) == 4
+    assert ranges[0][0] == 0 and ranges[-1][1] == len(ts)
+    for (start, stop), (next_start, next_stop) in zip(ranges[:-1], ranges[1:]):
+        assert stop == next_start
+        assert ts[:stop].max() + EventBuilder.dt_cut <= ts[stop:].min()
+
+    events = build_events(filename)
+    range_events = []
+    for row_range in ranges:
+        range_events += build_events(filename, row_range=row_range,
+                                     evid_offset=row_range[0])
+    assert [event.get_hit_attr('hid') for event in range_events] == \
+        [event.get_hit_attr('hid') for event in events]
+    evids = [event.evid for event in range_events]
+    assert evids == sorted(set(evids))
+
+def test_process_parallel(tmpdir):
+    filename = str(tmpdir.join('data.h5'))
+    outfile = str(tmpdir.join('reco.h5'))
+    write_datafile(filename, shuffled_timestamps())
+    events = build_events(filename, event_filter=EventFilter(nhit=(None, 15)))
+    event_filter = EventFilter()
+    n_events = process_parallel(filename, outfile, processes=2, n_ranges=3,
+                                reconstruct=False, block_length=64,
+                                sort_buffer_length=16,
+                                event_filter=EventFilter(nhit=(None, 15)),
+                                stages=[event_filter])
+    with RecoReader(outfile) as reader:
+        assert len(reader.events) == n_events == len(events)
+        # event ids are the same as in a serial run
+        assert reader.events['evid'].tolist() == [event.evid for event in events]
+    assert event_filter.n_events - event_filter.n_rejected == n_events
+    assert event_filter.n_rejected > 0
+
+def test_process_parallel_empty(tmpdir):
+    filename = str(tmpdir.join('data.h5'))
+    outfile = str(tmpdir.join('reco.h5'))
+    write_datafile(filename, np.zeros(0))
+    assert plan_ranges(filename, 2) == []
+    assert process_parallel(filename, outfile, processes=2) == 0
+    with RecoReader(outfile) as reader:
+        assert len(reader.events) == 0
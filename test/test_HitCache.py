@@ -0,0 +1,48 @@
+import pytest
+import os
+import numpy as np
+import larpixreco
+from larpixreco.HitCache import *
+from larpixreco.EventBuilder import EventBuilder
+from test_HitParser import write_datafile
+
+def test_ingest(tmpdir):
+    rng = np.random.RandomState(2)
+    filename = str(tmpdir.join('raw.h5'))
+    write_datafile(filename, rng.randint(0, 1e6, size=3000))
+    cache_filename = ingest(filename, index_step=100)
+    assert cache_filename == default_cache_filename(filename)
+    assert is_valid_cache(cache_filename, filename)
+
+    hp = CachedHitParser(cache_filename)
+    hp.chunk_length = 700
+    blocks = list(hp.iter_sorted_blocks())
+    ts = np.concatenate([block['ts'] for block in blocks])
+    assert len(ts) == 3000
+    assert np.all(np.diff(ts) >= 0)
+    assert hp.find_ts(ts[1234]) == np.searchsorted(ts, ts[1234])
+    hit = hp.get_next_sorted_hit()
+    assert hit.ts == ts[0]
+    assert hp.get_hit(hit.hid).ts == hit.ts
+
+    assert isinstance(EventBuilder(filename).data, CachedHitParser)
+    os.utime(filename, (0, 0))
+    assert not is_valid_cache(cache_filename, filename)
+    assert not isinstance(EventBuilder(filename).data, CachedHitParser)
+
+def test_glob_ignores_cache(tmpdir):
+    for idx in range(2):
+        write_datafile(str(tmpdir.join('run_{}.h5'.format(idx))), np.arange(100) + 1000*idx)
+    ingest(str(tmpdir.join('run_0.h5')))
+    eb = EventBuilder(str(tmpdir.join('run_*.h5')))
+    assert eb.data.filenames == [str(tmpdir.join('run_{}.h5'.format(idx))) for idx in range(2)]
+
+def test_cache_sort_options(tmpdir, caplog):
+    filename = str(tmpdir.join('raw.h5'))
+    write_datafile(filename, np.arange(100))
+    ingest(filename)
+    EventBuilder(filename)
+    assert not 'sort options are ignored' in caplog.text
+    eb = EventBuilder(filename, sort_mode='external')
+    assert isinstance(eb.data, CachedHitParser)
+    assert 'sort options are ignored' in caplog.text
@@ -2,6 +2,8 @@ import pytest
 import larpixreco
 from larpixreco.HitParser import *
 import os.path
+import h5py
+import numpy as np
 
 test_datafile = os.path.dirname(__file__) + '/test_datafile.h5'
 
@@ -23,3 +25,69 @@ def test_get_next_sorted_hit():
                                                                                                 incorrect_packets)
 
         
+def write_datafile(filename, timestamps, chipid=0, channelid=0):
+    ''' Write a minimal raw data file with the specified hit timestamps '''
+    data = np.zeros((len(timestamps), len(HitParser._col2name_map)))
+    data[:,HitParser._name2col_map['timestamp']] = timestamps
+    data[:,HitParser._name2col_map['chipid']] = chipid
+    data[:,HitParser._name2col_map['channelid']] = channelid
+    with h5py.File(filename, 'w') as datafile:
+        dataset = datafile.create_dataset('data', data=data)
+        dataset.attrs['descripiton'] = 'test'
+
+def test_convert_hit_block_to_hits():
+    block = np.zeros(2, dtype=HitParser.hit_block_desc)
+    block['hid'] = [3, 4]
+    block['iochain'] = [HitParser.empty_value, 1]
+    block['geom'] = HitParser.empty_value
+    hits = HitParser.convert_hit_block_to_hits(block)
+    assert [hit.hid for hit in hits] == [3, 4]
+    assert [hit.iochain for hit in hits] == [None, 1]
+    assert [hit.geom for hit in hits] == [None, None]
+    assert [hit.chipid for hit in hits] == [0, 0]
+
+def test_sort_buffer_blocks():
+    ts = np.array([3, 1, 2, 6, 4, 5, 9, 7, 8])
+    block = np.zeros(len(ts), dtype=HitParser.hit_block_desc)
+    block['ts'] = ts
+    blocks = [block[i:i+2] for i in range(0, len(block), 2)]
+    sorted_ts = np.concatenate([sorted_block['ts'] for sorted_block in
+                                sort_buffer_blocks(blocks, buffer_length=2)])
+    assert np.all(sorted_ts == np.sort(ts))
+
+def test_multi_file_merge(tmpdir):
+    rng = np.random.RandomState(0)
+    filenames = []
+    for file_idx in range(5):
+        filename = str(tmpdir.join('data_{}.h5'.format(file_idx)))
+        write_datafile(filename, np.sort(rng.randint(0, 1e6, size=3000)),
+                       chipid=file_idx)
+        filenames += [filename]
+    hp = MultiFileHitParser(str(tmpdir.join('data_*.h5')), sort_buffer_length=10)
+    hp.chunk_length = 100
+    assert hp.filenames == filenames
+    assert hp.nrows == 15000
+    hits = []
+    while True:
+        hit = hp.get_next_sorted_hit()
+        if hit is None: break
+        hits += [hit]
+    assert len(hits) == hp.nrows
+    assert len(set(hit.hid for hit in hits)) == hp.nrows
+    dts = np.diff([hit.ts for hit in hits])
+    assert np.all(dts >= 0)
+    assert hp.get_hit(3500).chipid == 1
+
+def test_external_sort(tmpdir):
+    rng = np.random.RandomState(1)
+    filename = str(tmpdir.join('unsorted.h5'))
+    write_datafile(filename, rng.randint(0, 1e6, size=5000))
+    hp = HitParser(filename, sort_mode='external',
+                   sort_memory=500*np.dtype(HitParser.hit_block_desc).itemsize)
+    hp.chunk_length = 300
+    blocks = list(hp.iter_sorted_blocks())
+    ts = np.concatenate([block['ts'] for block in blocks])
+    hids = np.concatenate([block['hid'] for block in blocks])
+    assert np.all(np.diff(ts) >= 0)
+    assert np.all(np.sort(hids) == np.arange(5000))
+    assert all(len(block) <= 500 for block in blocks)
@@ -0,0 +1,78 @@
+import pytest
+import json
+import numpy as np
+from larpixreco.Metrics import *
+from larpixreco.RecoFile import RecoFile
+from larpixreco.algorithms.hough import HoughParameters, compute_hough
+from test_RecoFile import make_event
+
+def test_counter_histogram():
+    registry = MetricsRegistry()
+    counter = registry.counter('a_total', 'a')
+    assert registry.counter('a_total') is counter
+    counter.inc()
+    counter.inc(4)
+    assert counter.value == 5
+    histogram = registry.histogram('b_seconds', buckets=(1, 10))
+    for value in (0.5, 1, 5, 20):
+        histogram.observe(value)
+    assert histogram.counts == [2, 1, 1]
+    assert histogram.count == 4
+    assert histogram.sum == 26.5
+    with registry.timer('b_seconds'):
+        pass
+    assert histogram.count == 5
+    registry.reset()
+    assert counter.value == 0
+    assert histogram.counts == [0, 0, 0]
+
+def test_dump(tmpdir):
+    registry = MetricsRegistry()
+    registry.counter('events_total', 'events').inc(10)
+    registry.histogram('t_seconds', buckets=(1,)).observe(2)
+    filename = str(tmpdir.join('metrics.json'))
+    registry.dump(filename)
+    with open(filename) as metrics_file:
+        snapshot = json.load(metrics_file)
+    assert snapshot['counters']['events_total'] == 10
+    assert snapshot['rates']['events_total'] > 0
+    assert snapshot['histograms']['t_seconds']['counts'] == [0, 1]
+
+    filename = str(tmpdir.join('metrics.prom'))
+    registry.dump(filename, format='prometheus')
+    with open(filename) as metrics_file:
+        lines = metrics_file.read().splitlines()
+    assert 'larpixreco_events_total 10' in lines
+    assert 'larpixreco_t_seconds_bucket{le="1"} 0' in lines
+    assert 'larpixreco_t_seconds_bucket{le="+Inf"} 1' in lines
+    assert 'larpixreco_t_seconds_count 1' in lines
+
+def test_maybe_dump(tmpdir):
+    registry = MetricsRegistry()
+    registry.maybe_dump() # no file configured
+    with pytest.raises(ValueError):
+        registry.configure('metrics.txt', format='txt')
+    filename = str(tmpdir.join('metrics.json'))
+    registry.configure(filename, interval=3600)
+    registry.maybe_dump()
+    assert not tmpdir.join('metrics.json').exists()
+    registry.configure(filename, interval=0)
+    registry.maybe_dump()
+    assert tmpdir.join('metrics.json').exists()
+
+def test_instrumentation(tmpdir):
+    metrics.reset()
+    params = HoughParameters()
+    params.ndirections = 10
+    params.dr = 1
+    points = np.random.RandomState(1).uniform(-5, 5, size=(7, 3))
+    compute_hough(points, params)
+    assert metrics.counters['hough_votes_total'].value == 70
+    assert metrics.histograms['hough_accumulator_bins'].count == 1
+
+    recofile = RecoFile(str(tmpdir.join('test_metrics.h5')), opt='o')
+    recofile.write(make_event(0))
+    nrows = sum(recofile._nrows.values())
+    recofile.close()
+    assert metrics.histograms['write_seconds'].count == 1
+    assert metrics.counters['rows_written_total'].value == nrows
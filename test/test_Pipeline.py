@@ -0,0 +1,147 @@
+import pytest
+import os
+import time
+import numpy as np
+import h5py
+from larpixreco.types import Track, Event, Hit
+from larpixreco.EventBuilder import EventBuilder
+from larpixreco.RecoReader import RecoReader
+from larpixreco.EventFilter import EventFilter
+from larpixreco.Reconstruction import ReconstructionChain
+from larpixreco.Pipeline import *
+from test_HitParser import write_datafile
+from test_EventBuilder import event_timestamps
+
+class FirstHitsTrack(object):
+    ''' Test reconstruction, adds a track of the first 3 hits and fails on some events '''
+    def __init__(self, fail_evids=(), crash_evids=(), hang_evids=()):
+        self.fail_evids = fail_evids
+        self.crash_evids = crash_evids
+        self.hang_evids = hang_evids
+
+    def do_reconstruction(self, event):
+        if event.evid in self.crash_evids:
+            os._exit(1)
+        if event.evid in self.hang_evids:
+            time.sleep(60)
+        if event.evid in self.fail_evids:
+            raise RuntimeError('test failure')
+        event.reco_objs += [Track(event.hits[:3], 0., 0., 0., 0.,
+                                  start=np.zeros(3), end=np.ones(3))]
+
+class BatchFirstHitsTrack(FirstHitsTrack):
+    '''
+    Test reconstruction, only reconstructs batches of events and fails on
+    batches of several events that contain one of `batch_fail_evids`
+    '''
+    def __init__(self, batch_fail_evids=()):
+        FirstHitsTrack.__init__(self)
+        self.batch_fail_evids = batch_fail_evids
+
+    def do_reconstruction(self, event):
+        raise RuntimeError('not run on single events')
+
+    def do_batch_reconstruction(self, events):
+        if len(events) > 1 and any(event.evid in self.batch_fail_evids for event in events):
+            raise RuntimeError('test failure')
+        for event in events:
+            FirstHitsTrack.do_reconstruction(self, event)
+
+def test_pack_events():
+    events = [Event(evid, [Hit(evid*10+i, i, i, 100*evid+i, 1., chipid=2)
+                           for i in range(5)]) for evid in range(3)]
+    for use_shared_memory in (False, True):
+        unpacked = unpack_events(*pack_events(events, use_shared_memory))
+        assert [event.evid for event in unpacked] == [0, 1, 2]
+        assert [event.get_hit_attr('hid') for event in unpacked] == \
+            [event.get_hit_attr('hid') for event in events]
+        assert unpacked[1].hits[0].chipid == 2
+
+def shm_segments():
+    return set(os.listdir('/dev/shm')) if os.path.isdir('/dev/shm') else set()
+
+@pytest.mark.parametrize('use_shared_memory', [False, True])
+def test_run_pipeline(tmpdir, use_shared_memory):
+    filename = str(tmpdir.join('data.h5'))
+    outfile = str(tmpdir.join('reco.h5'))
+    ts = event_timestamps()
+    write_datafile(filename, ts)
+    starts, stops = EventBuilder.find_events(ts)
+    segments = shm_segments()
+    counts = run_pipeline(filename, outfile, processes=3, batch_size=2,
+                          make_reconstructions=lambda: [FirstHitsTrack(fail_evids=[3],
+                                                                       crash_evids=[8])],
+                          use_shared_memory=use_shared_memory,
+                          builder_kwargs=dict(use_cache=False), start_method='fork',
+                          recofile_kwargs=dict(format_version=2), timeout=0.1)
+    assert counts['n_failed_events'] == 1
+    # the batch of events 8 and 9 is retried one event at a time, only 8 is lost
+    assert counts['n_lost_events'] == 1
+    assert counts['n_events'] == len(starts) - 1
+    assert shm_segments() <= segments
+    with RecoReader(outfile) as reader:
+        evids = reader.events['evid']
+        assert evids.tolist() == [evid for evid in range(len(starts)) if evid != 8]
+        assert len(reader.tracks_for(3)) == 0
+        assert len(reader.tracks_for(9)) == 1
+        assert reader.hits_for(reader.tracks_for(4)['track_id'][0])['hid'].tolist() == \
+            list(range(starts[4], starts[4] + 3))
+
+def test_run_pipeline_timeout(tmpdir):
+    filename = str(tmpdir.join('data.h5'))
+    outfile = str(tmpdir.join('reco.h5'))
+    ts = event_timestamps()
+    write_datafile(filename, ts)
+    starts, stops = EventBuilder.find_events(ts)
+    segments = shm_segments()
+    counts = run_pipeline(filename, outfile, processes=2, batch_size=3,
+                          make_reconstructions=lambda: [FirstHitsTrack(hang_evids=[4])],
+                          builder_kwargs=dict(use_cache=False), start_method='fork',
+                          recofile_kwargs=dict(format_version=2), timeout=0.1,
+                          batch_timeout=2.)
+    assert counts['n_lost_events'] == 1
+    assert counts['n_events'] == len(starts) - 1
+    assert shm_segments() <= segments
+    with RecoReader(outfile) as reader:
+        assert not 4 in reader.events['evid'].tolist()
+
+def test_run_pipeline_stages(tmpdir):
+    filename = str(tmpdir.join('data.h5'))
+    outfile = str(tmpdir.join('reco.h5'))
+    ts = event_timestamps()
+    write_datafile(filename, ts)
+    starts, stops = EventBuilder.find_events(ts)
+    event_filter = EventFilter()
+    chain = ReconstructionChain([FirstHitsTrack()])
+    counts = run_pipeline(filename, outfile, processes=2, batch_size=2,
+                          make_reconstructions=lambda: [ReconstructionChain([FirstHitsTrack()])],
+                          builder_kwargs=dict(use_cache=False, event_filter=EventFilter()),
+                          start_method='fork', recofile_kwargs=dict(format_version=2),
+                          timeout=0.1, stages=[event_filter, chain])
+    # the run totals of the reader and the workers are added to the stages
+    assert event_filter.n_events == len(starts)
+    assert event_filter.n_rejected == 0
+    assert chain.n_events.tolist() == [counts['n_events']] == [len(starts)]
+
+def test_run_pipeline_batch(tmpdir):
+    filename = str(tmpdir.join('data.h5'))
+    outfile = str(tmpdir.join('reco.h5'))
+    ts = event_timestamps()
+    write_datafile(filename, ts)
+    starts, stops = EventBuilder.find_events(ts)
+    counts = run_pipeline(filename, outfile, processes=2, batch_size=4,
+                          make_reconstructions=lambda: [ReconstructionChain(
+                    [BatchFirstHitsTrack(batch_fail_evids=[5])], record_events=True)],
+                          builder_kwargs=dict(use_cache=False), start_method='fork',
+                          recofile_kwargs=dict(format_version=2), timeout=0.1)
+    # the batch of event 5 is retried one event at a time
+    assert counts['n_failed_events'] == 0
+    with RecoReader(outfile) as reader:
+        assert all(len(reader.tracks_for(evid)) == 1 for evid in range(len(starts)))
+    with h5py.File(outfile, 'r') as datafile:
+        records = datafile['info/reco_stage_records'][:]
+    records = records[np.argsort(records['evid'])]
+    assert records['evid'].tolist() == list(range(len(starts)))
+    # the time of a batch is split evenly between its events
+    assert len(set(records['wall_time'][:4])) == 1
+    assert len(set(records['wall_time'][4:8])) == 4
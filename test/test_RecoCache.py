@@ -0,0 +1,72 @@
+import pytest
+import os
+import numpy as np
+from larpixreco.types import Event
+from larpixreco.EventBuilder import EventBuilder
+from larpixreco.SyntheticData import write_file
+from larpixreco.Reconstruction import TrackReconstruction
+import larpixreco.algorithms.hough as hough
+from larpixreco.RecoCache import *
+
+def test_get_put(tmpdir):
+    cache = RecoCache(str(tmpdir.join('cache')))
+    points = np.arange(12.).reshape(4, 3)
+    key = RecoCache.key('test', points, 10)
+    assert key == RecoCache.key('test', points.copy(), 10)
+    assert key != RecoCache.key('test', points, 11)
+    assert key != RecoCache.key('test', points.astype('f4'), 10)
+    assert cache.get(key) is None
+    cache.put(key, a=points, b=np.arange(3))
+    arrays = cache.get(key)
+    assert np.all(arrays['a'] == points)
+    assert np.all(arrays['b'] == np.arange(3))
+    assert (cache.n_hits, cache.n_misses) == (1, 1)
+    assert RecoCache(str(tmpdir.join('cache'))).nbytes == cache.nbytes > 0
+    cache.clear()
+    assert cache.get(key) is None
+
+def test_eviction(tmpdir):
+    cache = RecoCache(str(tmpdir.join('cache')))
+    keys = [RecoCache.key(idx) for idx in range(4)]
+    for idx, key in enumerate(keys[:3]):
+        cache.put(key, a=np.zeros(100))
+        os.utime(cache.filename(key), (idx, idx))
+    entry_bytes = cache.nbytes // 3
+    cache.get(keys[0]) # most recently used
+    cache.max_bytes = 3 * entry_bytes
+    cache.low_water = 0.75
+    cache.put(keys[3], a=np.zeros(100))
+    assert [cache.get(key) is None for key in keys] == [False, True, True, False]
+    assert cache.nbytes == 2 * entry_bytes
+
+def test_lines_arrays():
+    line = hough.Line(0.1, 0.2, 1., 2.)
+    line.cov, line.start, line.end = np.eye(4), np.zeros(3), np.ones(3)
+    other = hough.Line(0.3, 0.4, 3., 4.)
+    other.start, other.end = np.ones(3), np.zeros(3)
+    lines = arrays_to_lines(lines_to_arrays({line : np.array([0, 1, 2]),
+                                             other : np.array([5])}))
+    (new_line, idcs), (new_other, other_idcs) = lines.items()
+    assert new_line.coords() == line.coords()
+    assert np.all(new_line.cov == line.cov)
+    assert new_other.cov is None
+    assert idcs.tolist() == [0, 1, 2]
+    assert other_idcs.tolist() == [5]
+    assert arrays_to_lines(lines_to_arrays({})) == {}
+
+def test_track_reconstruction(tmpdir):
+    datafile = str(tmpdir.join('raw.h5'))
+    write_file(datafile, n_events=1, tracks_per_event=0, noise_rate=0, seed=9)
+    hits = next(EventBuilder(datafile, use_cache=False).iter_events()).hits
+    cache_dir = str(tmpdir.join('cache'))
+    tracks = []
+    for _ in range(2):
+        reco = TrackReconstruction(hough_ndir=50, result_cache=cache_dir)
+        tracks += [reco.do_reconstruction(Event(0, list(hits)))]
+    assert (reco.result_cache.n_hits, reco.result_cache.n_misses) == (1, 0)
+    assert len(tracks[0]) == len(tracks[1]) > 0
+    for track, cached_track in zip(*tracks):
+        assert [hit.hid for hit in track.hits] == [hit.hid for hit in cached_track.hits]
+        assert (track.theta, track.phi, track.xp, track.yp) == \
+            (cached_track.theta, cached_track.phi, cached_track.xp, cached_track.yp)
+        assert np.all(track.start == cached_track.start)
@@ -1,5 +1,6 @@
 import pytest
 import numpy as np
+import h5py
 import larpixreco
 from larpixreco.RecoFile import *
 
@@ -15,3 +16,160 @@ def test_larpixreco_type_to_hdf5_hit():
 def test_larpixreco_type_to_hdf5_error():
     with pytest.raises(TypeError):
         RecoFile.larpixreco_type_to_hdf5('this is not a valid larpixreco type')
+
+def make_event(evid, nhit=6):
+    hits = [larpixreco.types.Hit(evid*100+i, i, i, 1000*evid+i, 1, chipid=1,
+                                 channelid=i) for i in range(nhit)]
+    event = larpixreco.types.Event(evid, hits)
+    event.reco_objs += [
+        larpixreco.types.Track(hits[:3], 0.1, 0.2, 1., 2., cov=np.eye(4),
+                               start=np.zeros(3), end=np.ones(3)),
+        larpixreco.types.Track(hits[2:5], 0.1, 0.2, 1., 2.,
+                               start=np.zeros(3), end=np.ones(3))]
+    return event
+
+def test_flush(tmpdir):
+    recofile = RecoFile(str(tmpdir.join('reco.h5')), write_queue_length=4)
+    for evid in range(10):
+        recofile.queue(make_event(evid))
+    assert recofile.datafile['events'].shape[0] >= 8
+    recofile.close()
+
+    datafile = h5py.File(str(tmpdir.join('reco.h5')), 'r')
+    assert datafile['events'].shape[0] == 10
+    assert datafile['tracks'].shape[0] == 20
+    # 3 + 3 hits on tracks + 1 orphan hit per event
+    assert datafile['hits'].shape[0] == 70
+    event = datafile['events'][7]
+    assert event['evid'] == 7
+    assert sorted(set(datafile['hits'][event['hit_ref']]['hid'])) == \
+        list(range(700, 706))
+    track = datafile['tracks'][event['track_ref']][1]
+    assert datafile['hits'][track['hit_ref']]['hid'].tolist() == [702, 703, 704]
+    event_ref = datafile['hits'][track['hit_ref']][0]['event_ref']
+    assert datafile['events'][event_ref]['evid'] == 7
+
+def test_write_large_event_orphans(tmpdir):
+    recofile = RecoFile(str(tmpdir.join('reco.h5')))
+    event = make_event(0, nhit=5000)
+    recofile.write(event)
+    recofile.close()
+    datafile = h5py.File(str(tmpdir.join('reco.h5')), 'r')
+    hids = datafile['hits']['hid']
+    # hits 0-4 are written with tracks, remaining hits are orphans
+    assert len(hids) == 6 + 4995
+    assert sorted(set(hids)) == list(range(5000))
+
+def test_index_format(tmpdir):
+    filename = str(tmpdir.join('reco.h5'))
+    recofile = RecoFile(filename, write_queue_length=3, format_version=2)
+    for evid in range(10):
+        recofile.queue(make_event(evid))
+    recofile.close()
+
+    with pytest.raises(ValueError):
+        RecoFile(filename, opt='r', format_version=1)
+    recofile = RecoFile(filename, opt='r')
+    assert recofile.format_version == 2
+    events = recofile.datafile['events'][2:5]
+    hits, offsets = recofile.read_daughters(events, 'hits')
+    for i, event in enumerate(events):
+        assert sorted(set(hits[offsets[i]:offsets[i+1]]['hid'])) == \
+            list(range(event['evid']*100, event['evid']*100+6))
+        assert np.all(hits[offsets[i]:offsets[i+1]]['event_idx'] == 2+i)
+    tracks, offsets = recofile.read_daughters(events, 'tracks')
+    assert offsets.tolist() == [0, 2, 4, 6]
+    hits, offsets = recofile.read_daughters(tracks[1], 'hits')
+    assert hits['hid'].tolist() == [202, 203, 204]
+    assert np.all(hits['track_idx'] == tracks[1]['track_id'])
+
+@pytest.mark.parametrize('storage_profile', list(RecoFile.storage_profiles.keys()))
+@pytest.mark.parametrize('format_version', [1, 2])
+def test_storage_profiles(tmpdir, storage_profile, format_version):
+    filename = str(tmpdir.join('reco.h5'))
+    recofile = RecoFile(filename, format_version=format_version,
+                        storage_profile=storage_profile, expected_nevents=10)
+    for evid in range(10):
+        recofile.queue(make_event(evid))
+    recofile.close()
+    datafile = h5py.File(filename, 'r')
+    assert datafile.attrs['storage_profile'] == storage_profile
+    profile = RecoFile.storage_profiles[storage_profile]
+    assert datafile['hits'].compression == profile['compression']
+    if profile['chunk_bytes'] is not None:
+        assert datafile['events'].chunks == (10,)
+    assert sorted(set(datafile['hits']['hid'])) == \
+        [evid*100 + i for evid in range(10) for i in range(6)]
+
+def test_async_write(tmpdir):
+    sync = RecoFile(str(tmpdir.join('sync.h5')), write_queue_length=3)
+    async_file = RecoFile(str(tmpdir.join('async.h5')), write_queue_length=3,
+                          format_version=1, async_write=True, max_pending_batches=1)
+    for evid in range(20):
+        sync.queue(make_event(evid))
+        async_file.queue(make_event(evid))
+    sync.close()
+    async_file.close()
+    assert async_file._writer is None
+    with h5py.File(str(tmpdir.join('sync.h5')), 'r') as sync_data, \
+         h5py.File(str(tmpdir.join('async.h5')), 'r') as async_data:
+        for dataset_name in ('events', 'tracks', 'hits'):
+            assert async_data[dataset_name].shape == sync_data[dataset_name].shape
+        assert np.array_equal(async_data['hits']['hid'], sync_data['hits']['hid'])
+        assert np.array_equal(async_data['events']['evid'], np.arange(20))
+
+def test_async_write_error(tmpdir, monkeypatch):
+    recofile = RecoFile(str(tmpdir.join('reco.h5')), write_queue_length=1,
+                        async_write=True)
+    def fail(rows):
+        raise IOError('disk full')
+    monkeypatch.setattr(recofile, '_write_rows', fail)
+    recofile.queue(make_event(0))
+    with pytest.raises(IOError):
+        recofile.flush()
+    monkeypatch.undo()
+    recofile.queue(make_event(1))
+    recofile.close()
+    with h5py.File(str(tmpdir.join('reco.h5')), 'r') as datafile:
+        assert datafile['events'].shape[0] == 1
+
+def test_close_writer_error(tmpdir, monkeypatch):
+    recofile = RecoFile(str(tmpdir.join('reco.h5')), write_queue_length=1,
+                        async_write=True)
+    recofile.queue(make_event(0))
+    recofile.flush()
+    def fail(rows):
+        raise IOError('disk full')
+    monkeypatch.setattr(recofile, '_write_rows', fail)
+    recofile.queue(make_event(1))
+    with pytest.raises(IOError):
+        recofile.close()
+    # the file is closed and trimmed despite the error
+    assert recofile.datafile is None
+    assert recofile._writer is None
+    recofile.close()
+    with h5py.File(str(tmpdir.join('reco.h5')), 'r') as datafile:
+        assert datafile['events'].shape[0] == 1
+
+def test_association_format(tmpdir):
+    recofile = RecoFile(str(tmpdir.join('reco.h5')), write_queue_length=4,
+                        format_version=3)
+    for evid in range(10):
+        recofile.queue(make_event(evid))
+    recofile.close()
+
+    recofile = RecoFile(str(tmpdir.join('reco.h5')), opt='r')
+    assert recofile.format_version == 3
+    datafile = recofile.datafile
+    # each event hit is stored once, hit 2 is shared by both tracks
+    assert datafile['hits'].shape[0] == 60
+    assert datafile['track_hits'].shape[0] == 60
+    event = datafile['events'][4]
+    assert datafile['hits']['hid'][event['hit_start']:event['hit_stop']].tolist() \
+        == list(range(400, 406))
+    tracks = datafile['tracks'][event['track_start']:event['track_stop']]
+    hits, offsets = recofile.read_daughters(tracks, 'hits')
+    assert hits['hid'][offsets[0]:offsets[1]].tolist() == [400, 401, 402]
+    assert hits['hid'][offsets[1]:offsets[2]].tolist() == [402, 403, 404]
+    assert np.all(hits['event_idx'] == 4)
+    recofile.datafile.close()
@@ -0,0 +1,63 @@
+import pytest
+import os
+import numpy as np
+import larpixreco
+from larpixreco.RecoFile import RecoFile
+from larpixreco.RecoReader import *
+from test_RecoFile import make_event
+
+@pytest.mark.parametrize('format_version', [1, 2])
+def test_reader(tmpdir, format_version):
+    filename = str(tmpdir.join('reco.h5'))
+    recofile = RecoFile(filename, write_queue_length=4, format_version=format_version)
+    for evid in range(10):
+        recofile.queue(make_event(evid))
+    recofile.close()
+
+    reader = RecoReader(filename)
+    assert len(reader.events) == 10
+    assert reader.events[2:4]['evid'].tolist() == [2, 3]
+    assert reader.events[[5, 1]]['evid'].tolist() == [5, 1]
+    assert reader.column('hits', 'hid').shape == (70,)
+
+    tracks = reader.tracks_for(3)
+    assert len(tracks) == 2
+    assert reader.hits_for(tracks['track_id'][1])['hid'].tolist() == [302, 303, 304]
+    assert sorted(set(reader.hits_for_event(3)['hid'])) == list(range(300, 306))
+    hits, offsets = reader.hits_for_event([1, 7])
+    assert offsets.tolist() == [0, 7, 14]
+    assert set(hits['hid'][7:]) == set(range(700, 706))
+    tracks, offsets = reader.tracks_for(np.array([0, 9]))
+    assert offsets.tolist() == [0, 2, 4]
+    assert np.all(reader.index['track_event_idx'][tracks['track_id']] ==
+                  reader.event_rows([0, 0, 9, 9]))
+    with pytest.raises(KeyError):
+        reader.event(100)
+    reader.close()
+
+    assert os.path.exists(reader.index_filename) == (format_version == 1)
+    if format_version == 1:
+        reader = RecoReader(filename)
+        assert reader._load_index() is not None
+        reader.close()
+
+def test_reader_association(tmpdir):
+    filename = str(tmpdir.join('reco.h5'))
+    recofile = RecoFile(filename, write_queue_length=4, format_version=3)
+    for evid in range(5):
+        recofile.queue(make_event(evid))
+    recofile.close()
+
+    with RecoReader(filename) as reader:
+        tracks = reader.tracks_for(2)
+        assert reader.hits_for(tracks['track_id'][0])['hid'].tolist() == [200, 201, 202]
+        hits, offsets = reader.hits_for(tracks['track_id'])
+        assert offsets.tolist() == [0, 3, 6]
+        assert reader.hits_for_event(2)['hid'].tolist() == list(range(200, 206))
+        hit_rows = reader.event_rows(2) * 6 + np.arange(6)
+        track_rows, offsets = reader.tracks_for_hits(hit_rows)
+        assert np.diff(offsets).tolist() == [1, 1, 2, 1, 1, 0]
+        assert track_rows[2:4].tolist() == tracks['track_id'].tolist()
+        track_rows, offsets = reader.tracks_for_hits(hit_rows[2])
+        assert track_rows.tolist() == tracks['track_id'].tolist()
+        assert reader._hit_tracks is not None
@@ -0,0 +1,59 @@
+import pytest
+import numpy as np
+import h5py
+import larpixreco
+from larpixreco.RecoShards import *
+from larpixreco.RecoReader import RecoReader
+from test_RecoFile import make_event
+
+def test_consolidate(tmpdir):
+    filename = str(tmpdir.join('reco.h5'))
+    shards = []
+    for shard_idx in range(3):
+        recofile = open_shard(filename, shard_idx, write_queue_length=2)
+        for evid in range(shard_idx*4, shard_idx*4 + 4):
+            recofile.queue(make_event(evid))
+        recofile.close()
+        shards += [recofile.filename]
+    assert shards[1] == str(tmpdir.join('reco.shard0001.h5'))
+    nrows = consolidate(shards, filename)
+    assert nrows == {'events' : 12, 'tracks' : 24, 'hits' : 84}
+
+    reader = RecoReader(filename)
+    assert reader.events['evid'].tolist() == list(range(12))
+    assert reader.events[9]['hit_start'] == 63
+    tracks = reader.tracks_for(9)
+    assert tracks['event_idx'].tolist() == [9, 9]
+    assert tracks['track_id'].tolist() == [18, 19]
+    hits = reader.hits_for(19)
+    assert hits['hid'].tolist() == [902, 903, 904]
+    assert np.all(hits['track_idx'] == 19)
+    hits, offsets = reader.hits_for_event([3, 10])
+    assert set(hits['hid'][offsets[1]:]) == set(range(1000, 1006))
+    assert np.all(hits['event_idx'][offsets[1]:] == 10)
+    orphans = hits[hits['track_idx'] == -9999]
+    assert orphans['hid'].tolist() == [305, 1005]
+    reader.close()
+
+def test_consolidate_evid_counts(tmpdir):
+    filename = str(tmpdir.join('reco.h5'))
+    shards = []
+    for shard_idx in range(3):
+        recofile = open_shard(filename, shard_idx)
+        for evid in range(shard_idx + 1):
+            recofile.queue(make_event(evid))
+        recofile.write_table('records', np.arange(shard_idx + 1).astype([('evid', 'i8')]))
+        recofile.close()
+        shards += [recofile.filename]
+    consolidate(shards, filename, evid_counts=[2, 3, 3])
+    with RecoReader(filename) as reader:
+        assert reader.events['evid'].tolist() == [0, 2, 3, 5, 6, 7]
+    # info tables are concatenated and renumbered
+    with h5py.File(filename, 'r') as datafile:
+        assert datafile['info/records']['evid'].tolist() == [0, 2, 3, 5, 6, 7]
+    # consolidating again does not renumber the shards twice
+    consolidate(shards, filename, evid_counts=[2, 3, 3])
+    with RecoReader(filename) as reader:
+        assert reader.events['evid'].tolist() == [0, 2, 3, 5, 6, 7]
+    with h5py.File(filename, 'r') as datafile:
+        assert datafile['info/records']['evid'].tolist() == [0, 2, 3, 5, 6, 7]
@@ -0,0 +1,108 @@
+import pytest
+import json
+import numpy as np
+import larpixreco
+from larpixreco.Reconstruction import *
+from test_RecoFile import make_event
+
+class CountingReconstruction(Reconstruction):
+    ''' Test stage, adds n_objs copies of the first reco object '''
+    def __init__(self, n_objs=1):
+        Reconstruction.__init__(self)
+        self.n_objs = n_objs
+
+    def do_reconstruction(self, event):
+        event.reco_objs += [event.reco_objs[0]] * self.n_objs
+
+class BatchReconstruction(CountingReconstruction):
+    def do_batch_reconstruction(self, events):
+        self.n_batches = getattr(self, 'n_batches', 0) + 1
+        for event in events:
+            self.do_reconstruction(event)
+
+def test_reconstruction_chain(tmpdir):
+    config = {'record_events' : True, 'stages' : [
+            {'type' : 'test_Reconstruction:CountingReconstruction',
+             'kwargs' : {'n_objs' : 2}, 'profile' : True},
+            {'type' : 'test_Reconstruction:BatchReconstruction', 'name' : 'batch'},
+            {'type' : 'ShowerReconstruction'}]}
+    config_file = str(tmpdir.join('chain.json'))
+    with open(config_file, 'w') as f:
+        json.dump(config, f)
+    chain = ReconstructionChain.from_file(config_file)
+    assert chain.names == ['test_Reconstruction:CountingReconstruction', 'batch',
+                           'ShowerReconstruction']
+
+    chain.do_reconstruction(make_event(0))
+    events = [make_event(evid) for evid in range(1, 4)]
+    chain.do_batch_reconstruction(events)
+    assert chain.stages[1].n_batches == 1
+    assert [len(event.reco_objs) for event in events] == [5, 5, 5]
+
+    summary = chain.summary()
+    assert summary['batch']['n_events'] == 4
+    assert summary['batch']['n_objs'] == 4
+    assert summary['test_Reconstruction:CountingReconstruction']['n_objs'] == 8
+    assert summary['ShowerReconstruction']['wall_time'] >= 0
+    records = chain.records_array()
+    assert len(records) == 12
+    assert records[records['stage'] == 0]['n_objs'].tolist() == [2] * 4
+    assert records[records['stage'] == 1]['evid'].tolist() == [0, 1, 2, 3]
+    stats = chain.profile_stats(0)
+    assert stats.total_calls > 0
+    with pytest.raises(ValueError):
+        ReconstructionChain.from_config({'stages' : [{'type' : 'Unknown'}]})
+
+class AllocatingReconstruction(Reconstruction):
+    ''' Test stage, temporarily allocates nbytes '''
+    def __init__(self, nbytes):
+        Reconstruction.__init__(self)
+        self.nbytes = nbytes
+
+    def do_reconstruction(self, event):
+        np.ones(self.nbytes, dtype='u1').sum()
+
+def test_trace_memory():
+    chain = ReconstructionChain([AllocatingReconstruction(int(4e6)),
+                                 AllocatingReconstruction(int(1e6))],
+                                names=['large', 'small'], record_events=True,
+                                trace_memory=True)
+    chain.do_reconstruction(make_event(0))
+    summary = chain.summary()
+    assert summary['large']['peak_bytes'] >= 4e6
+    assert 1e6 <= summary['small']['peak_bytes'] < 4e6
+    records = chain.records_array()
+    assert records['peak_bytes'].tolist() == chain.peak_bytes.tolist()
+    assert ReconstructionChain([CountingReconstruction()]).summary()[
+        'CountingReconstruction']['peak_bytes'] == -1
+
+class AllocatingBatchReconstruction(AllocatingReconstruction):
+    ''' Test stage, allocates nbytes per evid '''
+    def do_reconstruction(self, event):
+        np.ones(self.nbytes * event.evid, dtype='u1').sum()
+
+    def do_batch_reconstruction(self, events):
+        for event in events:
+            self.do_reconstruction(event)
+
+def test_trace_memory_batch():
+    chain = ReconstructionChain([AllocatingBatchReconstruction(int(1e6))],
+                                record_events=True, trace_memory=True)
+    chain.do_batch_reconstruction([make_event(evid) for evid in (1, 3)])
+    peak_bytes = chain.records_array()['peak_bytes']
+    assert 1e6 <= peak_bytes[0] < 3e6 <= peak_bytes[1]
+
+def test_write_records(tmpdir):
+    chain = ReconstructionChain([BatchReconstruction(), CountingReconstruction()],
+                                record_events=True)
+    recofile = larpixreco.RecoFile.RecoFile(str(tmpdir.join('reco.h5')))
+    chain.do_batch_reconstruction([make_event(evid) for evid in range(3)])
+    chain.write_records(recofile)
+    assert chain.records == []
+    chain.do_reconstruction(make_event(3))
+    chain.write(recofile)
+    records = recofile.datafile['info/reco_stage_records'][:]
+    assert records['evid'].tolist() == [0, 1, 2, 0, 1, 2, 3, 3]
+    # the batch stage time is split evenly between the events of the batch
+    assert len(set(records['wall_time'][:3])) == 1
+    recofile.close()
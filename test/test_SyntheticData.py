@@ -0,0 +1,48 @@
+import pytest
+import h5py
+import numpy as np
+from larpixreco.HitParser import HitParser
+from larpixreco.EventBuilder import EventBuilder
+from larpixreco.SyntheticData import *
+
+def test_generate_rows():
+    rows, truth = generate_rows(20, tracks_per_event=3, noise_rate=0, seed=2)
+    rows_again, truth_again = generate_rows(20, tracks_per_event=3, noise_rate=0, seed=2)
+    assert np.all(rows == rows_again)
+    assert len(rows) == truth['nhit'].sum()
+    assert set(truth['evid']) == set(range(20))
+    col = HitParser._name2col_map
+    assert np.all(rows[:, col['v']] - rows[:, col['pdst_v']] > 0)
+    assert np.all(rows[:, col['pixelx']] < n_pixels * pixel_pitch)
+
+def test_max_delay():
+    ts_col = HitParser._name2col_map['timestamp']
+    rows, truth = generate_rows(20, max_delay=0, seed=3)
+    assert np.all(np.diff(rows[:, ts_col]) >= 0)
+    rows, truth = generate_rows(20, max_delay=5000, seed=3)
+    assert np.any(np.diff(rows[:, ts_col]) < 0)
+
+def test_write_file(tmpdir):
+    filename = str(tmpdir.join('synthetic.h5'))
+    assert write_file(filename, n_events=5, n_rows=1000, noise_rate=0, seed=4) == 1000
+    with h5py.File(filename, 'r') as datafile:
+        assert datafile['data'].shape == (1000, len(HitParser._col2name_map))
+
+    write_file(filename, n_events=30, tracks_per_event=0, noise_rate=0, seed=5)
+    eb = EventBuilder(filename, use_cache=False)
+    events = list(eb.iter_events())
+    with h5py.File(filename, 'r') as datafile:
+        truth = datafile['truth'][:]
+    # single track events with enough hits are built as one event each
+    nhit = np.bincount(truth['evid'], weights=truth['nhit'])
+    assert len(events) == np.count_nonzero(nhit >= EventBuilder.min_ev_len)
+
+def test_generate_events():
+    events = generate_events(3, hits_per_event=30, tracks_per_event=2, overlap=2)
+    assert [event.evid for event in events] == [0, 1, 2]
+    assert [len(event.hits) for event in events] == [30, 30, 30]
+    tracks = events[1].reco_objs
+    assert len(tracks) == 2
+    # consecutive tracks share the overlap hits
+    shared = set(hit.hid for hit in tracks[0].hits) & set(hit.hid for hit in tracks[1].hits)
+    assert len(shared) == 2
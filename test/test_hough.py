@@ -0,0 +1,49 @@
+import pytest
+import numpy as np
+import larpixreco.algorithms.hough as hough
+from larpixreco.types import Event
+from larpixreco.EventBuilder import EventBuilder
+from larpixreco.Reconstruction import TrackReconstruction
+from larpixreco.SyntheticData import write_file
+
+def test_plan_accumulator():
+    points = np.random.RandomState(0).uniform(0, 300, size=(500, 3))
+    plan = hough.plan_accumulator(points, 1000, 3)
+    assert (plan.action, plan.dtype) == ('none', 'f8')
+    assert plan.npositions == hough.count_positions(points, 3)
+    assert plan.nbytes == 1000 * plan.npositions**2 * 8
+    assert plan.nvotes == 500 * 1000
+
+    narrow = hough.plan_accumulator(points, 1000, 3, max_bytes=plan.nbytes // 2)
+    assert (narrow.action, narrow.dtype, narrow.dr) == ('narrow', 'i2', 3)
+
+    coarse = hough.plan_accumulator(points, 1000, 3, max_bytes=plan.nbytes // 20)
+    assert coarse.action == 'coarsen'
+    assert coarse.dr > 3
+    assert coarse.nbytes <= plan.nbytes // 20
+    xp_edges, yp_edges = hough.get_xp_yp_edges(points, coarse.dr)
+    assert len(xp_edges) - 1 == coarse.npositions
+
+    skip = hough.plan_accumulator(points, 1000, 3, max_bytes=plan.nbytes // 20, max_dr=4)
+    assert skip.action == 'skip'
+
+def test_narrow_dtype(tmpdir):
+    datafile = str(tmpdir.join('raw.h5'))
+    write_file(datafile, n_events=1, tracks_per_event=3, noise_rate=0, seed=9)
+    event = next(EventBuilder(datafile, use_cache=False).iter_events())
+    points = np.array([event['px'], event['py'], event['ts']], dtype=float).T
+    float_bytes = hough.plan_accumulator(points / [10, 10, 1000], 50, 3).nbytes
+    tracks = []
+    for max_accumulator_mb in (None, float_bytes / 2e6):
+        reco = TrackReconstruction(hough_ndir=50, max_accumulator_mb=max_accumulator_mb)
+        tracks += [reco.do_reconstruction(Event(event.evid, list(event.hits)))]
+    assert len(tracks[0]) == len(tracks[1]) > 0
+    for track, narrow_track in zip(*tracks):
+        assert (track.theta, track.phi, track.xp, track.yp) == \
+            (narrow_track.theta, narrow_track.phi, narrow_track.xp, narrow_track.yp)
+
+    assert hough.plan_accumulator(points / [10, 10, 1000], 50, 3,
+                                  max_bytes=float_bytes // 2).action == 'narrow'
+    reco = TrackReconstruction(hough_ndir=50, max_accumulator_mb=1e-6, max_dr_mm=3)
+    assert reco.do_reconstruction(event) == []
+    assert reco.skipped_evids == [event.evid]